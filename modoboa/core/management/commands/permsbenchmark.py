@@ -0,0 +1,69 @@
+# coding: utf-8
+"""
+Access grants benchmark.
+
+Creates fake accounts then measures the time needed to promote a new
+account to super administrator (which grants access to every
+object). Everything is done inside a transaction which is rolled back
+at the end, so the database is left untouched.
+"""
+import time
+from optparse import make_option
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from modoboa.core.models import User, ObjectAccess
+from modoboa.lib.permissions import grant_access_to_objects
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the promotion of a super administrator'
+
+    option_list = BaseCommand.option_list + (
+        make_option("--objects", default="10000,100000",
+                    help="Comma separated list of object counts to test"),
+        make_option("--compare", action="store_true", default=False,
+                    help="Also measure the former row by row method")
+    )
+
+    def rowbyrow(self, user, objects, ct):
+        """Previous implementation (one INSERT per object)"""
+        for obj in objects:
+            try:
+                ObjectAccess.objects.create(
+                    user=user, content_type=ct, object_id=obj.id
+                )
+            except IntegrityError:
+                pass
+
+    def run(self, count, compare):
+        ct = ContentType.objects.get_for_model(User)
+        for start in range(0, count, 1000):
+            User.objects.bulk_create([
+                User(username="bench%d@bench.test" % i,
+                     password="{PLAIN}bench")
+                for i in range(start, min(start + 1000, count))
+            ])
+        methods = [("bulk", grant_access_to_objects)]
+        if compare:
+            methods += [("row by row", self.rowbyrow)]
+        for label, method in methods:
+            user = User.objects.create(
+                username="%s@bench.test" % label.replace(" ", ""),
+                password="{PLAIN}bench"
+            )
+            start = time.time()
+            method(user, User.objects.all(), ct)
+            elapsed = time.time() - start
+            print "%d objects, %s: %.2fs (%d grants/s)" % (
+                count, label, elapsed,
+                user.objectaccess_set.count() / max(elapsed, 0.001)
+            )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        for count in [int(c) for c in options["objects"].split(",")]:
+            try:
+                self.run(count, options["compare"])
+            finally:
+                transaction.rollback()
@@ -7,6 +7,7 @@ import base64
 from random import Random
 import reversion
 from django.db import models
+from django.db.models import Q
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext as _, ugettext_lazy
@@ -29,6 +30,21 @@ except ImportError:
     ldap_available = False
 
 
+# Version of the accesses cached by ``User`` instances (see
+# ``User.get_accessible_ids``)
+access_cache_version = 0
+
+
+def invalidate_access_cache():
+    """Invalidate accesses cached by all ``User`` instances
+
+    Must be called each time ``ObjectAccess`` entries are created or
+    deleted.
+    """
+    global access_cache_version
+    access_cache_version += 1
+
+
 class User(AbstractBaseUser, PermissionsMixin):
     """Custom User model.
 
@@ -86,8 +102,9 @@ class User(AbstractBaseUser, PermissionsMixin):
         ungrant_access_to_object(self)
         super(User, self).delete()
 
-    def _crypt_password(self, raw_value):
-        scheme = parameters.get_admin("PASSWORD_SCHEME")
+    def _crypt_password(self, raw_value, scheme=None):
+        if scheme is None:
+            scheme = parameters.get_admin("PASSWORD_SCHEME")
         if type(raw_value) is unicode:
             raw_value = raw_value.encode("utf-8")
         if scheme == "crypt":
@@ -237,35 +254,65 @@ class User(AbstractBaseUser, PermissionsMixin):
             return False
         return ooentry.is_owner
 
+    def get_accessible_ids(self, ct):
+        """Return the identifiers of the objects this user can access
+
+        An object is accessible if the user has got a direct access to
+        it, or if it is owned by a user he has got access to. Both
+        cases are resolved with a single query.
+
+        Results are cached by the instance (so during one request
+        when used with ``request.user``) until accesses change.
+
+        :param ct: a ``ContentType`` object
+        :return: a set of identifiers
+        """
+        cache = getattr(self, "_access_cache", None)
+        if cache is None or cache[0] != access_cache_version:
+            cache = self._access_cache = (access_cache_version, {})
+        if not ct.id in cache[1]:
+            q = Q(user=self)
+            if ct.model != "user":
+                users = ObjectAccess.objects.filter(
+                    user=self,
+                    content_type=ContentType.objects.get_for_model(self)
+                ).values("object_id")
+                q |= Q(is_owner=True, user__in=users)
+            cache[1][ct.id] = set(
+                ObjectAccess.objects.filter(q, content_type=ct)
+                .values_list("object_id", flat=True)
+            )
+        return cache[1][ct.id]
+
     def can_access(self, obj):
         """Check if the user can access a specific object
 
-        This function is recursive : if the given user hasn't got direct
-        access to this object and if he has got access other ``User``
-        objects, we check if one of those users owns the object.
+        If the user hasn't got direct access to this object and if he
+        has got access other ``User`` objects, we check if one of those
+        users owns the object.
 
         :param obj: a admin object
         :return: a boolean
         """
         if self.is_superuser:
             return True
+        return obj.id in self.get_accessible_ids(
+            ContentType.objects.get_for_model(obj)
+        )
 
-        ct = ContentType.objects.get_for_model(obj)
-        try:
-            ooentry = self.objectaccess_set.get(content_type=ct, object_id=obj.id)
-        except ObjectAccess.DoesNotExist:
-            pass
-        else:
-            return True
-        if ct.model == "user":
-            return False
+    def can_access_many(self, objects):
+        """Check if the user can access several objects
 
-        ct = ContentType.objects.get_for_model(self)
-        qs = self.objectaccess_set.filter(content_type=ct)
-        for ooentry in qs.all():
-            if ooentry.content_object.is_owner(obj):
-                return True
-        return False
+        :param objects: a list of admin objects (types can differ)
+        :return: a list of booleans (one per object)
+        """
+        if self.is_superuser:
+            return [True] * len(objects)
+        return [
+            obj.id in self.get_accessible_ids(
+                ContentType.objects.get_for_model(obj)
+            ) for obj in objects
+        ]
 
     def set_role(self, role):
         """Set administrative role for this account
@@ -281,6 +328,7 @@ class User(AbstractBaseUser, PermissionsMixin):
         else:
             if self.is_superuser:
                 ObjectAccess.objects.filter(user=self).delete()
+                invalidate_access_cache()
             self.is_superuser = False
             try:
                 self.groups.add(Group.objects.get(name=role))
@@ -1,6 +1,14 @@
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
+from django.test import TestCase
+from modoboa.lib.permissions import (
+    bulk_grant, grant_access_to_object, grant_access_to_objects,
+    ungrant_access_to_object
+)
 from modoboa.lib.tests import ModoTestCase
 from . import factories
+from .models import User, ObjectAccess
 
 
 class ProfileTestCase(ModoTestCase):
@@ -40,3 +48,112 @@ class ProfileTestCase(ModoTestCase):
         self.assertEqual(
             self.clt.login(username="user@test.com", password="tutu"), True
         )
+
+
+class GrantAccessTestCase(TestCase):
+    fixtures = ['initial_users.json']
+
+    def setUp(self):
+        self.ct = ContentType.objects.get_for_model(User)
+        for i in range(5):
+            factories.UserFactory(username="user%d@test.com" % i,
+                                  groups=('SimpleUsers',))
+        self.admin = factories.UserFactory(
+            username="admin@test.com", groups=('DomainAdmins',)
+        )
+
+    def test_grant_access_to_objects(self):
+        self.assertEqual(
+            grant_access_to_objects(self.admin, User.objects.all(), self.ct,
+                                    batch_size=2),
+            7
+        )
+        # Nothing left to grant, existing entries are kept
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                grant_access_to_objects(self.admin, User.objects.all(),
+                                        self.ct),
+                0
+            )
+        self.assertEqual(
+            grant_access_to_objects(self.admin, list(User.objects.all()),
+                                    self.ct),
+            0
+        )
+        self.assertEqual(self.admin.objectaccess_set.count(), 7)
+        self.assertFalse(
+            self.admin.objectaccess_set.filter(is_owner=True).exists()
+        )
+
+    def test_bulk_grant_duplicates(self):
+        users = list(User.objects.filter(username__startswith="user"))
+        ObjectAccess.objects.create(user=self.admin, content_type=self.ct,
+                                    object_id=users[0].id)
+        # The batch fails, only the missing entries are counted
+        self.assertEqual(
+            bulk_grant(
+                ObjectAccess(user=self.admin, content_type=self.ct,
+                             object_id=user.id)
+                for user in users
+            ),
+            4
+        )
+        self.assertEqual(self.admin.objectaccess_set.count(), 5)
+
+    def test_grant_access_to_object(self):
+        su = factories.UserFactory(username="admin2", groups=())
+        su.is_superuser = True
+        su.save()
+        user = factories.UserFactory(username="user@test.com",
+                                     groups=('SimpleUsers',))
+        # Owned by 'admin', granted to the other superuser
+        entries = ObjectAccess.objects.filter(content_type=self.ct,
+                                              object_id=user.id)
+        self.assertEqual(
+            sorted(entries.values_list("user__username", "is_owner")),
+            [(u"admin", True), (u"admin2", False)]
+        )
+        grant_access_to_object(self.admin, user, is_owner=True)
+        self.assertEqual(entries.count(), 3)
+        self.assertTrue(entries.get(user=self.admin).is_owner)
+
+
+class AccessCacheTestCase(TestCase):
+    fixtures = ['initial_users.json']
+
+    def setUp(self):
+        self.admin = factories.UserFactory(
+            username="admin@test.com", groups=('DomainAdmins',)
+        )
+        self.user = factories.UserFactory(username="user@test.com",
+                                          groups=('SimpleUsers',))
+        self.user2 = factories.UserFactory(username="user2@test.com",
+                                           groups=('SimpleUsers',))
+        self.superadmin = User.objects.get(username="admin")
+        grant_access_to_object(self.admin, self.user, is_owner=True)
+
+    def test_cached_accesses(self):
+        admin = User.objects.get(pk=self.admin.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(admin.can_access(self.user))
+            self.assertFalse(admin.can_access(self.user2))
+        self.assertEqual(
+            admin.can_access_many([self.user, self.user2, self.superadmin]),
+            [True, False, False]
+        )
+        grant_access_to_object(admin, self.user2)
+        self.assertTrue(admin.can_access(self.user2))
+        ungrant_access_to_object(self.user, admin)
+        self.assertFalse(admin.can_access(self.user))
+
+    def test_owned_objects(self):
+        # Objects owned by a user the admin can access
+        group = Group.objects.get(name="SimpleUsers")
+        grant_access_to_object(self.user, group, is_owner=True)
+        admin = User.objects.get(pk=self.admin.pk)
+        self.assertTrue(admin.can_access(group))
+        self.assertFalse(User.objects.get(pk=self.user2.pk).can_access(group))
+        self.assertEqual(
+            admin.get_accessible_ids(ContentType.objects.get_for_model(group)),
+            set([group.id])
+        )
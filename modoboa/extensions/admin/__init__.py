@@ -127,6 +127,9 @@ def grant_access_to_all_objects(user, role):
 def export_admin_domains(admin):
     if admin.group != "DomainAdmins":
         return []
+    if hasattr(admin, "administered_domains"):
+        # Already fetched by the export
+        return admin.administered_domains
     return [dom.name for dom in Domain.objects.get_for_admin(admin)]
 
 
@@ -0,0 +1,486 @@
+# coding: utf-8
+"""
+Bulk import of domains and identities from a CSV file.
+
+The uploaded file is never loaded in memory: it is read several
+times, line by line.
+
+1. The names referenced by the file (domains, accounts, mailboxes
+   and aliases) are collected and resolved with a few queries,
+2. Every line is validated. If one is invalid, nothing is written
+   and all errors are reported with their line numbers,
+3. Lines are written by batches, one transaction per batch. Simple
+   users and domain administrators (the main content of a migration)
+   are created with ``bulk_create``; other lines use the regular
+   ``from_csv`` methods.
+"""
+import csv
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils.translation import ugettext as _
+from modoboa.core.models import User, ObjectAccess
+from modoboa.lib import events, parameters
+from modoboa.lib.emailutils import split_mailbox
+from modoboa.lib.exceptions import ModoboaException, PermDeniedException
+from modoboa.lib.permissions import bulk_grant
+from modoboa.extensions.admin.exceptions import AdminError
+from modoboa.extensions.admin.models import (
+    Domain, DomainAlias, Mailbox, Alias, Quota
+)
+from modoboa.extensions.admin.models.base import ObjectDates
+
+# Roles created in bulk. Other roles need extra processing (see
+# ``User.set_role``) so they use the regular method.
+BULK_ROLES = ["SimpleUsers", "DomainAdmins"]
+
+# Values per ``__in`` lookup (SQLite accepts 999 parameters per query)
+LOOKUP_SIZE = 500
+
+# Maximum number of errors reported
+MAX_ERRORS = 20
+
+
+def chunks(values, size=LOOKUP_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class Importer(object):
+    """CSV importer
+
+    :param user: the ``User`` importing the file
+    :param options: the import form's cleaned data
+    :param batch_size: number of lines written per transaction
+    """
+
+    def __init__(self, user, options, batch_size=500):
+        self.user = user
+        self.sepchar = options["sepchar"]
+        self.continue_if_exists = options["continue_if_exists"]
+        self.crypt_password = options.get("crypt_password", False)
+        self.batch_size = batch_size
+        self.errors = []
+        self.skipped = set()
+        self.count = 0
+
+    def rows(self, fp):
+        """Iterate over the lines of a file
+
+        :param fp: a file object
+        :return: a generator of (line number, row)
+        """
+        fp.seek(0)
+        reader = csv.reader(fp, delimiter=self.sepchar)
+        for row in reader:
+            if not row:
+                continue
+            row[0] = row[0].strip()
+            if not hasattr(self, "check_%s" % row[0]):
+                continue
+            yield reader.line_num, row
+
+    def import_file(self, fp):
+        """Import a file
+
+        :param fp: a file object
+        :return: the number of imported objects
+        """
+        self.resolve(fp)
+        self.validate(fp)
+        if self.errors:
+            msg = "\n".join(
+                [_("Line %d: %s") % (lineno, error)
+                 for lineno, error in self.errors[:MAX_ERRORS]]
+            )
+            if len(self.errors) > MAX_ERRORS:
+                msg += "\n" + _("(%d more errors)") \
+                    % (len(self.errors) - MAX_ERRORS)
+            raise AdminError(msg)
+        return self.write(fp)
+
+    #
+    # First pass: resolve the referenced objects
+    #
+
+    def resolve(self, fp):
+        domains = set()
+        usernames = set()
+        addresses = set()
+        for lineno, row in self.rows(fp):
+            values = [v.strip() for v in row[1:]]
+            if row[0] == "domain":
+                domains.update(values[:1])
+            elif row[0] == "domainalias":
+                domains.update(values[:2])
+            elif row[0] == "account":
+                usernames.update(values[:1])
+                if len(values) > 6 and values[6]:
+                    addresses.add(values[6])
+                domains.update(values[7:])
+            else:
+                addresses.update(values[:1])
+                addresses.update(values[2:])
+        domains.update([split_mailbox(addr)[1] for addr in addresses])
+        domains.discard(None)
+
+        self.domains = {}
+        self.domaliases = set()
+        for chunk in chunks(domains):
+            for dom in Domain.objects.filter(name__in=chunk):
+                self.domains[dom.name] = dom
+            self.domaliases.update(
+                DomainAlias.objects.filter(name__in=chunk)
+                .values_list("name", flat=True)
+            )
+        self.usernames = set()
+        for chunk in chunks(usernames):
+            self.usernames.update(
+                User.objects.filter(username__in=chunk)
+                .values_list("username", flat=True)
+            )
+        self.mailboxes = set()
+        self.aliases = set()
+        localparts = set([split_mailbox(addr)[0] for addr in addresses])
+        localparts.discard(None)
+        for chunk in chunks(localparts):
+            for model, result in [(Mailbox, self.mailboxes),
+                                  (Alias, self.aliases)]:
+                for address, domname in model.objects.filter(
+                        address__in=chunk
+                ).values_list("address", "domain__name"):
+                    result.add("%s@%s" % (address, domname))
+        if self.user.is_superuser:
+            self.accessible_domains = None
+        else:
+            self.accessible_domains = self.user.get_accessible_ids(
+                ContentType.objects.get_for_model(Domain)
+            )
+
+    #
+    # Second pass: validation
+    #
+
+    def validate(self, fp):
+        for lineno, row in self.rows(fp):
+            try:
+                if not getattr(self, "check_%s" % row[0])(row):
+                    self.skipped.add(lineno)
+            except ModoboaException, e:
+                self.errors.append((lineno, str(e)))
+
+    def exists(self, row):
+        """Report an already existing object
+
+        :return: False (the line is skipped) if allowed
+        """
+        if self.continue_if_exists:
+            return False
+        raise AdminError(_("Object already exists: %s" % row))
+
+    def verify_access(self, domain):
+        if self.accessible_domains is not None and \
+                not domain.id in self.accessible_domains:
+            raise PermDeniedException(domain.name)
+
+    def check_domain(self, row):
+        if len(row) < 4:
+            raise AdminError(_("Invalid line"))
+        name = row[1].strip()
+        try:
+            quota = int(row[2].strip())
+        except ValueError:
+            raise AdminError(_("Invalid quota value for domain '%s'" % name))
+        if name in self.domains:
+            return self.exists(row)
+        # Created domains are visible to the following lines
+        self.domains[name] = Domain(name=name, quota=quota)
+        return True
+
+    def check_domainalias(self, row):
+        if len(row) < 4:
+            raise AdminError(_("Invalid line"))
+        name = row[1].strip()
+        domname = row[2].strip()
+        if not domname in self.domains:
+            raise AdminError(_("Unknown domain %s" % domname))
+        if name in self.domaliases:
+            return self.exists(row)
+        self.domaliases.add(name)
+        return True
+
+    def check_account(self, row):
+        if len(row) < 7:
+            raise AdminError(_("Invalid line"))
+        username = row[1].strip()
+        role = row[6].strip()
+        if not self.user.is_superuser and \
+                not role in ["SimpleUsers", "DomainAdmins"]:
+            raise PermDeniedException(
+                _("You can't import an account with a role greater than yours")
+            )
+        email = row[7].strip() if len(row) > 7 else ""
+        if role == "SimpleUsers":
+            if email == "":
+                raise AdminError(
+                    _("The simple user '%s' must have a valid email address" % username)
+                )
+            if username != email:
+                raise AdminError(
+                    _("username and email fields must not differ for '%s'" % username)
+                )
+        if username in self.usernames:
+            return self.exists(row)
+        if email != "":
+            localpart, domname = split_mailbox(email)
+            if not domname in self.domains:
+                raise AdminError(
+                    _("Account import failed (%s): domain does not exist" % username)
+                )
+            domain = self.domains[domname]
+            if domain.id is not None:
+                self.verify_access(domain)
+            if email in self.mailboxes:
+                return self.exists(row)
+            mb = Mailbox(address=localpart, domain=domain,
+                         use_domain_quota=True)
+            mb.set_quota(override_rules=self.user.has_perm("admin.change_domain"))
+            self.mailboxes.add(email)
+        self.usernames.add(username)
+        return True
+
+    def check_alias(self, row, expected_elements=4):
+        if len(row) < expected_elements:
+            raise AdminError(_("Invalid line: %s" % row))
+        address = row[1].strip()
+        localpart, domname = split_mailbox(address)
+        if not domname in self.domains:
+            raise AdminError(_("Domain '%s' does not exist" % domname))
+        domain = self.domains[domname]
+        if domain.id is not None:
+            self.verify_access(domain)
+        if address in self.aliases:
+            return self.exists(row)
+        for rcpt in row[3:]:
+            rcpt = rcpt.strip()
+            if not split_mailbox(rcpt)[1] in self.domains:
+                continue
+            if not rcpt in self.aliases and not rcpt in self.mailboxes:
+                raise AdminError(_("Local recipient %s not found" % rcpt))
+        self.aliases.add(address)
+        return True
+
+    def check_forward(self, row):
+        return self.check_alias(row)
+
+    def check_dlist(self, row):
+        return self.check_alias(row, 5)
+
+    #
+    # Third pass: creation
+    #
+
+    def write(self, fp):
+        self.password_scheme = parameters.get_admin("PASSWORD_SCHEME", app="core")
+        self.local_auth = \
+            parameters.get_admin("AUTHENTICATION_TYPE", app="core") == "local"
+        self.override_quota = self.user.has_perm("admin.change_domain")
+        self.superusers = list(
+            User.objects.filter(is_superuser=True)
+            .exclude(pk=self.user.pk).values_list("pk", flat=True)
+        )
+        self.groups = dict(
+            [(grp.name, grp) for grp in Group.objects.filter(name__in=BULK_ROLES)]
+        )
+        self.domain_admins = {}
+
+        batch = []
+        for lineno, row in self.rows(fp):
+            if lineno in self.skipped:
+                continue
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch)
+                self.count += len(batch)
+                batch = []
+        if batch:
+            self.write_batch(batch)
+            self.count += len(batch)
+        return self.count
+
+    @transaction.commit_on_success
+    def write_batch(self, rows):
+        accounts = []
+        for row in rows:
+            if row[0] == "account" and row[6].strip() in BULK_ROLES:
+                accounts.append(row)
+                continue
+            if accounts:
+                self.create_accounts(accounts)
+                accounts = []
+            getattr(self, "import_%s" % row[0])(row)
+        if accounts:
+            self.create_accounts(accounts)
+
+    def get_domain(self, name):
+        domain = self.domains.get(name)
+        if domain is None or domain.id is None:
+            try:
+                domain = Domain.objects.get(name=name)
+            except Domain.DoesNotExist:
+                return None
+            self.domains[name] = domain
+        return domain
+
+    def get_domain_admins(self, domain):
+        if not domain.id in self.domain_admins:
+            self.domain_admins[domain.id] = list(
+                domain.owners.filter(user__is_superuser=False)
+                .values_list("user", flat=True)
+            )
+        return self.domain_admins[domain.id]
+
+    def import_domain(self, row):
+        dom = Domain()
+        dom.from_csv(self.user, row)
+        self.domains[dom.name] = dom
+
+    def import_domainalias(self, row):
+        domalias = DomainAlias()
+        domalias.from_csv(self.user, row)
+
+    def import_account(self, row):
+        account = User()
+        account.from_csv(self.user, row, self.crypt_password)
+
+    def import_alias(self, row):
+        alias = Alias()
+        alias.from_csv(self.user, row, expected_elements=4)
+
+    def import_forward(self, row):
+        self.import_alias(row)
+
+    def import_dlist(self, row):
+        alias = Alias()
+        alias.from_csv(self.user, row)
+
+    def grants(self, ct, obj_id):
+        """Accesses given to the importer and the super users"""
+        yield ObjectAccess(user=self.user, content_type=ct,
+                           object_id=obj_id, is_owner=True)
+        for pk in self.superusers:
+            yield ObjectAccess(user_id=pk, content_type=ct, object_id=obj_id)
+
+    def create_accounts(self, rows):
+        """Create accounts (and their mailboxes) in bulk
+
+        The result is the same as ``User.from_csv`` (see also the
+        ``AccountImported`` handler) but the ``AccountCreated`` and
+        ``CreateMailbox`` events are raised once, with the list of
+        created objects.
+
+        :param rows: a list of rows (simple users and domain admins)
+        """
+        accounts = []
+        for row in rows:
+            account = User(
+                username=row[1].strip(), first_name=row[3].strip(),
+                last_name=row[4].strip(), is_active=row[5].strip() == "True"
+            )
+            if len(row) > 7:
+                account.email = row[7].strip()
+            password = row[2].strip()
+            if not self.crypt_password:
+                account.password = password
+            elif self.local_auth:
+                account.password = account._crypt_password(
+                    password, self.password_scheme
+                )
+            else:
+                account.set_password(password)
+            accounts.append(account)
+        for chunk in chunks(accounts):
+            User.objects.bulk_create(chunk)
+        ids = {}
+        for chunk in chunks([a.username for a in accounts]):
+            ids.update(User.objects.filter(username__in=chunk)
+                       .values_list("username", "id"))
+        for account in accounts:
+            account.id = ids[account.username]
+
+        user_ct = ContentType.objects.get_for_model(User)
+        memberships = []
+        accesses = []
+        for account, row in zip(accounts, rows):
+            role = row[6].strip()
+            memberships.append(User.groups.through(
+                user_id=account.id, group_id=self.groups[role].id
+            ))
+            accesses += self.grants(user_ct, account.id)
+            if role == "DomainAdmins":
+                accesses.append(ObjectAccess(
+                    user=account, content_type=user_ct, object_id=account.id
+                ))
+        for chunk in chunks(memberships):
+            User.groups.through.objects.bulk_create(chunk)
+
+        mailboxes = self.create_mailboxes(
+            [account for account in accounts if account.email != ""]
+        )
+        mb_ct = ContentType.objects.get_for_model(Mailbox)
+        for mb in mailboxes:
+            accesses += self.grants(mb_ct, mb.id)
+            if not self.user.is_superuser:
+                continue
+            # See ``Mailbox.post_create``
+            for pk in self.get_domain_admins(mb.domain):
+                accesses += [
+                    ObjectAccess(user_id=pk, content_type=mb_ct,
+                                 object_id=mb.id),
+                    ObjectAccess(user_id=pk, content_type=user_ct,
+                                 object_id=mb.user_id)
+                ]
+        bulk_grant(accesses)
+
+        for account, row in zip(accounts, rows):
+            if row[6].strip() != "DomainAdmins":
+                continue
+            for domname in row[8:]:
+                domain = self.get_domain(domname.strip())
+                if domain is not None:
+                    domain.add_admin(account)
+                    self.domain_admins.pop(domain.id, None)
+
+        events.raiseEvent("AccountCreated", accounts)
+        if mailboxes:
+            events.raiseEvent("CreateMailbox", self.user, mailboxes)
+
+    def create_mailboxes(self, accounts):
+        """Create the mailboxes of new accounts
+
+        :param accounts: a list of ``User`` objects (with an email)
+        :return: the list of created ``Mailbox`` objects
+        """
+        mailboxes = []
+        for account in accounts:
+            localpart, domname = split_mailbox(account.email)
+            mb = Mailbox(address=localpart, domain=self.get_domain(domname),
+                         user=account, use_domain_quota=True)
+            mb.set_quota(override_rules=self.override_quota)
+            # Dates are not shared: each mailbox needs its own row
+            mb.dates = ObjectDates.objects.create()
+            mailboxes.append(mb)
+        for chunk in chunks(mailboxes):
+            Mailbox.objects.bulk_create(chunk)
+        ids = {}
+        for chunk in chunks([account.id for account in accounts]):
+            ids.update(Mailbox.objects.filter(user__in=chunk)
+                       .values_list("user", "id"))
+        for mb in mailboxes:
+            mb.id = ids[mb.user_id]
+        for chunk in chunks(mailboxes):
+            Quota.objects.bulk_create([
+                Quota(username=mb.full_address, mbox_id=mb.id) for mb in chunk
+            ])
+        return mailboxes
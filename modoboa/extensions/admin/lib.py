@@ -56,18 +56,17 @@ def get_listing_page(objects, pagenum):
     return page
 
 
-def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
-    """Return all the identities owned by a user.
+def get_identities_querysets(user, searchquery=None, idtfilter=None,
+                             grpfilter=None):
+    """Return the querysets of the identities owned by a user.
 
     :param user: the desired user
     :param str searchquery: search pattern
     :param list idtfilter: identity type filters
     :param list grpfilter: group names filters
-    :return: a queryset
+    :return: a tuple (accounts, aliases), None if filtered out
     """
-    from itertools import chain
-
-    accounts = []
+    accounts = None
     if idtfilter is None or not idtfilter or idtfilter == "account":
         ids = user.objectaccess_set \
             .filter(content_type=ContentType.objects.get_for_model(user)) \
@@ -81,9 +80,9 @@ def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
                 q &= Q(is_superuser=True)
             else:
                 q &= Q(groups__name=grpfilter)
-        accounts = User.objects.select_related().filter(q)
+        accounts = User.objects.filter(q)
 
-    aliases = []
+    aliases = None
     if idtfilter is None or not idtfilter \
             or (idtfilter in ["alias", "forward", "dlist"]):
         alct = ContentType.objects.get_for_model(Alias)
@@ -100,7 +99,162 @@ def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
             else:
                 q &= Q(address__icontains=searchquery) | \
                     Q(domain__name__icontains=searchquery)
-        aliases = Alias.objects.select_related().filter(q)
         if idtfilter is not None and idtfilter:
-            aliases = [al for al in aliases if al.type == idtfilter]
+            q &= Q(alias_type=idtfilter)
+        aliases = Alias.objects.filter(q)
+    return accounts, aliases
+
+
+def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
+    """Return all the identities owned by a user.
+
+    :param user: the desired user
+    :param str searchquery: search pattern
+    :param list idtfilter: identity type filters
+    :param list grpfilter: group names filters
+    :return: a queryset
+    """
+    from itertools import chain
+
+    accounts, aliases = get_identities_querysets(
+        user, searchquery, idtfilter, grpfilter
+    )
+    if accounts is None:
+        accounts = []
+    else:
+        accounts = accounts.select_related()
+    if aliases is None:
+        aliases = []
+    else:
+        aliases = aliases.select_related()
     return chain(accounts, aliases)
+
+
+class IdentitiesList(object):
+    """The identities owned by a user, sorted and paginated by the database
+
+    Accounts and aliases are combined using a ``UNION ALL`` query
+    which also computes the sort keys (first recipients of
+    aliases). Only the identifiers of the requested slice are
+    returned by the database, the corresponding objects are then
+    loaded with their relations.
+
+    Supports ``count()`` and slicing so it can be given to a
+    ``Paginator``.
+    """
+    sort_columns = {
+        "identity": "identity", "name_or_rcpt": "name_or_rcpt", "tags": "tag"
+    }
+
+    def __init__(self, user, sort_order="identity", sort_dir="",
+                 searchquery=None, idtfilter=None, grpfilter=None):
+        self.sort_column = self.sort_columns[sort_order]
+        self.sort_dir = "DESC" if sort_dir == "-" else "ASC"
+        self.accounts, self.aliases = get_identities_querysets(
+            user, searchquery, idtfilter, grpfilter
+        )
+        self._count = None
+
+    def _concat(self, *parts):
+        from modoboa.lib.dbutils import db_type
+
+        if db_type() == "mysql":
+            return "CONCAT(%s)" % ", ".join(parts)
+        return " || ".join(parts)
+
+    def _accounts_sql(self):
+        sql, params = self.accounts.values_list("pk", flat=True) \
+            .query.sql_with_params()
+        return """SELECT 'account' AS kind, u.id AS id, u.username AS identity,
+  CASE WHEN u.first_name <> '' THEN %s ELSE '----' END AS name_or_rcpt,
+  'account' AS tag
+FROM core_user u WHERE u.id IN (%s)""" % (
+            self._concat("u.first_name", "' '", "u.last_name"), sql
+        ), params
+
+    def _aliases_sql(self):
+        sql, params = self.aliases.values_list("pk", flat=True) \
+            .query.sql_with_params()
+        return """SELECT 'alias' AS kind, a.id AS id, %(identity)s AS identity,
+  CASE WHEN a.rcpts_count = 0 THEN '---'
+       ELSE COALESCE(
+         (SELECT %(target)s FROM admin_alias_aliases r
+          INNER JOIN admin_alias t ON r.to_alias_id = t.id
+          INNER JOIN admin_domain td ON t.domain_id = td.id
+          WHERE r.from_alias_id = a.id
+          ORDER BY td.name, t.address LIMIT 1),
+         (SELECT %(mbox)s FROM admin_alias_mboxes r
+          INNER JOIN admin_mailbox m ON r.mailbox_id = m.id
+          INNER JOIN admin_domain md ON m.domain_id = md.id
+          WHERE r.alias_id = a.id
+          ORDER BY m.id LIMIT 1),
+         a.extmboxes)
+  END AS name_or_rcpt,
+  a.alias_type AS tag
+FROM admin_alias a INNER JOIN admin_domain d ON a.domain_id = d.id
+WHERE a.id IN (%(ids)s)""" % {
+            "identity": self._concat("a.address", "'@'", "d.name"),
+            "target": self._concat("t.address", "'@'", "td.name"),
+            "mbox": self._concat("m.address", "'@'", "md.name"),
+            "ids": sql
+        }, params
+
+    def _query(self, columns, suffix=""):
+        parts = []
+        params = []
+        for qset, method in [(self.accounts, self._accounts_sql),
+                             (self.aliases, self._aliases_sql)]:
+            if qset is None:
+                continue
+            sql, qparams = method()
+            parts.append(sql)
+            params += list(qparams)
+        if not parts:
+            return None, None
+        sql = "SELECT %s FROM (%s) identities" \
+            % (columns, " UNION ALL ".join(parts))
+        return sql + suffix, params
+
+    def _execute(self, sql, params):
+        from django.db import connection
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def count(self):
+        if self._count is None:
+            sql, params = self._query("COUNT(*)")
+            self._count = 0 if sql is None \
+                else self._execute(sql, params)[0][0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("Only slices are supported")
+        start = key.start or 0
+        sql, params = self._query(
+            "kind, id",
+            " ORDER BY %s %s, kind, identity LIMIT %d OFFSET %d" % (
+                self.sort_column, self.sort_dir, key.stop - start, start
+            )
+        )
+        if sql is None:
+            return []
+        rows = self._execute(sql, params)
+        objects = {}
+        ids = [pk for kind, pk in rows if kind == "account"]
+        if ids:
+            for account in User.objects.filter(pk__in=ids) \
+                    .prefetch_related("groups"):
+                objects[("account", account.id)] = account
+        ids = [pk for kind, pk in rows if kind == "alias"]
+        if ids:
+            for alias in Alias.objects.filter(pk__in=ids) \
+                    .select_related("domain") \
+                    .prefetch_related("aliases__domain", "mboxes__domain"):
+                objects[("alias", alias.id)] = alias
+        return [objects[row] for row in rows]
@@ -0,0 +1,30 @@
+# coding: utf-8
+"""
+Rebuild the recipient counters of aliases.
+
+Counters are maintained automatically. This command is useful if
+aliases are modified outside Modoboa (directly in the database for
+example).
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from modoboa.extensions.admin.models import Alias
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the recipient counters and types of aliases'
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=500,
+                    help="Number of aliases updated per transaction"),
+    )
+
+    def handle(self, *args, **options):
+        ids = list(Alias.objects.order_by("pk").values_list("pk", flat=True))
+        size = options["batch_size"]
+        for start in range(0, len(ids), size):
+            with transaction.commit_on_success():
+                Alias.objects.update_recipients_info(ids[start:start + size])
+        if int(options["verbosity"]) > 1:
+            print "%d alias(es) updated" % len(ids)
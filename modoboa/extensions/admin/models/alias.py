@@ -1,5 +1,8 @@
 import reversion
-from django.db import models
+from django.db import models, connection
+from django.db.models.manager import Manager
+from django.db.models.signals import m2m_changed, pre_delete, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext as _, ugettext_lazy
 from modoboa.lib import events
 from modoboa.lib.emailutils import split_mailbox
@@ -10,6 +13,48 @@ from .domain import Domain
 from .mailbox import Mailbox
 
 
+# Number of recipients of an alias (see ``Alias.rcpts_count``)
+RCPTS_COUNT_SQL = """(SELECT COUNT(*) FROM admin_alias_aliases r
+ WHERE r.from_alias_id = admin_alias.id)
++ (SELECT COUNT(*) FROM admin_alias_mboxes r
+   WHERE r.alias_id = admin_alias.id)
++ CASE WHEN admin_alias.extmboxes = '' THEN 0
+       ELSE LENGTH(admin_alias.extmboxes)
+            - LENGTH(REPLACE(admin_alias.extmboxes, ',', '')) + 1
+  END"""
+
+
+class AliasManager(Manager):
+
+    def update_recipients_info(self, ids=None):
+        """Compute the number of recipients and the type of aliases
+
+        Counters are computed by the database (two ``UPDATE``
+        queries).
+
+        :param list ids: the aliases to update (all if None)
+        """
+        where = ""
+        params = []
+        if ids is not None:
+            if not ids:
+                return
+            where = " WHERE admin_alias.id IN (%s)" \
+                % ", ".join(["%s"] * len(ids))
+            params = list(ids)
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE admin_alias SET rcpts_count = %s%s"
+            % (RCPTS_COUNT_SQL, where), params
+        )
+        cursor.execute(
+            "UPDATE admin_alias SET alias_type = CASE "
+            "WHEN rcpts_count > 1 THEN 'dlist' "
+            "WHEN extmboxes <> '' THEN 'forward' "
+            "ELSE 'alias' END%s" % where, params
+        )
+
+
 class Alias(DatesAware):
     address = models.CharField(
         ugettext_lazy('address'), max_length=254,
@@ -29,6 +74,14 @@ class Alias(DatesAware):
         ugettext_lazy('enabled'),
         help_text=ugettext_lazy("Check to activate this alias")
     )
+    # Denormalized values, updated when recipients change (see
+    # ``update_recipients_info``)
+    rcpts_count = models.PositiveIntegerField(default=0, editable=False)
+    alias_type = models.CharField(
+        max_length=7, default="alias", editable=False
+    )
+
+    objects = AliasManager()
 
     class Meta:
         permissions = (
@@ -51,7 +104,7 @@ class Alias(DatesAware):
 
     @property
     def name_or_rcpt(self):
-        rcpts_count = self.get_recipients_count()
+        rcpts_count = self.rcpts_count
         if not rcpts_count:
             return "---"
         rcpts = self.get_recipients()
@@ -61,12 +114,7 @@ class Alias(DatesAware):
 
     @property
     def type(self):
-        cpt = self.get_recipients_count()
-        if cpt > 1:
-            return "dlist"
-        if self.extmboxes != "":
-            return "forward"
-        return "alias"
+        return self.alias_type
 
     @property
     def tags(self):
@@ -104,21 +152,23 @@ class Alias(DatesAware):
         super(Alias, self).save(*args, **kwargs)
         if creator is not None:
             self.post_create(creator)
-        curaliases = self.aliases.all()
-        curmboxes = self.mboxes.all()
-        for t in int_rcpts:
-            if isinstance(t, Alias):
-                if not t in curaliases:
-                    self.aliases.add(t)
-                continue
-            if not t in curmboxes:
-                self.mboxes.add(t)
-        for t in curaliases:
-            if not t in int_rcpts:
-                self.aliases.remove(t)
-        for t in curmboxes:
-            if not t in int_rcpts:
-                self.mboxes.remove(t)
+        curaliases = list(self.aliases.all())
+        curmboxes = list(self.mboxes.all())
+        newaliases = [t for t in int_rcpts if isinstance(t, Alias)]
+        newmboxes = [t for t in int_rcpts if not isinstance(t, Alias)]
+        toadd = [t for t in newaliases if not t in curaliases]
+        if toadd:
+            self.aliases.add(*toadd)
+        toadd = [t for t in newmboxes if not t in curmboxes]
+        if toadd:
+            self.mboxes.add(*toadd)
+        toremove = [t for t in curaliases if not t in int_rcpts]
+        if toremove:
+            self.aliases.remove(*toremove)
+        toremove = [t for t in curmboxes if not t in int_rcpts]
+        if toremove:
+            self.mboxes.remove(*toremove)
+        self.update_recipients_info()
 
     def delete(self):
         from modoboa.lib.permissions import ungrant_access_to_object
@@ -141,6 +191,9 @@ class Alias(DatesAware):
     def get_recipients_count(self):
         """Return the number of recipients of this alias.
 
+        The value is read from the database, use ``rcpts_count`` to
+        avoid the queries.
+
         :rtype: int
         """
         total = 0
@@ -148,6 +201,19 @@ class Alias(DatesAware):
             total += len(self.extmboxes.split(','))
         return total + self.aliases.count() + self.mboxes.count()
 
+    def update_recipients_info(self):
+        """Update the number of recipients and the type of this alias"""
+        self.rcpts_count = self.get_recipients_count()
+        if self.rcpts_count > 1:
+            self.alias_type = "dlist"
+        elif self.extmboxes != "":
+            self.alias_type = "forward"
+        else:
+            self.alias_type = "alias"
+        Alias.objects.filter(pk=self.pk).update(
+            rcpts_count=self.rcpts_count, alias_type=self.alias_type
+        )
+
     def from_csv(self, user, row, expected_elements=5):
         """Create a new alias from a CSV file entry
 
@@ -195,3 +261,49 @@ class Alias(DatesAware):
         csvwriter.writerow(row)
 
 reversion.register(Alias)
+
+
+@receiver(m2m_changed, sender=Alias.mboxes.through)
+@receiver(m2m_changed, sender=Alias.aliases.through)
+def alias_recipients_changed(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    """Keep recipient counters up to date
+
+    Only the aliases whose recipients changed are updated: ``instance``
+    when the relation is modified from the forward side, the aliases
+    pointing to ``instance`` when it is modified from the reverse side
+    (ie. ``mailbox.alias_set.remove(...)`` or
+    ``alias.alias_set.clear()``).
+    """
+    if not action in ["pre_clear", "post_add", "post_remove", "post_clear"]:
+        return
+    if not reverse:
+        if action != "pre_clear":
+            instance.update_recipients_info()
+        return
+    if action == "pre_clear":
+        if sender is Alias.mboxes.through:
+            qset = Alias.objects.filter(mboxes=instance)
+        else:
+            qset = Alias.objects.filter(aliases=instance)
+        instance._cleared_aliases = list(qset.values_list("pk", flat=True))
+        return
+    if action == "post_clear":
+        pk_set = instance.__dict__.pop("_cleared_aliases", [])
+    Alias.objects.update_recipients_info(list(pk_set))
+
+
+@receiver(pre_delete, sender=Alias)
+def alias_pre_delete(sender, instance, **kwargs):
+    """Remember the aliases pointing to a deleted alias"""
+    instance._parent_aliases = list(
+        Alias.objects.filter(aliases=instance).values_list("pk", flat=True)
+    )
+
+
+@receiver(post_delete, sender=Alias)
+def alias_post_delete(sender, instance, **kwargs):
+    Alias.objects.update_recipients_info(
+        [pk for pk in instance.__dict__.pop("_parent_aliases", [])
+         if pk != instance.pk]
+    )
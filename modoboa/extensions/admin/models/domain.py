@@ -9,6 +9,15 @@ from modoboa.extensions.admin.exceptions import AdminError
 from .base import DatesAware
 
 
+# Counters computed by ``DomainManager.with_counters`` (name, table,
+# foreign key to the domain)
+COUNTERS = [
+    ("domainalias_count", "admin_domainalias", "target_id"),
+    ("mailbox_count", "admin_mailbox", "domain_id"),
+    ("mbalias_count", "admin_alias", "domain_id"),
+]
+
+
 class DomainManager(Manager):
 
     def get_for_admin(self, admin):
@@ -21,6 +30,25 @@ class DomainManager(Manager):
             return self.get_query_set()
         return self.get_query_set().filter(owners__user=admin)
 
+    def with_counters(self, queryset=None):
+        """Add object counters to a domains queryset
+
+        Counters are computed by subqueries, within the query which
+        loads the domains (joining the three relations would multiply
+        the number of rows). ``Domain`` properties use them when they
+        are available.
+
+        :param queryset: the domains (all if None)
+        """
+        if queryset is None:
+            queryset = self.get_query_set()
+        return queryset.extra(select=dict([
+            ("%s_value" % name,
+             "SELECT COUNT(*) FROM %s WHERE %s.%s = admin_domain.id"
+             % (table, table, column))
+            for name, table, column in COUNTERS
+        ]))
+
 
 class Domain(DatesAware):
     name = models.CharField(ugettext_lazy('name'), max_length=100, unique=True,
@@ -46,14 +74,20 @@ class Domain(DatesAware):
 
     @property
     def domainalias_count(self):
+        if hasattr(self, "domainalias_count_value"):
+            return self.domainalias_count_value
         return self.domainalias_set.count()
 
     @property
     def mailbox_count(self):
+        if hasattr(self, "mailbox_count_value"):
+            return self.mailbox_count_value
         return self.mailbox_set.count()
 
     @property
     def mbalias_count(self):
+        if hasattr(self, "mbalias_count_value"):
+            return self.mbalias_count_value
         return self.alias_set.count()
 
     @property
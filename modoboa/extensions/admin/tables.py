@@ -17,10 +17,11 @@ class DomainsTable(tables.Table):
     )
     domaliases = tables.Column(
         "domainalias_set", label=ugettext_lazy("Alias(es)"), safe=True,
-        sortable=True, sort_order="domainalias__name"
+        sortable=True, sort_order="domainalias__name",
+        related=["domainalias_set"]
     )
     actions = tables.ActionColumn("actions", label=ugettext_lazy("Actions"),
-                                  defvalue=domain_actions)
+                                  defvalue=domain_actions, use_object=True)
 
     cols_order = ["name", "domaliases", "actions"]
 
@@ -29,12 +30,10 @@ class DomainsTable(tables.Table):
         self.populate(self._rows_from_model(doms))
 
     def parse_domainalias_set(self, aliases):
-        if not len(aliases.all()):
+        aliases = aliases.all()
+        if not aliases:
             return "---"
-        res = ""
-        for da in aliases.all():
-            res += "%s<br/>" % da.name
-        return res
+        return "".join(["%s<br/>" % da.name for da in aliases])
 
     def row_class(self, request, domain):
         if not domain.enabled:
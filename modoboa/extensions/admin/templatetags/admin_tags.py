@@ -111,10 +111,15 @@ def identities_menu(user):
 
 
 @register.simple_tag
-def domain_actions(user, domid):
+def domain_actions(user, domain):
+    """Render the actions available for a domain
+
+    :param domain: a ``Domain`` instance or its identifier
+    """
     from modoboa.extensions.admin.models import Domain
 
-    domain = Domain.objects.get(pk=domid)
+    if not isinstance(domain, Domain):
+        domain = Domain.objects.get(pk=domain)
     actions = [
         {"name": "listidentities",
          "url": reverse("modoboa.extensions.admin.views.identity.identities") + "#list/?searchquery=@%s" % domain.name,
@@ -124,7 +129,7 @@ def domain_actions(user, domid):
     if user.has_perm("admin.delete_domain"):
         actions.append({
             "name": "deldomain",
-            "url": reverse("modoboa.extensions.admin.views.domain.deldomain", args=[domid]),
+            "url": reverse("modoboa.extensions.admin.views.domain.deldomain", args=[domain.id]),
             "title": _("Delete %s?" % domain.name),
             "img": "icon-trash"
         })
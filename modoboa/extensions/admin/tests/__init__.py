@@ -4,9 +4,10 @@ from .account import AccountTestCase, PermissionsTestCase
 from .alias import AliasTestCase
 from .import_ import ImportTestCase
 from .export import ExportTestCase
+from .identity import IdentitiesListTestCase
 
 __all__ = [
     'DomainTestCase', 'DomainAliasTestCase', 'AccountTestCase',
     'PermissionsTestCase', 'AliasTestCase', 'ImportTestCase',
-    'ExportTestCase'
+    'ExportTestCase', 'IdentitiesListTestCase'
 ]
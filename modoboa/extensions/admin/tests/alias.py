@@ -1,8 +1,9 @@
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from modoboa.core.models import User
 from modoboa.lib.tests import ModoTestCase
 from modoboa.extensions.admin.models import (
-    Alias
+    Alias, Mailbox
 )
 from modoboa.extensions.admin import factories
 
@@ -107,3 +108,65 @@ class AliasTestCase(ModoTestCase):
         fwd = Alias.objects.get(pk=fwd.pk)
         self.assertEqual(fwd.get_recipients_count(), 2)
         self.assertEqual(fwd.aliases.count(), 0)
+
+
+class AliasCountersTestCase(ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(AliasCountersTestCase, self).setUp()
+        factories.populate_database()
+
+    def _check(self, address, count, altype):
+        alias = Alias.objects.get(address=address, domain__name="test.com")
+        self.assertEqual(alias.rcpts_count, count)
+        self.assertEqual(alias.alias_type, altype)
+
+    def test_initial_values(self):
+        self._check("forward", 1, "forward")
+        self._check("alias", 1, "alias")
+        self._check("postmaster", 2, "dlist")
+
+    def test_mailboxes_changes(self):
+        alias = Alias.objects.get(address="alias", domain__name="test.com")
+        admin = Mailbox.objects.get(address="admin", domain__name="test.com")
+        alias.mboxes.add(admin)
+        self._check("alias", 2, "dlist")
+        admin.alias_set.remove(alias)
+        self._check("alias", 1, "alias")
+        admin.alias_set.add(alias)
+        admin.alias_set.clear()
+        self._check("alias", 1, "alias")
+
+        admin.alias_set.add(alias)
+        admin.delete()
+        self._check("alias", 1, "alias")
+
+    def test_aliases_changes(self):
+        fwd = Alias.objects.get(address="forward", domain__name="test.com")
+        alias = Alias.objects.get(address="alias", domain__name="test.com")
+        fwd.aliases.add(alias)
+        self._check("forward", 2, "dlist")
+        fwd.aliases.clear()
+        self._check("forward", 1, "forward")
+
+        fwd.aliases.add(alias)
+        alias.delete()
+        self._check("forward", 1, "forward")
+
+    def test_aliases_reverse_changes(self):
+        fwd = Alias.objects.get(address="forward", domain__name="test.com")
+        alias = Alias.objects.get(address="alias", domain__name="test.com")
+        alias.alias_set.add(fwd)
+        self._check("forward", 2, "dlist")
+        self._check("alias", 1, "alias")
+        alias.alias_set.clear()
+        self._check("forward", 1, "forward")
+        self._check("alias", 1, "alias")
+
+    def test_rebuild_counters(self):
+        Alias.objects.update(rcpts_count=0, alias_type="alias")
+        call_command("update_alias_counters", batch_size=2)
+        self._check("forward", 1, "forward")
+        self._check("alias", 1, "alias")
+        self._check("postmaster", 2, "dlist")
@@ -1,8 +1,11 @@
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import simplejson
 from modoboa.core.models import User
 from modoboa.lib.tests import ModoTestCase
 from modoboa.extensions.admin.models import (
-    Domain, Alias
+    Domain, DomainAlias, Alias
 )
 from modoboa.extensions.admin import factories
 
@@ -95,3 +98,36 @@ class DomainTestCase(ModoTestCase):
         )
         with self.assertRaises(Domain.DoesNotExist):
             Domain.objects.get(pk=1)
+
+    def __count_listing_queries(self):
+        response = self.clt.get(
+            reverse("modoboa.extensions.admin.views.domain._domains")
+        )
+        self.assertEqual(response.status_code, 200)
+        # Queries are reset at the beginning of each request
+        return len(connection.queries), \
+            simplejson.loads(response.content)["table"]
+
+    @override_settings(DEBUG=True)
+    def test_listing_queries(self):
+        """The number of queries does not depend on the number of domains"""
+        self.__count_listing_queries()
+        before, table = self.__count_listing_queries()
+        for i in range(3):
+            dom = factories.DomainFactory.create(name="dom%d.com" % i)
+            DomainAlias.objects.create(name="alias%d.com" % i, target=dom,
+                                       enabled=True)
+        after, table = self.__count_listing_queries()
+        self.assertIn("alias2.com<br/>", table)
+        self.assertEqual(after, before)
+
+    def test_counters(self):
+        dom = Domain.objects.with_counters().get(name="test.com")
+        self.assertEqual(dom.mailbox_count, 2)
+        self.assertEqual(dom.mbalias_count, 3)
+        self.assertEqual(dom.domainalias_count, 0)
+        response = self.clt.get(
+            reverse("modoboa.extensions.admin.views.domain.editdomain",
+                    args=[dom.id])
+        )
+        self.assertEqual(response.status_code, 200)
@@ -1,6 +1,11 @@
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import override_settings
 from modoboa.lib.tests import ModoTestCase
+from modoboa.core.factories import UserFactory
 from modoboa.extensions.admin import factories
+from modoboa.extensions.admin.models import Domain
+from modoboa.extensions.admin.views import export
 
 
 class ExportTestCase(ModoTestCase):
@@ -15,21 +20,22 @@ class ExportTestCase(ModoTestCase):
             reverse("modoboa.extensions.admin.views.identity._identities") \
                 + "?grpfilter=%s&idtfilter=%s" % (grpfilter, idtfilter)
         )
-        return self.clt.post(
+        response = self.clt.post(
             reverse("modoboa.extensions.admin.views.export.export_identities"),
             {"filename": "test.csv"}
         )
+        return "".join(response.streaming_content)
 
     def test_export_identities(self):
         response = self.__export_identities()
-        self.assertEqual(response.content, "account;admin;{CRYPT}dTTsGDkA5ZHKg;;;True;SuperAdmins;\r\naccount;admin@test.com;{PLAIN}toto;;;True;DomainAdmins;admin@test.com;test.com\r\naccount;admin@test2.com;{PLAIN}toto;;;True;DomainAdmins;admin@test2.com;test2.com\r\naccount;user@test.com;{PLAIN}toto;;;True;SimpleUsers;user@test.com\r\naccount;user@test2.com;{PLAIN}toto;;;True;SimpleUsers;user@test2.com\r\nalias;alias@test.com;False;user@test.com\r\nforward;forward@test.com;False;user@external.com\r\ndlist;postmaster@test.com;False;toto@titi.com;test@truc.fr\r\n")
+        self.assertEqual(response, "account;admin;{CRYPT}dTTsGDkA5ZHKg;;;True;SuperAdmins;\r\naccount;admin@test.com;{PLAIN}toto;;;True;DomainAdmins;admin@test.com;test.com\r\naccount;admin@test2.com;{PLAIN}toto;;;True;DomainAdmins;admin@test2.com;test2.com\r\naccount;user@test.com;{PLAIN}toto;;;True;SimpleUsers;user@test.com\r\naccount;user@test2.com;{PLAIN}toto;;;True;SimpleUsers;user@test2.com\r\nalias;alias@test.com;False;user@test.com\r\nforward;forward@test.com;False;user@external.com\r\ndlist;postmaster@test.com;False;toto@titi.com;test@truc.fr\r\n")
 
     def test_export_simpleusers(self):
         response = self.__export_identities(
             idtfilter="account", grpfilter="SimpleUsers"
         )
         self.assertEqual(
-            response.content.strip(),
+            response.strip(),
             "account;user@test.com;{PLAIN}toto;;;True;SimpleUsers;user@test.com\r\naccount;user@test2.com;{PLAIN}toto;;;True;SimpleUsers;user@test2.com"
         )
 
@@ -38,7 +44,7 @@ class ExportTestCase(ModoTestCase):
             idtfilter="account", grpfilter="SuperAdmins"
         )
         self.assertEqual(
-            response.content.strip(),
+            response.strip(),
             "account;admin;{CRYPT}dTTsGDkA5ZHKg;;;True;SuperAdmins;"
         )
 
@@ -47,27 +53,78 @@ class ExportTestCase(ModoTestCase):
             idtfilter="account", grpfilter="DomainAdmins"
         )
         self.assertEqual(
-            response.content.strip(),
+            response.strip(),
             "account;admin@test.com;{PLAIN}toto;;;True;DomainAdmins;admin@test.com;test.com\r\naccount;admin@test2.com;{PLAIN}toto;;;True;DomainAdmins;admin@test2.com;test2.com"
         )
 
     def test_export_aliases(self):
         response = self.__export_identities(idtfilter="alias")
         self.assertEqual(
-            response.content.strip(),
+            response.strip(),
             "alias;alias@test.com;False;user@test.com"
         )
 
     def test_export_forwards(self):
         response = self.__export_identities(idtfilter="forward")
         self.assertEqual(
-            response.content.strip(),
+            response.strip(),
             "forward;forward@test.com;False;user@external.com"
         )
 
     def test_export_dlists(self):
         response = self.__export_identities(idtfilter="dlist")
         self.assertEqual(
-            response.content.strip(),
+            response.strip(),
             "dlist;postmaster@test.com;False;toto@titi.com;test@truc.fr"
         )
+
+    def test_export_domains(self):
+        response = self.clt.post(
+            reverse("modoboa.extensions.admin.views.export.export_domains"),
+            {"filename": "test.csv"}
+        )
+        self.assertEqual(
+            "".join(response.streaming_content),
+            "domain;test.com;10;True\r\ndomain;test2.com;0;True\r\n"
+        )
+
+    def __count_export_queries(self):
+        self.clt.get(
+            reverse("modoboa.extensions.admin.views.identity._identities")
+        )
+        response = self.clt.post(
+            reverse("modoboa.extensions.admin.views.export.export_identities"),
+            {"filename": "test.csv"}
+        )
+        # Queries are run while the content is generated
+        queries = len(connection.queries)
+        content = "".join(response.streaming_content)
+        return len(connection.queries) - queries, content
+
+    @override_settings(DEBUG=True)
+    def test_export_queries(self):
+        """The number of queries only depends on the number of chunks"""
+        export.CHUNK_SIZE = 3
+        try:
+            before, content = self.__count_export_queries()
+            dom = Domain.objects.get(name="test.com")
+            for i in range(3):
+                account = UserFactory.create(
+                    username="user%d@test.com" % i, groups=("SimpleUsers",)
+                )
+                factories.MailboxFactory.create(
+                    address="user%d" % i, domain=dom, user=account
+                )
+                al = factories.AliasFactory.create(
+                    address="alias%d" % i, domain=dom
+                )
+                al.mboxes.add(account.mailbox_set.all()[0])
+            after, content = self.__count_export_queries()
+        finally:
+            export.CHUNK_SIZE = 500
+        self.assertIn("account;user2@test.com;", content)
+        self.assertIn("alias;alias2@test.com;False;user2@test.com", content)
+        # One more chunk of accounts (accounts, groups) and one more
+        # chunk of aliases (aliases, aliases and mailboxes they point
+        # to, domains of those mailboxes)
+        self.assertEqual(after, before + 2 + 4)
@@ -0,0 +1,64 @@
+from modoboa.core.models import User
+from modoboa.lib.tests import ModoTestCase
+from modoboa.extensions.admin import factories
+from modoboa.extensions.admin.lib import get_identities, IdentitiesList
+from modoboa.extensions.admin.models import Alias, Domain
+
+
+class IdentitiesListTestCase(ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(IdentitiesListTestCase, self).setUp()
+        factories.populate_database()
+        self.admin = User.objects.get(username="admin")
+        dom = Domain.objects.get(name="test.com")
+        al = factories.AliasFactory.create(address="group", domain=dom)
+        al.mboxes.add(*list(dom.mailbox_set.all()))
+        al.aliases.add(Alias.objects.get(address="alias"))
+
+    def __python_sort(self, sort_order, sort_dir, **filters):
+        """Sort identities the way the listing used to"""
+        idents = get_identities(self.admin, **filters)
+        if sort_order == "tags":
+            key = lambda o: o.tags[0]
+        else:
+            key = lambda o: getattr(o, sort_order)
+        return [ident.identity for ident in
+                sorted(idents, key=key, reverse=sort_dir == "-")]
+
+    def test_sort_orders(self):
+        for sort_order in ["identity", "name_or_rcpt", "tags"]:
+            for sort_dir in ["", "-"]:
+                idents = IdentitiesList(self.admin, sort_order, sort_dir)
+                self.assertEqual(idents.count(), 9)
+                self.assertEqual(
+                    [ident.identity for ident in idents[0:9]],
+                    self.__python_sort(sort_order, sort_dir)
+                )
+
+    def test_filters(self):
+        for idtfilter in ["account", "alias", "forward", "dlist"]:
+            idents = IdentitiesList(self.admin, idtfilter=idtfilter)
+            self.assertEqual(
+                [ident.identity for ident in idents[0:idents.count()]],
+                self.__python_sort("identity", "", idtfilter=idtfilter)
+            )
+        idents = IdentitiesList(
+            self.admin, searchquery="test2", grpfilter="SimpleUsers"
+        )
+        self.assertEqual(
+            [ident.identity for ident in idents[0:10]], ["user@test2.com"]
+        )
+
+    def test_pagination(self):
+        idents = IdentitiesList(self.admin, "identity", "-")
+        expected = self.__python_sort("identity", "-")
+        self.assertEqual(
+            [ident.identity for ident in idents[3:6]], expected[3:6]
+        )
+        dlist = [ident for ident in idents[0:9]
+                 if ident.identity == "group@test.com"][0]
+        with self.assertNumQueries(0):
+            self.assertEqual(dlist.type, "dlist")
+            self.assertEqual(dlist.name_or_rcpt, "alias@test.com, ...")
@@ -117,3 +117,80 @@ account; sa@test.com; toto; Super; Admin; True; SuperAdmins; superadmin@test.com
         )
         with self.assertRaises(User.DoesNotExist):
             User.objects.get(username="sa@test.com")
+
+    def test_bulk_identities_import(self):
+        """Accounts are created by batches, aliases in between"""
+        from modoboa.extensions.admin.importer import Importer
+
+        f = ContentFile(b"""
+account; user1@test.com; {PLAIN}toto; User; One; True; SimpleUsers; user1@test.com
+account; user2@test.com; {PLAIN}toto; User; Two; False; SimpleUsers; user2@test.com
+alias; alias1@test.com; True; user2@test.com
+account; da@test.com; {PLAIN}toto; Dom; Admin; True; DomainAdmins; da@test.com; test.com
+account; user3@test.com; {PLAIN}toto; User; Three; True; SimpleUsers; user3@test.com
+""", name="identities.csv")
+        admin = User.objects.get(username="admin")
+        importer = Importer(admin, {
+            "sepchar": ";", "continue_if_exists": False,
+            "crypt_password": False
+        }, batch_size=2)
+        self.assertEqual(importer.import_file(f), 5)
+
+        u2 = User.objects.get(username="user2@test.com")
+        self.assertFalse(u2.is_active)
+        self.assertEqual(u2.group, "SimpleUsers")
+        self.assertTrue(admin.is_owner(u2))
+        mb = u2.mailbox_set.all()[0]
+        self.assertTrue(admin.is_owner(mb))
+        self.assertEqual(mb.quota, mb.domain.quota)
+        self.assertEqual(mb.quota_value.username, "user2@test.com")
+        self.assertIsNotNone(mb.creation)
+        al = Alias.objects.get(address="alias1", domain__name="test.com")
+        self.assertIn(mb, al.mboxes.all())
+
+        da = User.objects.get(username="da@test.com")
+        self.assertEqual(da.group, "DomainAdmins")
+        self.assertIn(da, Domain.objects.get(name="test.com").admins)
+        self.assertTrue(da.can_access(da))
+        # Existing domain admins get access to new mailboxes
+        u3 = User.objects.get(username="user3@test.com")
+        dadmin = User.objects.get(username="admin@test.com")
+        self.assertTrue(dadmin.can_access(u3))
+        self.assertTrue(dadmin.can_access(u3.mailbox_set.all()[0]))
+        self.assertTrue(
+            self.clt.login(username="user3@test.com", password="toto")
+        )
+
+    def test_import_validation(self):
+        """Nothing is written if a line is invalid"""
+        f = ContentFile(b"""
+account; user1@test.com; {PLAIN}toto; User; One; True; SimpleUsers; user1@test.com
+account; user2@test.com; {PLAIN}toto; User; Two; True; SimpleUsers; user2@unknown.com
+alias; alias1@test.com; True; user4@test.com
+""", name="identities.csv")
+        response = self.clt.post(
+            reverse("modoboa.extensions.admin.views.import.import_identities"),
+            {"sourcefile": f}
+        )
+        self.assertIn("Line 3", response.content)
+        self.assertIn("Line 4", response.content)
+        self.assertFalse(
+            User.objects.filter(username="user1@test.com").exists()
+        )
+
+    def test_bulk_import_duplicates(self):
+        f = ContentFile(b"""
+account; user@test.com; {PLAIN}toto; User; ; True; SimpleUsers; user@test.com
+account; user1@test.com; {PLAIN}toto; User; One; True; SimpleUsers; user1@test.com
+""", name="identities.csv")
+        url = reverse("modoboa.extensions.admin.views.import.import_identities")
+        response = self.clt.post(url, {"sourcefile": f})
+        self.assertIn("already exists", response.content)
+        self.assertFalse(
+            User.objects.filter(username="user1@test.com").exists()
+        )
+        f.seek(0)
+        self.clt.post(url, {"sourcefile": f, "continue_if_exists": True})
+        self.assertTrue(
+            User.objects.filter(username="user1@test.com").exists()
+        )
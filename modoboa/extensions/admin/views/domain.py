@@ -129,12 +129,15 @@ def newdomain(request, tplname="common/wizard_forms.html"):
 @permission_required("admin.view_domains")
 @transaction.commit_on_success
 def editdomain(request, dom_id, tplname="admin/editdomainform.html"):
-    domain = Domain.objects.get(pk=dom_id)
+    domain = Domain.objects.with_counters().get(pk=dom_id)
     if not request.user.can_access(domain):
         raise PermDeniedException
 
-    domadmins = [u for u in domain.admins
-                 if request.user.can_access(u) and not u.is_superuser]
+    admins = domain.admins
+    domadmins = [
+        u for u, access in zip(admins, request.user.can_access_many(admins))
+        if access and not u.is_superuser
+    ]
     if not request.user.is_superuser:
         domadmins = [u for u in domadmins if u.group == "DomainAdmins"]
 
@@ -1,34 +1,94 @@
 import csv
 import cStringIO
+from itertools import chain
 from rfc6266 import build_header
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import (
     login_required, permission_required, user_passes_test
 )
-from modoboa.extensions.admin.lib import get_identities
+from modoboa.lib.dbutils import queryset_chunks
+from modoboa.extensions.admin.lib import get_identities_querysets
 from modoboa.extensions.admin.models import Domain
 from modoboa.extensions.admin.forms import (
     ExportIdentitiesForm, ExportDomainsForm
 )
 
 
+# Number of objects read per query
+CHUNK_SIZE = 500
+
+
 def _export(content, filename):
     """Export a csv file's content
 
-    :param content: the content to export (string)
+    :param content: the content to export (an iterator of strings)
     :param filename: the name that will appear into the response
-    :return: an ``HttpResponse`` object
+    :return: a ``StreamingHttpResponse`` object
     """
-    resp = HttpResponse(content)
-    resp["Content-Type"] = "text/csv"
-    resp["Content-Length"] = len(content)
+    resp = StreamingHttpResponse(content, content_type="text/csv")
     resp["Content-Disposition"] = build_header(filename)
     return resp
 
 
+def _csv_lines(chunks, sepchar):
+    """Write objects to CSV, chunk by chunk
+
+    :param chunks: an iterator of lists of objects (with a ``to_csv``
+                   method)
+    :param sepchar: the separator character
+    :return: a generator of strings (one per chunk)
+    """
+    for objects in chunks:
+        fp = cStringIO.StringIO()
+        csvwriter = csv.writer(fp, delimiter=sepchar)
+        for obj in objects:
+            obj.to_csv(csvwriter)
+        yield fp.getvalue()
+        fp.close()
+
+
+def _account_chunks(accounts):
+    """Read accounts by chunks, with their groups and domains"""
+    for chunk in queryset_chunks(
+            accounts.prefetch_related("groups"), ["username"], CHUNK_SIZE
+    ):
+        # Domains of the domain administrators (see the
+        # ``AccountExported`` event), in one query
+        admins = dict([
+            (account.id, account) for account in chunk
+            if account.group == "DomainAdmins"
+        ])
+        for account in admins.values():
+            account.administered_domains = []
+        if admins:
+            for user_id, name in Domain.objects.filter(
+                    owners__user__in=admins.keys()
+            ).values_list("owners__user", "name").order_by("name"):
+                admins[user_id].administered_domains.append(name)
+        yield chunk
+
+
+def _alias_chunks(aliases):
+    """Read aliases by chunks, with their recipients"""
+    aliases = aliases.select_related("domain").prefetch_related(
+        "aliases__domain", "mboxes__domain"
+    )
+    return queryset_chunks(aliases, ["domain__name", "address"], CHUNK_SIZE)
+
+
+def _domain_chunks(domains):
+    """Read domains by chunks, followed by their aliases"""
+    domains = domains.prefetch_related("domainalias_set__target")
+    for chunk in queryset_chunks(domains, ["name"], CHUNK_SIZE):
+        objects = []
+        for dom in chunk:
+            objects += [dom] + list(dom.domainalias_set.all())
+        yield objects
+
+
 @login_required
 @user_passes_test(
     lambda u: u.has_perm("core.add_user") or u.has_perm("admin.add_alias")
@@ -45,13 +105,17 @@ def export_identities(request):
     if request.method == "POST":
         form = ExportIdentitiesForm(request.POST)
         form.is_valid()
-        fp = cStringIO.StringIO()
-        csvwriter = csv.writer(fp, delimiter=form.cleaned_data["sepchar"])
-        for ident in get_identities(request.user, **request.session['identities_filters']):
-            ident.to_csv(csvwriter)
-        content = fp.getvalue()
-        fp.close()
-        return _export(content, form.cleaned_data["filename"])
+        filters = request.session['identities_filters']
+        accounts, aliases = get_identities_querysets(request.user, **filters)
+        chunks = []
+        if accounts is not None:
+            chunks = _account_chunks(accounts)
+        if aliases is not None:
+            chunks = chain(chunks, _alias_chunks(aliases))
+        return _export(
+            _csv_lines(chunks, form.cleaned_data["sepchar"]),
+            form.cleaned_data["filename"]
+        )
 
     ctx["form"] = ExportIdentitiesForm()
     return render(request, "common/generic_modal_form.html", ctx)
@@ -71,15 +135,11 @@ def export_domains(request):
     if request.method == "POST":
         form = ExportDomainsForm(request.POST)
         form.is_valid()
-        fp = cStringIO.StringIO()
-        csvwriter = csv.writer(fp, delimiter=form.cleaned_data["sepchar"])
-        for dom in Domain.objects.get_for_admin(request.user):
-            dom.to_csv(csvwriter)
-            for da in dom.domainalias_set.all():
-                da.to_csv(csvwriter)
-        content = fp.getvalue()
-        fp.close()
-        return _export(content, form.cleaned_data["filename"])
+        chunks = _domain_chunks(Domain.objects.get_for_admin(request.user))
+        return _export(
+            _csv_lines(chunks, form.cleaned_data["sepchar"]),
+            form.cleaned_data["filename"]
+        )
 
     ctx["form"] = ExportDomainsForm()
     return render(request, "common/generic_modal_form.html", ctx)
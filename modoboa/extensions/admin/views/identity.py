@@ -16,7 +16,7 @@ from modoboa.lib.templatetags.lib_tags import pagination_bar
 from modoboa.core.models import User
 from modoboa.extensions.admin.models import Mailbox, Domain
 from modoboa.extensions.admin.lib import (
-    get_sort_order, get_listing_page, get_identities
+    get_sort_order, get_listing_page, IdentitiesList
 )
 from modoboa.extensions.admin.exceptions import AdminError
 from modoboa.extensions.admin.forms import (
@@ -32,15 +32,9 @@ def _identities(request):
     filters = dict((fname, request.GET.get(fname, None))
                    for fname in ['searchquery', 'idtfilter', 'grpfilter'])
     request.session['identities_filters'] = filters
-    idents_list = get_identities(request.user, **filters)
     sort_order, sort_dir = get_sort_order(request.GET, "identity",
                                           ["identity", "name_or_rcpt", "tags"])
-    if sort_order in ["identity", "name_or_rcpt"]:
-        objects = sorted(idents_list, key=lambda o: getattr(o, sort_order),
-                         reverse=sort_dir == '-')
-    else:
-        objects = sorted(idents_list, key=lambda o: o.tags[0],
-                         reverse=sort_dir == '-')
+    objects = IdentitiesList(request.user, sort_order, sort_dir, **filters)
     page = get_listing_page(objects, request.GET.get("page", 1))
     return ajax_simple_response({
         "table": _render_to_string(request, "admin/identities_table.html", {
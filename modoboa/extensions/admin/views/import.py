@@ -2,35 +2,17 @@ import csv
 from django.utils.translation import ugettext as _
 from django.shortcuts import render
 from django.core.urlresolvers import reverse
-from django.db import transaction, IntegrityError
+from django.db import IntegrityError
 from django.contrib.auth.decorators import (
     login_required, permission_required, user_passes_test
 )
 from modoboa.lib.exceptions import ModoboaException
-from modoboa.core.models import User
-from modoboa.extensions.admin.models import (
-    Domain, DomainAlias, Alias
-)
 from modoboa.extensions.admin.forms import ImportIdentitiesForm, ImportDataForm
-
-
-@transaction.commit_on_success
-def import_domain(user, row, formopts):
-    """Specific code for domains import"""
-    dom = Domain()
-    dom.from_csv(user, row)
-
-
-@transaction.commit_on_success
-def import_domainalias(user, row, formopts):
-    """Specific code for domain aliases import"""
-    domalias = DomainAlias()
-    domalias.from_csv(user, row)
+from modoboa.extensions.admin.importer import Importer
 
 
 @login_required
 @permission_required("admin.add_domain")
-@transaction.commit_on_success
 def import_domains(request):
     if request.method == "POST":
         return importdata(request)
@@ -58,37 +40,12 @@ def import_domains(request):
     return render(request, "admin/importform.html", ctx)
 
 
-@transaction.commit_on_success
-def import_account(user, row, formopts):
-    """Specific code for accounts import"""
-    account = User()
-    account.from_csv(user, row, formopts["crypt_password"])
-
-
-@transaction.commit_on_success
-def _import_alias(user, row, **kwargs):
-    """Specific code for aliases import"""
-    alias = Alias()
-    alias.from_csv(user, row, **kwargs)
-
-
-def import_alias(user, row, formopts):
-    _import_alias(user, row, expected_elements=4)
-
-
-def import_forward(user, row, formopts):
-    _import_alias(user, row, expected_elements=4)
-
-
-def import_dlist(user, row, formopts):
-    _import_alias(user, row)
-
-
 def importdata(request, formclass=ImportDataForm):
     """Generic import function
 
     As the process of importing data from a CSV file is the same
-    whatever the type, we do a maximum of the work here.
+    whatever the type, we do a maximum of the work here. The file is
+    validated before anything is written (see ``Importer``).
 
     :param request: a ``Request`` instance
     :param typ: a string indicating the object type being imported
@@ -97,35 +54,23 @@ def importdata(request, formclass=ImportDataForm):
     error = None
     form = formclass(request.POST, request.FILES)
     if form.is_valid():
+        importer = Importer(request.user, form.cleaned_data)
         try:
-            reader = csv.reader(request.FILES['sourcefile'],
-                                delimiter=form.cleaned_data['sepchar'])
+            cpt = importer.import_file(request.FILES['sourcefile'])
         except csv.Error, e:
             error = str(e)
-
+        except IntegrityError, e:
+            error = _("Object already exists: %s" % str(e))
+        except ModoboaException, e:
+            error = str(e)
+        if error is not None and importer.count:
+            # Previous batches are committed
+            error += " " + _("(%d objects imported)" % importer.count)
         if error is None:
-            try:
-                cpt = 0
-                for row in reader:
-                    if not row:
-                        continue
-                    try:
-                        fct = globals()["import_%s" % row[0].strip()]
-                    except KeyError:
-                        continue
-                    try:
-                        fct(request.user, row, form.cleaned_data)
-                    except IntegrityError, e:
-                        if form.cleaned_data["continue_if_exists"]:
-                            continue
-                        raise ModoboaException(_("Object already exists: %s" % row))
-                    cpt += 1
-                msg = _("%d objects imported successfully" % cpt)
-                return render(request, "admin/import_done.html", {
-                    "status": "ok", "msg": msg
-                })
-            except (ModoboaException), e:
-                error = str(e)
+            msg = _("%d objects imported successfully" % cpt)
+            return render(request, "admin/import_done.html", {
+                "status": "ok", "msg": msg
+            })
 
     return render(request, "admin/import_done.html", {
         "status": "ko", "msg": error
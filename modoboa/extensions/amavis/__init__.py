@@ -132,12 +132,12 @@ $(document).ready(function() {
 
 @events.observe("TopNotifications")
 def display_requests(user):
-    from .sql_listing import get_wrapper
+    from .lib import get_pending_requests
 
     if parameters.get_admin("USER_CAN_RELEASE") == "yes" \
             or user.group == "SimpleUsers":
         return []
-    nbrequests = get_wrapper().get_pending_requests(user)
+    nbrequests = get_pending_requests(user)[1]
 
     url = reverse("modoboa.extensions.amavis.views.index")
     url += "#listing/?viewrequests=1"
@@ -16,6 +16,14 @@ class ParametersForm(AdminParametersForm):
         help_text=_("Quarantine messages maximum age (in days) before deletion")
     )
 
+    search_index = forms.CharField(
+        label=_("Search index"),
+        initial="",
+        required=False,
+        help_text=_("Path to the quarantine search index (built by the "
+                    "amsearchindex command). Leave empty to disable it")
+    )
+
     sep1 = SeparatorField(label=_("Messages releasing"))
                           
     released_msgs_cleanup = YesNoField(
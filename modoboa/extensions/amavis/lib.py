@@ -1,9 +1,12 @@
 # coding: utf-8
 import socket
 import re
-import struct
-import string
+import threading
+import time
+import urllib
+from email.parser import FeedParser
 from functools import wraps
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from modoboa.lib import parameters
@@ -36,43 +39,227 @@ def selfservice(ssfunc=None):
     return decorator
 
 
+def _pending_requests_version():
+    """Return the current version of the pending requests counters
+
+    Cached counters are never deleted one by one: changing the version
+    invalidates all of them.
+    """
+    version = cache.get("amavis.pending.version")
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add("amavis.pending.version", version, 86400)
+        version = cache.get("amavis.pending.version", version)
+    return version
+
+
+def get_pending_requests(user):
+    """Return the number of pending release requests of an administrator
+
+    The result is cached during CHECK_REQUESTS_INTERVAL seconds (the
+    poller's frequency) so many administrators checking their
+    requests don't mean many queries against the amavis database.
+
+    :param user: a ``User`` instance
+    :return: a tuple (counter version, number of requests)
+    """
+    from .sql_listing import get_wrapper
+
+    version = _pending_requests_version()
+    key = "amavis.pending.%s.%s" % (version, user.id)
+    count = cache.get(key)
+    if count is None:
+        count = get_wrapper().get_pending_requests(user)
+        cache.set(
+            key, count,
+            int(parameters.get_admin("CHECK_REQUESTS_INTERVAL", app="amavis"))
+        )
+    return version, count
+
+
+def invalidate_pending_requests():
+    """Invalidate the cached pending requests counters
+
+    Must be called each time the status of a message changes
+    (release, delete, release request).
+    """
+    try:
+        cache.incr("amavis.pending.version")
+    except ValueError:
+        cache.set("amavis.pending.version", int(time.time() * 1000), 86400)
+
+
+def get_quarantined_message(mail_id, headers_only=False, max_size=None):
+    """Parse a quarantined message
+
+    Chunks are read one after the other and fed to an incremental
+    parser, so the message is never stored twice in memory.
+
+    :param mail_id: the message's identifier
+    :param headers_only: stop reading after the header block
+    :param max_size: stop reading after this number of bytes
+    :return: an ``email.message.Message`` instance, with a
+             ``truncated`` attribute
+    """
+    from .sql_listing import get_wrapper
+
+    parser = FeedParser()
+    size = 0
+    tail = ""
+    truncated = False
+    for chunk in get_wrapper().iter_mail_chunks(mail_id):
+        if headers_only:
+            # The separator can be split between two chunks
+            data = tail + chunk
+            m = re.search(r"\r?\n\r?\n", data)
+            if m is not None:
+                parser.feed(chunk[:max(m.end() - len(tail), 0)])
+                break
+            tail = data[-3:]
+        elif max_size is not None and size + len(chunk) > max_size:
+            parser.feed(chunk[:max_size - size])
+            truncated = True
+            break
+        parser.feed(chunk)
+        size += len(chunk)
+    msg = parser.close()
+    msg.truncated = truncated
+    return msg
+
+
 class AMrelease(object):
+    """Client for amavis' policy delegation protocol (AM.PDP)
+
+    The connection is kept open between requests (one per thread) so
+    consecutive releases don't pay for a new connection each
+    time. Requests are pipelined: they are all sent before reading
+    the answers, which come back in the same order.
+    """
+    _local = threading.local()
+
     def __init__(self):
-        mode = parameters.get_admin("AM_PDP_MODE")
+        self.sock = self._get_socket()
+
+    def _get_address(self):
+        if parameters.get_admin("AM_PDP_MODE") == "inet":
+            return (socket.AF_INET, (parameters.get_admin('AM_PDP_HOST'),
+                                     int(parameters.get_admin('AM_PDP_PORT'))))
+        return (socket.AF_UNIX, parameters.get_admin('AM_PDP_SOCKET'))
+
+    def _get_socket(self, reconnect=False):
+        address = self._get_address()
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            if not reconnect and self._local.address == address:
+                return sock
+            self.close()
+        sock = socket.socket(address[0], socket.SOCK_STREAM)
         try:
-            if mode == "inet":
-                host = parameters.get_admin('AM_PDP_HOST')
-                port = parameters.get_admin('AM_PDP_PORT')
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((host, int(port)))
-            else:
-                path = parameters.get_admin('AM_PDP_SOCKET')
-                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                self.sock.connect(path)
+            sock.connect(address[1])
         except socket.error, err:
+            sock.close()
             raise ModoboaException(
                 _("Connection to amavis failed: %s" % str(err))
             )
+        self._local.sock = sock
+        self._local.address = address
+        return sock
+
+    @classmethod
+    def close(cls):
+        """Close the connection opened by the current thread."""
+        sock = getattr(cls._local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        cls._local.sock = None
 
     def decode(self, answer):
-        def repl(match):
-            return struct.pack("B", string.atoi(match.group(0)[1:], 16))
+        return urllib.unquote(answer)
 
-        return re.sub(r"%([0-9a-fA-F]{2})", repl, answer)
+    def format_request(self, mailid, secretid, recipient):
+        attributes = [("request", "release"), ("mail_id", mailid),
+                      ("secret_id", secretid), ("quar_type", "Q"),
+                      ("recipient", recipient)]
+        return "".join(
+            ["%s=%s\n" % (name, urllib.quote(str(value), "@<>+"))
+             for name, value in attributes]
+        ) + "\n"
 
-    def __del__(self):
-        self.sock.close()
+    def read_answer(self, stream):
+        """Read one answer (terminated by an empty line)
 
-    def sendreq(self, mailid, secretid, recipient, *others):
-        self.sock.send("""request=release
-mail_id=%s
-secret_id=%s
-quar_type=Q
-recipient=%s
-
-""" % (mailid, secretid, recipient))
-        answer = self.sock.recv(1024)
-        answer = self.decode(answer)
-        if re.search("250 [\d\.]+ Ok", answer):
-            return True
+        :param stream: a file-like object bound to the socket
+        :return: a list of (name, value) tuples, None if the
+                 connection was closed
+        """
+        attributes = []
+        while True:
+            line = stream.readline()
+            if line == "":
+                return None
+            line = line.rstrip("\r\n")
+            if line == "":
+                break
+            name, sep, value = line.partition("=")
+            attributes.append((name, self.decode(value)))
+        return attributes
+
+    def is_success(self, answer):
+        for name, value in answer:
+            if name == "setreply" and re.match(r"250 [\d\.]+ Ok", value):
+                return True
         return False
+
+    def sendreq(self, mailid, secretid, recipient, *others):
+        return self.sendreqs([(mailid, secretid, recipient)])[0]
+
+    def _exchange(self, requests):
+        self.sock.sendall("".join(
+            [self.format_request(*req) for req in requests]
+        ))
+        stream = self.sock.makefile("rb")
+        try:
+            answers = []
+            for req in requests:
+                answer = self.read_answer(stream)
+                if answer is None:
+                    if answers:
+                        # Some requests have been processed: retrying
+                        # would release them twice
+                        raise ModoboaException(
+                            _("Connection to amavis lost")
+                        )
+                    raise socket.error("connection closed by amavis")
+                answers.append(answer)
+            return answers
+        finally:
+            stream.close()
+
+    def sendreqs(self, requests):
+        """Send several release requests at once
+
+        All requests are written before the first answer is read, so
+        releasing N messages doesn't cost N round trips.
+
+        :param requests: a list of (mail_id, secret_id, recipient) tuples
+        :return: a list of booleans (one per request)
+        """
+        if not requests:
+            return []
+        try:
+            answers = self._exchange(requests)
+        except socket.error:
+            # amavis may have closed an idle connection: retry once
+            # with a new one
+            self.sock = self._get_socket(reconnect=True)
+            try:
+                answers = self._exchange(requests)
+            except socket.error, err:
+                self.close()
+                raise ModoboaException(
+                    _("Connection to amavis failed: %s" % str(err))
+                )
+        return [self.is_success(answer) for answer in answers]
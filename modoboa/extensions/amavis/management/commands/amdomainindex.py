@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Prepare the amavis database for domain filtering.
+
+Quarantine listings filter recipients on ``maddr.domain`` (see
+``sql_listing.reverse_domain_names``). This command:
+
+* fills this column for addresses created without it,
+* creates an index on it (amavis doesn't create one by default),
+* optionally compares the old regular expression filter with the
+  new one (``--benchmark``) on the current database.
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction, DatabaseError
+from modoboa.lib.dbutils import db_type
+from modoboa.extensions.admin.models import Domain
+from modoboa.extensions.amavis.models import Maddr, Msgrcpt
+from modoboa.extensions.amavis.sql_listing import reverse_domain_names
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Backfill and index the domain column of amavis addresses'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type="int", default=1000,
+                    help='Number of addresses updated per transaction'),
+        make_option('--no-index', action='store_true', default=False,
+                    help='Do not create the index'),
+        make_option('--benchmark', action='store_true', default=False,
+                    help='Compare regexp and domain filters')
+    )
+
+    def backfill(self, batch_size):
+        """Fill ``maddr.domain`` when it is empty."""
+        total = 0
+        last_id = None
+        while True:
+            qset = Maddr.objects.filter(domain="").order_by("id")
+            if last_id is not None:
+                qset = qset.filter(id__gt=last_id)
+            rows = list(qset.values_list("id", "email")[:batch_size])
+            if not rows:
+                break
+            bydomain = {}
+            for pk, email in rows:
+                name = str(email).rsplit("@", 1)[-1].strip("[]").lower()
+                bydomain.setdefault(
+                    ".".join(reversed(name.split("."))), []
+                ).append(pk)
+            with transaction.commit_on_success(using="amavis"):
+                for domain, ids in bydomain.iteritems():
+                    Maddr.objects.filter(id__in=ids).update(domain=domain)
+            total += len(rows)
+            last_id = rows[-1][0]
+        return total
+
+    def create_index(self):
+        """Create the index on ``maddr.domain`` (if missing)."""
+        cursor = connections["amavis"].cursor()
+        sql = "CREATE INDEX maddr_idx_domain ON maddr (domain)"
+        if db_type("amavis") == "mysql":
+            # Only a prefix is indexed (column length is 765 bytes)
+            sql = "CREATE INDEX maddr_idx_domain ON maddr (domain(100))"
+        try:
+            with transaction.commit_on_success(using="amavis"):
+                cursor.execute(sql)
+        except DatabaseError:
+            return False
+        return True
+
+    def benchmark(self):
+        domains = list(Domain.objects.all())
+        if not domains:
+            print "No domain defined, nothing to compare"
+            return
+        regexp = "(%s)" % '|'.join([dom.name for dom in domains])
+        if db_type("amavis") == "postgres":
+            old = Msgrcpt.objects.filter(rs='p').extra(
+                where=["msgrcpt.rid=maddr.id",
+                       "convert_from(maddr.email, 'UTF8') ~ %s"],
+                params=[regexp], tables=['maddr']
+            )
+        else:
+            old = Msgrcpt.objects.filter(rs='p', rid__email__regex=regexp)
+        new = Msgrcpt.objects.filter(
+            rs='p', rid__domain__in=reverse_domain_names(domains)
+        )
+        for label, qset in [("regexp", old), ("domain", new)]:
+            start = time.time()
+            count = qset.count()
+            print "%s filter (%d domains): %d rows in %.3fs" \
+                % (label, len(domains), count, time.time() - start)
+
+    def handle(self, *args, **options):
+        start = time.time()
+        print "%d address(es) updated in %.2fs" \
+            % (self.backfill(options["batch_size"]), time.time() - start)
+        if not options["no_index"]:
+            if self.create_index():
+                print "Index maddr_idx_domain created"
+            else:
+                print "Index maddr_idx_domain not created (already exists?)"
+        if options["benchmark"]:
+            self.benchmark()
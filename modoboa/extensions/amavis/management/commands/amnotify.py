@@ -1,5 +1,10 @@
 #!/usr/bin/env python
 # coding: utf-8
+import fcntl
+import os
+import smtplib
+import socket
+import tempfile
 from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
 from django.template.loader import render_to_string
@@ -8,11 +13,9 @@ from django.utils.translation import ugettext as _
 from modoboa.core.models import User
 from modoboa.lib import parameters
 from modoboa.lib.emailutils import sendmail_simple
-from modoboa.extensions.admin.models import Domain
+from modoboa.extensions.admin.models import Domain, Mailbox
 from modoboa.extensions.amavis import Amavis
-from modoboa.extensions.amavis.models import (
-    Msgrcpt
-)
+from modoboa.extensions.amavis.models import Msgrcpt
 from modoboa.extensions.amavis.sql_listing import get_wrapper
 
 
@@ -30,6 +33,14 @@ class Command(BaseCommand):
                     help="The address of the SMTP server used to send notifications"),
         make_option("--smtp_port", type="int", default=25,
                     help="The listening port of the SMTP server used to send notifications"),
+        make_option("--max-per-connection", type="int", default=100,
+                    help="Maximum number of notifications sent using the same SMTP connection"),
+        make_option("--dry-run", action="store_true", default=False,
+                    help="Display the notifications that would be sent and exit"),
+        make_option("--lock-file", type="string",
+                    default=os.path.join(tempfile.gettempdir(),
+                                         "modoboa-amnotify.lock"),
+                    help="Lock file preventing concurrent executions"),
         make_option("--verbose", action="store_true",
                     help="Activate verbose mode")
     )
@@ -38,29 +49,120 @@ class Command(BaseCommand):
         if options["baseurl"] is None:
             raise CommandError("You must provide the --baseurl option")
         self.options = options
+        self.connection = None
+        self.sent = 0
         Amavis().load()
-        self.notify_admins_pending_requests()
+        with open(options["lock_file"], "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                raise CommandError("amnotify is already running")
+            try:
+                self.notify_admins_pending_requests()
+            finally:
+                self.close_connection()
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
-    def send_pr_notification(self, rcpt, reqs):
-        if self.options["verbose"]:
-            print "Sending notification to %s" % rcpt
-        total = reqs.count()
-        reqs = reqs.all()[:10]
+    def get_connection(self):
+        """Return the SMTP connection, (re)open it if needed
+
+        The same connection is used for several notifications. It is
+        renewed after --max-per-connection messages (MTAs often limit
+        the number of messages accepted per session).
+        """
+        if self.connection is not None \
+                and self.sent >= self.options["max_per_connection"]:
+            self.close_connection()
+        if self.connection is None:
+            self.connection = smtplib.SMTP(
+                self.options["smtp_host"], self.options["smtp_port"]
+            )
+            self.sent = 0
+        return self.connection
+
+    def close_connection(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            self.connection.close()
+        self.connection = None
+
+    def get_sketch(self, domains=None):
+        """Return the first pending requests of the given domains
+
+        Samples are fetched once per domain and shared between its
+        administrators. Super administrators share a single sample
+        (all domains).
+
+        :param domains: a list of domain names (None means all)
+        """
+        if domains is None:
+            if self.global_sketch is None:
+                self.global_sketch = list(
+                    Msgrcpt.objects.filter(rs='p')
+                    .select_related("mail", "mail__sid", "rid")
+                    .order_by("-mail__time_num")[:10]
+                )
+            return self.global_sketch
+        reqs = []
+        for domain in domains:
+            if not domain in self.sketches:
+                self.sketches[domain] = list(
+                    get_wrapper().get_domains_pending_requests(
+                        [Domain(name=domain)]
+                    ).select_related("mail", "mail__sid", "rid")
+                    .order_by("-mail__time_num")[:10]
+                )
+            reqs += self.sketches[domain]
+        return sorted(
+            reqs, key=lambda r: r.mail.time_num, reverse=True
+        )[:10]
+
+    def sendmail(self, rcpt, content):
+        """Send a notification using the current SMTP session
+
+        If the session was closed by the server, the message is sent
+        again (once) using a new one.
+
+        :return: True on success
+        """
+        for attempt in range(2):
+            try:
+                connection = self.get_connection()
+                status, msg = sendmail_simple(
+                    self.sender, rcpt,
+                    subject=_("[modoboa] Pending release requests"),
+                    content=content, connection=connection
+                )
+            except (smtplib.SMTPException, socket.error), e:
+                status, msg = False, "SMTP error: %s" % str(e)
+                dropped = True
+            else:
+                dropped = connection.sock is None
+            if status:
+                self.sent += 1
+                return True
+            if not dropped:
+                break
+            # A new connection will be opened
+            self.close_connection()
+        print msg
+        return False
+
+    def send_pr_notification(self, rcpt, total, domains=None):
+        if self.options["verbose"] or self.options["dry_run"]:
+            print "Sending notification to %s (%d request(s))" % (rcpt, total)
+        if self.options["dry_run"]:
+            return
         content = render_to_string(
             "amavis/notifications/pending_requests.html", dict(
-                total=total, requests=reqs,
+                total=total, requests=self.get_sketch(domains),
                 baseurl=self.baseurl, listingurl=self.listingurl
             )
         )
-        status, msg = sendmail_simple(
-            self.sender, rcpt,
-            subject=_("[modoboa] Pending release requests"),
-            content=content,
-            server=self.options["smtp_host"],
-            port=self.options["smtp_port"]
-        )
-        if not status:
-            print msg
+        self.sendmail(rcpt, content)
 
     def notify_admins_pending_requests(self):
         self.sender = parameters.get_admin("NOTIFICATIONS_SENDER",
@@ -69,24 +171,49 @@ class Command(BaseCommand):
         self.listingurl = self.baseurl \
             + reverse("modoboa.extensions.amavis.views._listing") \
             + "?viewrequests=1"
+        self.sketches = {}
+        self.global_sketch = None
+
+        counters = get_wrapper().count_pending_requests_by_domain()
+        if not counters:
+            if self.options["verbose"] or self.options["dry_run"]:
+                print "No release request currently pending"
+            return
 
-        for da in User.objects.filter(groups__name="DomainAdmins"):
-            if not da.mailbox_set.count():
+        # Domain administrators: (admin, domain) couples are read in
+        # one query, only for domains with pending requests
+        admins = {}
+        for user_id, name in Domain.objects.filter(
+                owners__user__groups__name="DomainAdmins"
+        ).values_list("owners__user", "name"):
+            if name.lower() in counters:
+                admins.setdefault(user_id, []).append(name.lower())
+        superadmins = list(
+            User.objects.filter(is_superuser=True).values_list("id", flat=True)
+        )
+        addresses = {}
+        for mb in Mailbox.objects.filter(
+                user__in=admins.keys() + superadmins
+        ).select_related("domain").order_by("id"):
+            addresses.setdefault(mb.user_id, mb.full_address)
+
+        notifications = 0
+        for user_id, domains in admins.iteritems():
+            if not user_id in addresses:
                 continue
-            rcpt = da.mailbox_set.all()[0].full_address
-            reqs = get_wrapper().get_domains_pending_requests(
-                Domain.objects.get_for_admin(da)
+            self.send_pr_notification(
+                addresses[user_id], sum([counters[d] for d in domains]),
+                domains
             )
-            if reqs.count():
-                self.send_pr_notification(rcpt, reqs)
+            notifications += 1
 
-        reqs = Msgrcpt.objects.filter(rs='p')
-        if not reqs.count():
-            if self.options["verbose"]:
-                print "No release request currently pending"
-            return
-        for su in User.objects.filter(is_superuser=True):
-            if not su.mailbox_set.count():
+        total = sum(counters.values())
+        for user_id in superadmins:
+            if not user_id in addresses:
                 continue
-            rcpt = su.mailbox_set.all()[0].full_address
-            self.send_pr_notification(rcpt, reqs)
+            self.send_pr_notification(addresses[user_id], total)
+            notifications += 1
+
+        if self.options["verbose"] or self.options["dry_run"]:
+            print "%d notification(s), %d pending request(s) in %d domain(s)" \
+                % (notifications, total, len(counters))
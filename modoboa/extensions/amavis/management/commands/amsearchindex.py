@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Build (or update) the quarantine search index.
+
+The index location is defined by the ``SEARCH_INDEX`` parameter. Run
+this command periodically (every few minutes) to index new messages.
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from modoboa.lib import parameters
+from modoboa.extensions.amavis import Amavis
+from modoboa.extensions.amavis.search import SearchIndex
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Update the quarantine search index'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type="int", default=1000,
+                    help='Number of messages indexed per transaction'),
+        make_option('--verbose', action='store_true', default=False,
+                    help='Display informational messages')
+    )
+
+    def handle(self, *args, **options):
+        Amavis().load()
+        path = parameters.get_admin("SEARCH_INDEX", app="amavis")
+        if not path:
+            raise CommandError("The SEARCH_INDEX parameter is not defined")
+        index = SearchIndex(path)
+        index.create()
+
+        start = time.time()
+        count = index.update(options["batch_size"])
+        limit = int(time.time()) - \
+            int(parameters.get_admin("MAX_MESSAGES_AGE", app="amavis")) \
+            * 24 * 3600
+        pruned = index.prune(limit)
+        if options["verbose"]:
+            print "%d message(s) indexed, %d removed in %.2fs" \
+                % (count, pruned, time.time() - start)
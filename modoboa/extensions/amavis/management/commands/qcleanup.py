@@ -4,11 +4,9 @@
 import time
 from optparse import make_option
 from django.core.management.base import BaseCommand
+from django.db import connections, transaction
 from modoboa.lib import parameters
 from modoboa.extensions.amavis import Amavis
-from modoboa.extensions.amavis.models import (
-    Msgrcpt, Msgs, Maddr
-)
 
 
 class Command(BaseCommand):
@@ -23,7 +21,11 @@ class Command(BaseCommand):
         make_option('--verbose',
                     action='store_true',
                     default=False,
-                    help='Display informational messages')
+                    help='Display informational messages'),
+        make_option('--batch-size',
+                    type="int",
+                    default=10000,
+                    help='Number of messages deleted per transaction')
     )
 
     def __vprint(self, msg):
@@ -31,6 +33,63 @@ class Command(BaseCommand):
             return
         print msg
 
+    def delete_messages(self, sql, params, keyset=False):
+        """Delete messages by batches
+
+        Each batch is deleted inside its own transaction so locks are
+        held during a short time.
+
+        :param sql: a query returning the identifiers of the messages
+                    to delete (without ORDER BY and LIMIT clauses)
+        :param params: the query's parameters
+        :param keyset: if True, resume the scan after the last
+                       identifier of the previous batch
+        :return: the number of deleted messages
+        """
+        cursor = connections["amavis"].cursor()
+        total = 0
+        last = None
+        start = time.time()
+        while True:
+            query, qparams = sql, list(params)
+            if keyset and last is not None:
+                query += " AND m.mail_id > %s"
+                qparams.append(last)
+            cursor.execute(
+                "%s ORDER BY m.mail_id LIMIT %d" % (query, self.batch_size),
+                qparams
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            placeholders = ", ".join(["%s"] * len(ids))
+            with transaction.commit_on_success(using="amavis"):
+                for table in ["msgrcpt", "quarantine", "msgs"]:
+                    cursor.execute(
+                        "DELETE FROM %s WHERE mail_id IN (%s)"
+                        % (table, placeholders), ids
+                    )
+            total += len(ids)
+            last = ids[-1]
+            self.__vprint("  %d messages deleted (%.1f/s)"
+                          % (total, total / max(time.time() - start, 0.001)))
+        return total
+
+    def delete_orphan_addresses(self):
+        """Delete addresses referenced by no message, in one query."""
+        cursor = connections["amavis"].cursor()
+        with transaction.commit_on_success(using="amavis"):
+            cursor.execute("""DELETE FROM maddr
+WHERE NOT EXISTS (SELECT 1 FROM msgs WHERE msgs.sid = maddr.id)
+AND NOT EXISTS (SELECT 1 FROM msgrcpt WHERE msgrcpt.rid = maddr.id)""")
+            return cursor.rowcount
+
+    def step(self, label, func, *args, **kwargs):
+        self.__vprint(label)
+        start = time.time()
+        count = func(*args, **kwargs)
+        self.__vprint("  %d deleted in %.2fs" % (count, time.time() - start))
+
     def handle(self, *args, **options):
         if options["debug"]:
             import logging
@@ -38,6 +97,7 @@ class Command(BaseCommand):
             l.setLevel(logging.DEBUG)
             l.addHandler(logging.StreamHandler())
         self.verbose = options["verbose"]
+        self.batch_size = options["batch_size"]
 
         Amavis().load()
 
@@ -49,19 +109,26 @@ class Command(BaseCommand):
                                 app="amavis") == "yes":
             flags += ['R']
 
-        self.__vprint("Deleting marked messages...")
-        ids = Msgrcpt.objects.filter(rs__in=flags).values("mail_id")
-        for msg in Msgs.objects.filter(mail_id__in=ids):
-            if not msg.msgrcpt_set.exclude(rs__in=flags).count():
-                msg.delete()
+        # Messages for which every recipient is marked
+        placeholders = ", ".join(["%s"] * len(flags))
+        self.step(
+            "Deleting marked messages...", self.delete_messages,
+            """SELECT m.mail_id FROM msgs m
+WHERE EXISTS (SELECT 1 FROM msgrcpt r
+              WHERE r.mail_id = m.mail_id AND r.rs IN (%s))
+AND NOT EXISTS (SELECT 1 FROM msgrcpt r
+                WHERE r.mail_id = m.mail_id AND r.rs NOT IN (%s))"""
+            % (placeholders, placeholders), flags + flags, keyset=True
+        )
 
-        self.__vprint("Deleting messages older than %d days..." % max_messages_age)
         limit = int(time.time()) - (max_messages_age * 24 * 3600)
-        Msgs.objects.filter(time_num__lt=limit).delete()
+        self.step(
+            "Deleting messages older than %d days..." % max_messages_age,
+            self.delete_messages,
+            "SELECT m.mail_id FROM msgs m WHERE m.time_num < %s", [limit]
+        )
 
-        self.__vprint("Deleting unreferenced e-mail addresses...")
-        for maddr in Maddr.objects.all():
-            if not maddr.msgs_set.count() and not maddr.msgrcpt_set.count():
-                maddr.delete()
+        self.step("Deleting unreferenced e-mail addresses...",
+                  self.delete_orphan_addresses)
 
         self.__vprint("Done.")
@@ -0,0 +1,282 @@
+# coding: utf-8
+"""
+Quarantine search index.
+
+``LIKE '%pattern%'`` filters on the amavis database need a full scan
+of the ``msgs`` table. On big databases, an optional index can be
+used instead: it is stored in a SQLite file (next to the amavis
+database, not inside it) and updated by the ``amsearchindex``
+management command.
+
+The index contains:
+
+* a full-text table (``msgs_fts``) for senders, subjects and
+  recipients,
+* a regular table (``msgs_meta``) for message-ids, client addresses
+  and spam scores.
+
+The listing only gets identifiers from the index, so permissions and
+message statuses are still checked against the amavis database.
+"""
+import os
+import re
+import sqlite3
+from django.db.models import Q
+from modoboa.lib import parameters
+from .models import Msgs
+
+FULLTEXT_CRITERIA = ["from_addr", "subject", "to"]
+CRITERIA = FULLTEXT_CRITERIA + ["message_id", "client_addr", "score"]
+
+
+class SearchIndex(object):
+    """A SQLite based index of quarantined messages."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+        return self._conn
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self):
+        """Create the index tables (if needed)."""
+        c = self.conn
+        c.execute("""CREATE TABLE IF NOT EXISTS msgs_meta (
+  id INTEGER PRIMARY KEY,
+  mail_id TEXT NOT NULL UNIQUE,
+  time_num INTEGER NOT NULL,
+  spam_level REAL,
+  client_addr TEXT,
+  message_id TEXT
+)""")
+        for column in ["time_num", "spam_level", "client_addr", "message_id"]:
+            c.execute("CREATE INDEX IF NOT EXISTS msgs_meta_idx_%s "
+                      "ON msgs_meta (%s)" % (column, column))
+        exists = c.execute(
+            "SELECT name FROM sqlite_master WHERE name='msgs_fts'"
+        ).fetchone()
+        if exists is None:
+            try:
+                c.execute("CREATE VIRTUAL TABLE msgs_fts "
+                          "USING fts5(from_addr, subject, rcpt)")
+            except sqlite3.OperationalError:
+                # SQLite < 3.9
+                c.execute("CREATE VIRTUAL TABLE msgs_fts "
+                          "USING fts4(from_addr, subject, rcpt)")
+        c.commit()
+
+    def last_position(self):
+        """Return the (time_num, mail_id) of the last indexed message."""
+        row = self.conn.execute(
+            "SELECT time_num, mail_id FROM msgs_meta "
+            "ORDER BY time_num DESC, mail_id DESC LIMIT 1"
+        ).fetchone()
+        return row
+
+    def update(self, batch_size=1000, overlap=300):
+        """Index the messages added since the last update
+
+        Messages are read by batches, ordered by (time_num,
+        mail_id). Amavis can write a message a bit after its
+        reception time so the scan restarts ``overlap`` seconds before
+        the last indexed message (already indexed ones are ignored).
+
+        :return: the number of indexed messages
+        """
+        from .sql_listing import get_wrapper
+
+        wrapper = get_wrapper()
+        position = self.last_position()
+        if position is not None:
+            position = (position[0] - overlap, "")
+        total = 0
+        while True:
+            qset = Msgs.objects.order_by("time_num", "mail_id")
+            if position is not None:
+                qset = qset.filter(
+                    Q(time_num__gt=position[0]) |
+                    Q(time_num=position[0], mail_id__gt=position[1])
+                )
+            rows = list(qset.values(
+                "mail_id", "time_num", "spam_level", "client_addr",
+                "message_id", "from_addr", "subject"
+            )[:batch_size])
+            if not rows:
+                break
+            rcpts = {}
+            for rcpt in wrapper.get_recipients([r["mail_id"] for r in rows]):
+                rcpts.setdefault(rcpt["mail_id"], []).append(rcpt["to_addr"])
+            total += self.add(rows, rcpts)
+            position = (rows[-1]["time_num"], rows[-1]["mail_id"])
+        return total
+
+    def add(self, rows, rcpts):
+        """Add messages to the index
+
+        :param rows: a list of dictionaries (``msgs`` rows)
+        :param rcpts: a dictionary (mail_id => list of recipients)
+        :return: the number of added messages
+        """
+        c = self.conn
+        count = 0
+        for row in rows:
+            mail_id = str(row["mail_id"])
+            cursor = c.execute(
+                "INSERT OR IGNORE INTO msgs_meta "
+                "(mail_id, time_num, spam_level, client_addr, message_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (mail_id, row["time_num"], row["spam_level"],
+                 row["client_addr"], normalize_message_id(row["message_id"]))
+            )
+            if not cursor.rowcount:
+                continue
+            c.execute(
+                "INSERT INTO msgs_fts (rowid, from_addr, subject, rcpt) "
+                "VALUES (?, ?, ?, ?)",
+                (cursor.lastrowid, row["from_addr"], row["subject"],
+                 u" ".join(rcpts.get(row["mail_id"], [])))
+            )
+            count += 1
+        c.commit()
+        return count
+
+    def prune(self, limit):
+        """Remove messages received before ``limit``."""
+        c = self.conn
+        c.execute("DELETE FROM msgs_fts WHERE rowid IN "
+                  "(SELECT id FROM msgs_meta WHERE time_num < ?)", (limit,))
+        cursor = c.execute("DELETE FROM msgs_meta WHERE time_num < ?",
+                           (limit,))
+        c.commit()
+        return cursor.rowcount
+
+    def _where(self, criteria, pattern):
+        """Return the WHERE clauses (and their parameters) of a search
+
+        :return: a tuple (clauses, params), None if nothing can match
+        """
+        where = []
+        params = []
+        tokens = re.findall(r"\w+", pattern.lower(), re.UNICODE)
+        fulltext = [c for c in criteria if c in FULLTEXT_CRITERIA]
+        if fulltext and tokens:
+            columns = ["rcpt" if c == "to" else c for c in fulltext]
+            match = " OR ".join(
+                ["(%s)" % " ".join(["%s:%s*" % (col, tok) for tok in tokens])
+                 for col in columns]
+            )
+            where.append("id IN (SELECT rowid FROM msgs_fts "
+                         "WHERE msgs_fts MATCH ?)")
+            params.append(match)
+        if "message_id" in criteria:
+            where.append("message_id = ?")
+            params.append(normalize_message_id(pattern))
+        if "client_addr" in criteria:
+            where.append("client_addr = ?")
+            params.append(pattern.strip())
+        if "score" in criteria:
+            scorerange = parse_score_range(pattern)
+            if scorerange is None:
+                return None
+            if scorerange[0] is not None:
+                where.append("spam_level >= ?")
+                params.append(scorerange[0])
+            if scorerange[1] is not None:
+                where.append("spam_level <= ?")
+                params.append(scorerange[1])
+        if not where:
+            return None
+        return where, params
+
+    def search_keys(self, criteria, pattern, limit=None, key=None,
+                    ascending=False):
+        """Return the keys of the messages matching a pattern
+
+        Keys are (time_num, mail_id) tuples, they can be used to read
+        the results by batches (see ``SQLconnector.seek``).
+
+        :param criteria: a list of criteria (see ``CRITERIA``); full
+                         text criteria are combined with OR
+        :param pattern: the searched value
+        :param limit: maximum number of returned keys (None: no limit)
+        :param key: only return the keys located after this one
+        :param ascending: the order of the keys (most recent first
+                          by default)
+        :return: a list of tuples
+        """
+        where = self._where(criteria, pattern)
+        if where is None:
+            return []
+        where, params = where
+        if key is not None:
+            op = ">" if ascending else "<"
+            where.append("(time_num %s ? OR (time_num = ? AND mail_id %s ?))"
+                         % (op, op))
+            params += [key[0], key[0], str(key[1])]
+        sign = "" if ascending else " DESC"
+        sql = "SELECT time_num, mail_id FROM msgs_meta WHERE %s " \
+            "ORDER BY time_num%s, mail_id%s" % (" AND ".join(where), sign, sign)
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+        return [tuple(row) for row in self.conn.execute(sql, params)]
+
+    def search(self, criteria, pattern, limit=None):
+        """Return the identifiers of the messages matching a pattern
+
+        The most recent messages come first.
+
+        :return: a list of mail_id
+        """
+        return [row[1] for row in self.search_keys(criteria, pattern, limit)]
+
+
+def normalize_message_id(value):
+    """Return a message-id without its angle brackets (as unicode)
+
+    Undecodable bytes (malformed headers) are replaced.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    return unicode(value).strip().strip(u"<>")
+
+
+def parse_score_range(value):
+    """Parse a spam score range
+
+    Accepted formats: ``min-max``, ``>min``, ``<max`` and ``min``.
+
+    :return: a tuple (min, max) (None means unbounded) or None if the
+             value is invalid
+    """
+    value = value.replace(" ", "")
+    m = re.match(r"^(-?[\d\.]+)-(-?[\d\.]+)$", value)
+    try:
+        if m is not None:
+            return float(m.group(1)), float(m.group(2))
+        if value.startswith(">"):
+            return float(value.lstrip(">=")), None
+        if value.startswith("<"):
+            return None, float(value.lstrip("<="))
+        return float(value), None
+    except ValueError:
+        return None
+
+
+def get_search_index():
+    """Return the search index, None if it is not enabled."""
+    path = parameters.get_admin("SEARCH_INDEX", app="amavis")
+    if not path:
+        return None
+    index = SearchIndex(path)
+    if not index.exists():
+        return None
+    return index
@@ -1,16 +1,21 @@
 # coding: utf-8
 import re
+import hashlib
 from datetime import datetime
+from django.core.cache import cache
+from django.db import connections
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy
-from django.db.models import Q
+from django.db.models import Q, Count
 from modoboa.lib import tables
 from modoboa.lib.webutils import static_url
-from modoboa.lib.email_listing import MBconnector, EmailListing
+from modoboa.lib.email_listing import (
+    MBconnector, EmailListing, CursorPage, encode_cursor, decode_cursor
+)
 from modoboa.lib.emailutils import Email
 from modoboa.lib.dbutils import db_type
 from modoboa.extensions.admin.models import Domain
-from .models import Quarantine, Msgrcpt
+from .models import Quarantine, Msgrcpt, Maddr
 
 
 class Qtable(tables.Table):
@@ -33,6 +38,128 @@ class Qtable(tables.Table):
         return datetime.fromtimestamp(value)
 
 
+def approximate_count(qset, timeout=60):
+    """Return an approximation of the number of rows of a queryset
+
+    With postgres, the estimation of the query planner is used.
+    Otherwise, the exact count is computed and cached during *timeout*
+    seconds.
+    """
+    sql, params = qset.query.get_compiler(using=qset.db).as_sql()
+    if db_type(qset.db) == "postgres":
+        cursor = connections[qset.db].cursor()
+        cursor.execute("EXPLAIN %s" % sql, params)
+        m = re.search(r"rows=(\d+)", cursor.fetchone()[0])
+        if m is not None:
+            return int(m.group(1))
+    key = "amavis.count.%s" % hashlib.md5(repr((sql, params))).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = qset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+class IndexSearch(object):
+    """A search made using the quarantine search index
+
+    Results are read from the index by batches of *batch_size* keys,
+    in (time_num, mail_id) order; the messages of each batch are then
+    filtered by the amavis database (permissions, statuses).
+
+    At most *max_batches* batches are read per operation so broad
+    patterns don't scan the whole index: counts stop at *max_count*
+    matches (see ``truncated``) and pages can be resumed from the last
+    key read (see ``rows``).
+    """
+
+    def __init__(self, index, criteria, pattern, batch_size=500,
+                 max_batches=20, max_count=1000):
+        self.index = index
+        self.criteria = criteria
+        self.pattern = pattern
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.max_count = max_count
+        #: True if the last count is a lower bound
+        self.truncated = False
+
+    def batches(self, key=None, ascending=False):
+        """Iterate over the matching keys, by batches
+
+        :param key: start after this (time_num, mail_id) key
+        """
+        for i in range(self.max_batches):
+            batch = self.index.search_keys(
+                self.criteria, self.pattern, self.batch_size, key, ascending
+            )
+            if batch:
+                yield batch
+            if len(batch) < self.batch_size:
+                break
+            key = batch[-1]
+
+    def has_more(self, key, ascending=False):
+        """Tell if keys remain after *key* (when a scan is interrupted)"""
+        return len(self.index.search_keys(
+            self.criteria, self.pattern, 1, key, ascending
+        )) > 0
+
+    def rows(self, qset, limit, key=None, ascending=False):
+        """Return the keys of the messages of *qset* matching the search
+
+        If *limit* is not reached after *max_batches* batches, the last
+        key read is also returned: no message of *qset* lies between the
+        returned rows and this key, the scan can be resumed from it.
+
+        :param qset: the messages (``Quarantine`` queryset)
+        :param limit: the maximum number of returned keys
+        :return: a tuple (list of (time_num, mail_id) tuples, last key
+                 read or None)
+        """
+        rows = []
+        batch = []
+        for batch in self.batches(key, ascending):
+            found = set(qset.filter(mail__in=[row[1] for row in batch])
+                        .values_list("mail_id", flat=True))
+            rows += [row for row in batch if row[1] in found]
+            if len(rows) >= limit:
+                return rows[:limit], None
+        if len(batch) == self.batch_size \
+                and self.has_more(batch[-1], ascending):
+            return rows, batch[-1]
+        return rows, None
+
+    def count(self, qset, timeout=60):
+        """Return the number of messages of *qset* matching the search
+
+        Counting stops after *max_count* matches or *max_batches*
+        batches, ``truncated`` tells if the result is a lower bound. It
+        is cached during *timeout* seconds.
+        """
+        sql, params = qset.query.get_compiler(using=qset.db).as_sql()
+        key = "amavis.count.%s" % hashlib.md5(repr(
+            (sql, params, self.index.path, self.criteria, self.pattern)
+        )).hexdigest()
+        result = cache.get(key)
+        if result is None:
+            count = 0
+            batch = []
+            for batch in self.batches():
+                count += qset.filter(
+                    mail__in=[row[1] for row in batch]
+                ).count()
+                if count >= self.max_count:
+                    break
+            truncated = count > self.max_count or (
+                len(batch) == self.batch_size and self.has_more(batch[-1])
+            )
+            result = (min(count, self.max_count), truncated)
+            cache.set(key, result, timeout)
+        count, self.truncated = result
+        return count
+
+
 class SQLconnector(MBconnector):
     orders = {
         "from": "mail__from_addr",
@@ -40,10 +167,22 @@ class SQLconnector(MBconnector):
         "date": "mail__time_num"
     }
 
-    def __init__(self, mail_ids=None, filter=None):
+    def __init__(self, mail_ids=None, filter=None, search=None):
         self.count = None
         self.mail_ids = mail_ids
         self.filter = filter
+        self.search = search
+        self.order = None
+
+    @property
+    def keyset(self):
+        """Tell if keyset pagination can be used (see ``seek``)
+
+        Only the date order is supported: (time_num, mail_id) is
+        unique and time_num is indexed by amavis.
+        """
+        return self.order is not None \
+            and self.order.lstrip("-") == self.orders["date"]
 
     def messages_count(self, **kwargs):
         if self.count is None:
@@ -53,37 +192,146 @@ class SQLconnector(MBconnector):
             if self.filter:
                 filter &= self.filter
             self.messages = Quarantine.objects.filter(filter)
-            if "order" in kwargs:
+            if kwargs.get("order"):
                 totranslate = kwargs["order"][1:]
                 sign = kwargs["order"][:1]
                 if sign == " ":
                     sign = ""
-                order = sign + self.orders[totranslate]
-                self.messages = self.messages.order_by(order)
-            self.count = self.messages.count()
+                self.order = sign + self.orders[totranslate]
+                self.messages = self.messages.order_by(
+                    self.order, sign + "mail"
+                )
+            if self.search is not None:
+                self.count = self.search.count(self.messages)
+            elif self.keyset:
+                self.count = approximate_count(self.messages)
+            else:
+                self.count = self.messages.count()
         return self.count
 
+    def seek(self, cursor, nbelems):
+        """Return a page of messages using keyset pagination
+
+        Instead of an offset, pages are located using the (time_num,
+        mail_id) key of the last (or first) message of the adjacent
+        page, so deep pages are as fast as the first one.
+
+        :param cursor: a cursor returned by a previous call (or None
+                       for the first page)
+        :param nbelems: the number of messages per page
+        :return: a tuple (emails, previous cursor, next cursor)
+        """
+        desc = self.order.startswith("-")
+        values = decode_cursor(cursor)
+        if values is None or values[1:2] != [self.order] \
+                or (values[0] in ["p", "n"] and
+                    (len(values) != 4 or not values[2].isdigit())):
+            # Invalid cursor: first page
+            values = [None]
+        direction = values[0]
+        key = (int(values[2]), values[3]) \
+            if direction in ["p", "n"] else None
+        backward = direction in ["p", "l"]
+        # Messages are read from the cursor, in this order
+        descending = desc != backward
+        resume = None
+        if self.search is not None:
+            rows, resume = self.search.rows(
+                self.messages, nbelems + 1, key, not descending
+            )
+        else:
+            qset = self.messages
+            if key is not None:
+                if descending:
+                    qset = qset.filter(
+                        Q(mail__time_num__lt=key[0]) |
+                        Q(mail__time_num=key[0], mail__lt=key[1])
+                    )
+                else:
+                    qset = qset.filter(
+                        Q(mail__time_num__gt=key[0]) |
+                        Q(mail__time_num=key[0], mail__gt=key[1])
+                    )
+            if backward:
+                qset = qset.reverse()
+            rows = list(
+                qset.values_list("mail__time_num", "mail_id")[:nbelems + 1]
+            )
+        more = len(rows) > nbelems or resume is not None
+        rows = rows[:nbelems]
+        if not rows and resume is None:
+            return [], None, None
+        if backward:
+            rows.reverse()
+        # Keys of the first and last messages of the page (display
+        # order). An unfinished index scan continues from the last key
+        # read, the page can even be empty.
+        first = rows[0] if rows else resume
+        last = rows[-1] if rows else resume
+        if resume is not None:
+            if backward:
+                first = resume
+            else:
+                last = resume
+        has_previous = more if backward else direction == "n"
+        has_next = more if not backward else direction == "p"
+        prev_cursor = encode_cursor("p", self.order, *first) \
+            if has_previous else None
+        next_cursor = encode_cursor("n", self.order, *last) \
+            if has_next else None
+        return (self.get_emails([row[1] for row in rows]),
+                prev_cursor, next_cursor)
+
     def fetch(self, start=None, stop=None, **kwargs):
-        messages = self.messages[start - 1:stop]
+        """Return the messages of a page
+
+        Only two queries are issued, whatever the page size: one to
+        select the page (quarantine) and one to retrieve the
+        recipients (msgrcpt, msgs and maddr joined).
+        """
+        return self.get_emails(list(
+            self.messages[start - 1:stop].values_list("mail_id", flat=True)
+        ))
+
+    def get_emails(self, mail_ids):
+        """Return the recipients of the given messages (one query)."""
+        rcpts = {}
+        for rcpt in get_wrapper().get_recipients(mail_ids):
+            rcpts.setdefault(rcpt["mail_id"], []).append(rcpt)
         emails = []
-        for qm in messages:
-            for rcpt in qm.mail.msgrcpt_set.all():
-                m = {"from": qm.mail.from_addr,
-                     "to": rcpt.rid.email,
-                     "subject": qm.mail.subject,
-                     "mailid": qm.mail_id,
-                     "date": qm.mail.time_num,
-                     "type": rcpt.content}
-                if rcpt.rs == '':
+        for mail_id in mail_ids:
+            for rcpt in rcpts.get(mail_id, []):
+                m = {"from": rcpt["mail__from_addr"],
+                     "to": rcpt["to_addr"],
+                     "subject": rcpt["mail__subject"],
+                     "mailid": mail_id,
+                     "date": rcpt["mail__time_num"],
+                     "type": rcpt["content"]}
+                if rcpt["rs"] == '':
                     m["class"] = "unseen"
-                elif rcpt.rs == 'R':
+                elif rcpt["rs"] == 'R':
                     m["img_rstatus"] = static_url("pics/release.png")
-                elif rcpt.rs == 'p':
+                elif rcpt["rs"] == 'p':
                     m["class"] = "pending"
                 emails.append(m)
         return emails
 
 
+def reverse_domain_names(domains):
+    """Return domain names as stored by amavis into ``maddr.domain``
+
+    Amavis stores the domain part of each address in lower case, with
+    its labels reversed (user@sub.example.com => com.example.sub).
+    Filtering on this column doesn't require a full scan of maddr,
+    unlike a regular expression applied to the email address.
+
+    :param domains: a list of ``Domain`` objects
+    :return: a list of strings
+    """
+    return [".".join(reversed(dom.name.lower().split(".")))
+            for dom in domains]
+
+
 class SQLWrapper(object):
     """A simple SQL wrapper.
 
@@ -108,23 +356,111 @@ class SQLWrapper(object):
         else:
             if not request.user.is_superuser:
                 doms = Domain.objects.get_for_admin(request.user)
-                regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-                doms_q = Q(rid__email__regex=regexp)
-                q &= doms_q
+                q &= Q(rid__domain__in=reverse_domain_names(doms))
             if rcptfilter is not None:
                 q &= Q(rid__email__contains=rcptfilter)
 
         return Msgrcpt.objects.filter(q).values("mail_id")
 
+    def get_recipients(self, mailids):
+        """Return the recipients of the given messages
+
+        Only the columns displayed by the listing are selected (as
+        dictionaries).
+
+        :param mailids: a list of message identifiers
+        """
+        return Msgrcpt.objects.filter(mail__in=mailids).extra(
+            select={"to_addr": "maddr.email"},
+            where=["msgrcpt.rid=maddr.id"], tables=["maddr"]
+        ).values(
+            "mail_id", "mail__from_addr", "mail__subject", "mail__time_num",
+            "to_addr", "content", "rs"
+        ).order_by("rseqnum")
+
     def get_recipient_message(self, address, mailid):
         return Msgrcpt.objects.get(mail=mailid, rid__email=address)
 
     def get_recipient_messages(self, address, mailids):
         return Msgrcpt.objects.filter(mail__in=mailids, rid__email=address)
 
+    def get_address_ids(self, addresses):
+        """Return the maddr identifiers of the given addresses
+
+        :param addresses: a list of email addresses
+        :return: a dictionary {address: id}
+        """
+        return dict(
+            Maddr.objects.filter(email__in=addresses)
+            .values_list("email", "id")
+        )
+
+    def _selection_filter(self, selection):
+        """Build a filter matching (address, mail_id) pairs
+
+        Pairs are grouped by recipient so the resulting condition
+        looks like (rid = 1 AND mail_id IN (...)) OR (rid = 2 AND
+        ...), which doesn't need any join.
+
+        :param selection: a list of (address, mail_id) tuples
+        :return: a tuple (``Q`` object or None, {address: id})
+        """
+        ids = self.get_address_ids(list(set([a for a, m in selection])))
+        mailids = {}
+        for address, mail_id in selection:
+            if address in ids:
+                mailids.setdefault(ids[address], []).append(mail_id)
+        result = None
+        for rid, mids in mailids.iteritems():
+            q = Q(rid=rid, mail__in=mids)
+            result = q if result is None else result | q
+        return result, ids
+
+    def get_selected_messages(self, selection):
+        """Return the information needed to release messages
+
+        :param selection: a list of (address, mail_id) tuples
+        :return: a list of (address, mail_id, secret_id) tuples
+        """
+        q, ids = self._selection_filter(selection)
+        if q is None:
+            return []
+        addresses = dict((v, k) for k, v in ids.iteritems())
+        return [
+            (addresses[row["rid"]], row["mail_id"], row["mail__secret_id"])
+            for row in Msgrcpt.objects.filter(q).values(
+                "rid", "mail_id", "mail__secret_id"
+            )
+        ]
+
+    def set_messages_status(self, selection, rs):
+        """Change the status of several messages using one UPDATE
+
+        :param selection: a list of (address, mail_id) tuples
+        :param rs: the new status
+        :return: the number of updated rows
+        """
+        q = self._selection_filter(selection)[0]
+        if q is None:
+            return 0
+        return Msgrcpt.objects.filter(q).update(rs=rs)
+
     def get_domains_pending_requests(self, domains):
-        regexp = "(%s)" % '|'.join([dom.name for dom in domains])
-        return Msgrcpt.objects.filter(rs='p', rid__email__regex=regexp)
+        return Msgrcpt.objects.filter(
+            rs='p', rid__domain__in=reverse_domain_names(domains)
+        )
+
+    def count_pending_requests_by_domain(self):
+        """Return the number of pending requests of each domain
+
+        :return: a dictionary (domain name => count)
+        """
+        return dict(
+            (".".join(reversed(row["rid__domain"].split("."))), row["count"])
+            for row in Msgrcpt.objects.filter(rs='p')
+            .values("rid__domain").annotate(count=Count("mail"))
+            .order_by()
+        )
 
     def get_pending_requests(self, user):
         """Return the number of current pending requests
@@ -136,13 +472,19 @@ class SQLWrapper(object):
             doms = Domain.objects.get_for_admin(user)
             if not doms.count():
                 return 0
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            doms_q = Q(rid__email__regex=regexp)
-            rq &= doms_q
+            rq &= Q(rid__domain__in=reverse_domain_names(doms))
         return Msgrcpt.objects.filter(rq).count()
 
     def get_mail_content(self, mailid):
-        return Quarantine.objects.filter(mail=mailid)
+        return Quarantine.objects.filter(mail=mailid).order_by("chunk_ind")
+
+    def iter_mail_chunks(self, mailid):
+        """Iterate over the chunks of a quarantined message
+
+        Chunks are returned in order and fetched lazily.
+        """
+        return self.get_mail_content(mailid) \
+            .values_list("mail_text", flat=True).iterator()
 
 
 class PgWrapper(SQLWrapper):
@@ -150,6 +492,9 @@ class PgWrapper(SQLWrapper):
 
     Make use of ``QuerySet.extra`` and postgres ``convert_from``
     function to let the quarantine manager work as expected !
+
+    ``maddr.domain`` is not a bytea field so filters on domains are
+    inherited from ``SQLWrapper``.
     """
 
     def get_mails(self, request, rcptfilter=None):
@@ -158,6 +503,7 @@ class PgWrapper(SQLWrapper):
         else:
             q = ~Q(rs='D')
         where = ["U0.rid=maddr.id"]
+        params = []
         if request.user.group == 'SimpleUsers':
             where.append("convert_from(maddr.email, 'UTF8') = '%s'" % request.user.email)
             return Msgrcpt.objects.filter(q).extra(
@@ -165,12 +511,30 @@ class PgWrapper(SQLWrapper):
             )
 
         if not request.user.is_superuser:
-            doms = Domain.objects.get_for_admin(request.user)
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            where.append("convert_from(maddr.email, 'UTF8') ~ '%s'" % regexp)
+            names = reverse_domain_names(
+                Domain.objects.get_for_admin(request.user)
+            )
+            if not names:
+                return Msgrcpt.objects.none().values("mail_id")
+            where.append(
+                "maddr.domain IN (%s)" % ", ".join(["%s"] * len(names))
+            )
+            params += names
         if rcptfilter is not None:
-            where.append("convert_from(maddr.email, 'UTF8') LIKE '%%%s%%'" % rcptfilter)
-        return Msgrcpt.objects.filter(q).extra(where=where, tables=['maddr']).values("mail_id")
+            where.append("convert_from(maddr.email, 'UTF8') LIKE %s")
+            params.append("%%%s%%" % rcptfilter)
+        return Msgrcpt.objects.filter(q).extra(
+            where=where, params=params, tables=['maddr']
+        ).values("mail_id")
+
+    def get_recipients(self, mailids):
+        return Msgrcpt.objects.filter(mail__in=mailids).extra(
+            select={"to_addr": "convert_from(maddr.email, 'UTF8')"},
+            where=["msgrcpt.rid=maddr.id"], tables=["maddr"]
+        ).values(
+            "mail_id", "mail__from_addr", "mail__subject", "mail__time_num",
+            "to_addr", "content", "rs"
+        ).order_by("rseqnum")
 
     def get_recipient_message(self, address, mailid):
         qset = Msgrcpt.objects.filter(mail=mailid).extra(
@@ -185,30 +549,26 @@ class PgWrapper(SQLWrapper):
             tables=['maddr']
         )
 
-    def get_domains_pending_requests(self, domains):
-        regexp = "(%s)" % '|'.join([dom.name for dom in domains])
-        return Msgrcpt.objects.filter(rs='p').extra(
-            where=["msgrcpt.rid=maddr.id", "convert_from(maddr.email, 'UTF8') ~ '%s'" % regexp],
-            tables=['maddr']
+    def get_address_ids(self, addresses):
+        if not addresses:
+            return {}
+        return dict(
+            Maddr.objects.extra(
+                select={"address": "convert_from(email, 'UTF8')"},
+                where=["convert_from(email, 'UTF8') IN (%s)"
+                       % ", ".join(["%s"] * len(addresses))],
+                params=addresses
+            ).values_list("address", "id")
         )
 
-    def get_pending_requests(self, user):
-        rq = Q(rs='p')
-        if not user.is_superuser:
-            doms = Domain.objects.get_for_admin(user)
-            if not doms.count():
-                return 0
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            return Msgrcpt.objects.filter(rq).extra(
-                where=["msgrcpt.rid=maddr.id", "convert_from(maddr.email, 'UTF8') ~ '%s'" % (regexp,)],
-                tables=['maddr']
-            ).count()
-        return Msgrcpt.objects.filter(rq).count()
-
     def get_mail_content(self, mailid):
         return Quarantine.objects.filter(mail=mailid).extra(
             select={'mail_text': "convert_from(mail_text, 'UTF8')"}
-        )
+        ).order_by("chunk_ind")
+
+    def iter_mail_chunks(self, mailid):
+        return (qm.mail_text
+                for qm in self.get_mail_content(mailid).iterator())
 
 
 def get_wrapper():
@@ -228,15 +588,41 @@ class SQLlisting(EmailListing):
     defcallback = "updatelisting"
     reset_wm_url = True
 
-    def __init__(self, user, msgs, filter, **kwargs):
+    def __init__(self, user, msgs, filter, search=None, **kwargs):
         if user.group == 'SimpleUsers':
             Qtable.cols_order = ['type', 'rstatus', 'from_', 'subject', 'time']
         else:
             Qtable.cols_order = ['type', 'rstatus', 'to', 'from_', 'subject', 'time']
-        self.mbc = SQLconnector(msgs, filter)
+        self.mbc = SQLconnector(msgs, filter, search)
         super(SQLlisting, self).__init__(**kwargs)
         self.show_listing_headers = True
 
+    def getpage(self, pageid, cursor=None):
+        """Return the requested page
+
+        Keyset pagination is used when messages are sorted by date,
+        numbered pages otherwise.
+
+        :param pageid: the page number (only used for display when
+                       the pagination is keyset based)
+        :param cursor: an opaque cursor (see ``SQLconnector.seek``)
+        """
+        if not self.mbc.keyset:
+            return self.paginator.getpage(pageid)
+        emails, prev_cursor, next_cursor = \
+            self.mbc.seek(cursor, self.elems_per_page)
+        if not emails and prev_cursor is None and next_cursor is None:
+            return None
+        if prev_cursor is None:
+            pageid = 1
+        page = CursorPage(
+            pageid, emails, self.paginator.total, self.elems_per_page,
+            prev_cursor, next_cursor, encode_cursor("l", self.mbc.order),
+            truncated=self.mbc.search is not None and self.mbc.search.truncated
+        )
+        page.paginator = self.paginator
+        return page
+
 
 class SQLemail(Email):
     def __init__(self, msg, *args, **kwargs):
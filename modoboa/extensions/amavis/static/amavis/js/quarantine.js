@@ -62,6 +62,7 @@ Quarantine.prototype = {
 
     view_requests: function(e) {
         e.preventDefault();
+        this.navobj.delparam("cursor");
         this.navobj.setparam("viewrequests", "1").update();
     },
 
@@ -103,6 +103,9 @@ def quar_menu(user):
         extraopts = [{"name": "to", "label": _("To")}]
     else:
         extraopts = []
+    extraopts += [{"name": "message_id", "label": _("Message-ID")},
+                  {"name": "client_addr", "label": _("Client address")},
+                  {"name": "score", "label": _("Spam score")}]
     extracontent = render_to_string('common/email_searchbar.html', {
         "STATIC_URL": settings.STATIC_URL,
         "extraopts": extraopts
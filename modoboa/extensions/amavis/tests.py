@@ -0,0 +1,901 @@
+# coding: utf-8
+import asyncore
+import fcntl
+import os
+import re
+import smtpd
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.conf.urls import patterns, include
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections, transaction
+from django.db.models import Q
+from django.test import TestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from StringIO import StringIO
+from django.utils import simplejson
+from modoboa.core.models import Extension, User
+from modoboa.lib import parameters
+from modoboa.lib.dbutils import db_type
+from modoboa.lib.email_listing import encode_cursor
+from modoboa.extensions.admin import factories
+from modoboa.extensions.admin.models import Domain
+from . import Amavis
+from .lib import (
+    AMrelease, get_pending_requests, invalidate_pending_requests,
+    get_quarantined_message
+)
+from .models import Maddr, Msgs, Msgrcpt, Quarantine
+from .search import SearchIndex, get_search_index, parse_score_range
+from .sql_listing import (
+    IndexSearch, SQLconnector, get_wrapper, reverse_domain_names
+)
+from .views import nbrequests
+
+# Simplified version of the amavis schema (see README.sql-mysql and
+# README.sql-pg inside amavis' documentation). Amavis tables are not
+# managed by django so we need to create them. Some columns are
+# binary with postgres (see PgWrapper).
+SCHEMA = {
+    "maddr": """CREATE TABLE maddr (
+  partition_tag integer DEFAULT 0,
+  id integer PRIMARY KEY,
+  email %(binary)s NOT NULL UNIQUE,
+  domain varchar(255) NOT NULL
+)""",
+    "msgs": """CREATE TABLE msgs (
+  partition_tag integer DEFAULT 0,
+  mail_id varchar(12) PRIMARY KEY,
+  secret_id varchar(12) DEFAULT '',
+  am_id varchar(20) NOT NULL,
+  time_num integer NOT NULL,
+  time_iso char(16) NOT NULL,
+  sid integer NOT NULL,
+  policy varchar(255) DEFAULT '',
+  client_addr varchar(255) DEFAULT '',
+  size integer NOT NULL,
+  originating char(1) DEFAULT ' ',
+  content char(1),
+  quar_type char(1),
+  quar_loc varchar(255) DEFAULT '',
+  dsn_sent char(1),
+  spam_level real,
+  message_id varchar(255) DEFAULT '',
+  from_addr varchar(255) DEFAULT '',
+  subject varchar(255) DEFAULT '',
+  host varchar(255) NOT NULL
+)""",
+    "msgrcpt": """CREATE TABLE msgrcpt (
+  partition_tag integer DEFAULT 0,
+  mail_id varchar(12) NOT NULL,
+  rseqnum integer DEFAULT 0 NOT NULL,
+  rid integer NOT NULL,
+  is_local char(1) DEFAULT ' ',
+  content char(1) DEFAULT ' ',
+  ds char(1) NOT NULL,
+  rs char(1) NOT NULL,
+  bl char(1) DEFAULT ' ',
+  wl char(1) DEFAULT ' ',
+  bspam_level real,
+  smtp_resp varchar(255) DEFAULT '',
+  PRIMARY KEY (partition_tag, mail_id, rseqnum)
+)""",
+    "quarantine": """CREATE TABLE quarantine (
+  partition_tag integer DEFAULT 0,
+  mail_id varchar(12) NOT NULL,
+  chunk_ind integer NOT NULL,
+  mail_text %(text)s NOT NULL,
+  PRIMARY KEY (partition_tag, mail_id, chunk_ind)
+)"""
+}
+
+
+class AmavisTestCase(TestCase):
+    """Base class for tests using the amavis database.
+
+    Without a dedicated amavis database (test settings usually don't
+    declare one), the 'amavis' alias is bound to the default
+    connection during the test case: rows are rolled back with the
+    ones of the default database.
+    """
+
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        super(AmavisTestCase, cls).setUpClass()
+        cls.amavis_settings = None
+        if not "amavis" in settings.DATABASES:
+            cls.amavis_settings = override_settings(DATABASES=dict(
+                settings.DATABASES, amavis=settings.DATABASES["default"]
+            ))
+            cls.amavis_settings.enable()
+            connections["amavis"] = connections["default"]
+        # Tables are created outside of the tests' transactions (sqlite
+        # commits the current transaction before a DDL statement)
+        connection = connections["amavis"]
+        existing = connection.introspection.table_names()
+        cursor = connection.cursor()
+        if db_type("amavis") == "postgres":
+            types = dict(binary="bytea", text="bytea")
+        else:
+            types = dict(binary="varchar(255)", text="text")
+        for table, sql in SCHEMA.iteritems():
+            if not table in existing:
+                cursor.execute(sql % types)
+        transaction.commit_unless_managed(using="amavis")
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.amavis_settings is not None:
+            delattr(connections._connections, "amavis")
+            cls.amavis_settings.disable()
+        super(AmavisTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.addrid = 0
+        # Listings use cached counters
+        cache.clear()
+
+    def count_queries(self, func, *args, **kwargs):
+        """Call *func* and return the number of queries on amavis tables
+
+        ``assertNumQueries`` can't be used when the amavis alias shares
+        the default connection.
+        """
+        connection = connections["amavis"]
+        debug, connection.use_debug_cursor = connection.use_debug_cursor, True
+        start = len(connection.queries)
+        try:
+            func(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = debug
+        return len([
+            query for query in connection.queries[start:]
+            if re.search(r"\b(maddr|msgs|msgrcpt|quarantine)\b", query["sql"])
+        ])
+
+    def get_maddr(self, email):
+        try:
+            return Maddr.objects.get(email=email)
+        except Maddr.DoesNotExist:
+            pass
+        self.addrid += 1
+        domain = ".".join(reversed(email.split("@")[1].split(".")))
+        return Maddr.objects.create(id=self.addrid, email=email, domain=domain)
+
+    def create_message(self, mail_id, sender, rcpts, rs=" ", content="S",
+                       time_num=None):
+        """Create a quarantined message
+
+        :param mail_id: the message identifier
+        :param sender: the sender address
+        :param rcpts: a list of recipient addresses
+        """
+        msg = Msgs.objects.create(
+            mail_id=mail_id, am_id="1",
+            time_num=time_num if time_num is not None else int(time.time()),
+            time_iso="", sid=self.get_maddr(sender), size=100,
+            content=content, from_addr=sender, subject="Test %s" % mail_id,
+            host="localhost"
+        )
+        for rseqnum, rcpt in enumerate(rcpts):
+            Msgrcpt.objects.create(
+                mail=msg, rid=self.get_maddr(rcpt), rseqnum=rseqnum,
+                content=content, ds="D", rs=rs
+            )
+        Quarantine.objects.create(
+            mail=msg, chunk_ind=1,
+            mail_text="From: %s\nSubject: Test\n\nTest\n" % sender
+        )
+        return msg
+
+
+class SQLconnectorTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(SQLconnectorTestCase, self).setUp()
+        for i in range(30):
+            self.create_message(
+                "mail%02d" % i, "sender@ext.com",
+                ["user%d@test.com" % n for n in range(i % 3 + 1)],
+                time_num=1000 + i
+            )
+
+    def test_fetch(self):
+        connector = SQLconnector()
+        self.assertEqual(connector.messages_count(order="-date"), 30)
+        emails = connector.fetch(1, 3)
+        self.assertEqual(
+            [(e["mailid"], e["to"]) for e in emails],
+            [("mail29", "user0@test.com"), ("mail29", "user1@test.com"),
+             ("mail29", "user2@test.com"), ("mail28", "user0@test.com"),
+             ("mail28", "user1@test.com"), ("mail27", "user0@test.com")]
+        )
+        self.assertEqual(emails[0]["from"], "sender@ext.com")
+        self.assertEqual(emails[0]["type"], "S")
+
+    def test_fetch_query_count(self):
+        for size in [5, 30]:
+            connector = SQLconnector()
+            connector.messages_count()
+            with self.assertNumQueries(2, using="amavis"):
+                connector.fetch(1, size)
+
+
+class WrapperTestCase(AmavisTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(WrapperTestCase, self).setUp()
+        factories.populate_database()
+        self.create_message("mail01", "sender@ext.com",
+                            ["user@test.com", "user@test2.com"], rs="p")
+        # Must not match test.com
+        self.create_message("mail02", "sender@ext.com",
+                            ["user@test.com.ext.org", "test.com@ext.org"],
+                            rs="p")
+
+    def test_reverse_domain_names(self):
+        self.assertEqual(
+            reverse_domain_names([Domain(name="Sub.Test.com")]),
+            ["com.test.sub"]
+        )
+
+    def test_pending_requests(self):
+        wrapper = get_wrapper()
+        admin = User.objects.get(username="admin@test.com")
+        self.assertEqual(wrapper.get_pending_requests(admin), 1)
+        admin = User.objects.get(username="admin")
+        self.assertEqual(wrapper.get_pending_requests(admin), 4)
+        reqs = wrapper.get_domains_pending_requests(Domain.objects.all())
+        self.assertEqual(reqs.count(), 2)
+
+
+class KeysetPaginationTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(KeysetPaginationTestCase, self).setUp()
+        # Several messages share the same time_num
+        for i in range(23):
+            self.create_message("mail%02d" % i, "sender@ext.com",
+                                ["user@test.com"], time_num=1000 + i / 3)
+
+    def get_ids(self, emails):
+        return [e["mailid"] for e in emails]
+
+    def check_order(self, order):
+        connector = SQLconnector()
+        self.assertEqual(connector.messages_count(order=order), 23)
+        self.assertTrue(connector.keyset)
+        expected = self.get_ids(connector.fetch(1, 23))
+        pages = []
+        emails, prev_cursor, next_cursor = connector.seek(None, 5)
+        self.assertIsNone(prev_cursor)
+        while True:
+            pages.append(self.get_ids(emails))
+            if next_cursor is None:
+                break
+            emails, prev_cursor, next_cursor = connector.seek(next_cursor, 5)
+            self.assertIsNotNone(prev_cursor)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(len(pages[-1]), 3)
+
+        # Go back to the previous page
+        emails, prev_cursor, next_cursor = connector.seek(prev_cursor, 5)
+        self.assertEqual(self.get_ids(emails), pages[-2])
+        self.assertIsNotNone(next_cursor)
+
+        # Last page
+        emails, prev_cursor, next_cursor = connector.seek(
+            encode_cursor("l", connector.order), 5
+        )
+        self.assertEqual(self.get_ids(emails), expected[-5:])
+        self.assertIsNone(next_cursor)
+
+    def test_seek(self):
+        self.check_order("-date")
+        self.check_order(" date")
+
+    def test_invalid_cursor(self):
+        connector = SQLconnector()
+        connector.messages_count(order="-date")
+        for cursor in ["garbage", u"caf\xe9",
+                       encode_cursor("n", "-date", "abc", "mail01")]:
+            emails, prev_cursor, next_cursor = connector.seek(cursor, 5)
+            self.assertEqual(self.get_ids(emails)[0], "mail22")
+            self.assertIsNone(prev_cursor)
+
+
+class PendingRequestsTestCase(AmavisTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(PendingRequestsTestCase, self).setUp()
+        Amavis().load()
+        factories.populate_database()
+        self.create_message("mail01", "sender@ext.com", ["user@test.com"],
+                            rs="p")
+        self.admin = User.objects.get(username="admin@test.com")
+
+    def test_cached_counter(self):
+        version, count = get_pending_requests(self.admin)
+        self.assertEqual(count, 1)
+        self.create_message("mail02", "sender@ext.com", ["user@test.com"],
+                            rs="p")
+        with self.assertNumQueries(0, using="amavis"):
+            self.assertEqual(get_pending_requests(self.admin),
+                             (version, count))
+        invalidate_pending_requests()
+        newversion, count = get_pending_requests(self.admin)
+        self.assertNotEqual(newversion, version)
+        self.assertEqual(count, 2)
+
+    def test_nbrequests_etag(self):
+        request = RequestFactory().get("/quarantine/nbrequests/")
+        request.user = self.admin
+        response = nbrequests(request)
+        self.assertEqual(simplejson.loads(response.content)["requests"], 1)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        request = RequestFactory().get(
+            "/quarantine/nbrequests/", HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        request.user = self.admin
+        self.assertEqual(nbrequests(request).status_code, 304)
+        invalidate_pending_requests()
+        self.assertEqual(nbrequests(request).status_code, 200)
+
+
+class BulkActionsTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(BulkActionsTestCase, self).setUp()
+        for i in range(10):
+            self.create_message(
+                "mail%02d" % i, "sender@ext.com",
+                ["user@test.com", "user2@test.com"], rs="p",
+                content="S" if i % 2 else "V"
+            )
+
+    def get_status(self, address, mail_id):
+        return Msgrcpt.objects.get(rid__email=address, mail=mail_id).rs
+
+    def test_set_messages_status(self):
+        wrapper = get_wrapper()
+        selection = [("user@test.com", "mail%02d" % i) for i in range(5)]
+        selection += [("user2@test.com", "mail09"),
+                      ("unknown@test.com", "mail09")]
+        self.assertEqual(wrapper.set_messages_status(selection, "D"), 6)
+        self.assertEqual(self.get_status("user@test.com", "mail00"), "D")
+        self.assertEqual(self.get_status("user2@test.com", "mail00"), "p")
+        self.assertEqual(self.get_status("user@test.com", "mail09"), "p")
+        self.assertEqual(self.get_status("user2@test.com", "mail09"), "D")
+        self.assertEqual(Msgrcpt.objects.filter(rs="D").count(), 6)
+        self.assertEqual(wrapper.set_messages_status([], "D"), 0)
+
+    def test_query_count(self):
+        wrapper = get_wrapper()
+        for size in [1, 10]:
+            selection = [("user@test.com", "mail%02d" % i)
+                         for i in range(size)]
+            selection += [("user2@test.com", "mail%02d" % i)
+                          for i in range(size)]
+            # One query to resolve addresses, one UPDATE
+            with self.assertNumQueries(2, using="amavis"):
+                wrapper.set_messages_status(selection, "R")
+
+    def test_get_selected_messages(self):
+        Msgs.objects.filter(mail_id="mail01").update(secret_id="secret")
+        result = get_wrapper().get_selected_messages(
+            [("user2@test.com", "mail01"), ("user@test.com", "unknown")]
+        )
+        self.assertEqual(result, [("user2@test.com", "mail01", "secret")])
+
+
+class FakePDPHandler(SocketServer.StreamRequestHandler):
+    """Minimal amavisd AM.PDP server
+
+    Releases are accepted unless the secret_id is 'bad'. Answers are
+    written one byte at a time to check the client's framing.
+    """
+
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            request = {}
+            while True:
+                line = self.rfile.readline()
+                if line == "":
+                    return
+                if line == "\n":
+                    break
+                name, value = line.rstrip("\n").split("=", 1)
+                request[name] = value
+            self.server.requests.append(request)
+            if request["secret_id"] == "bad":
+                reply = "450%204.5.0%20Failure"
+            else:
+                reply = "250%202.0.0%20Ok,%20id=rel-" + request["mail_id"]
+            answer = "setreply=%s\nreturn_value=dunno\n\n" % reply
+            for c in answer:
+                self.wfile.write(c)
+                self.wfile.flush()
+            if self.server.close_after_answer:
+                return
+
+
+class AMreleaseTestCase(TestCase):
+
+    def setUp(self):
+        Amavis().load()
+        self.server = SocketServer.ThreadingTCPServer(
+            ("127.0.0.1", 0), FakePDPHandler
+        )
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.close_after_answer = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        parameters.save_admin("AM_PDP_MODE", "inet", app="amavis")
+        parameters.save_admin("AM_PDP_HOST", "127.0.0.1", app="amavis")
+        parameters.save_admin(
+            "AM_PDP_PORT", str(self.server.server_address[1]), app="amavis"
+        )
+
+    def tearDown(self):
+        AMrelease.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pipelined_requests(self):
+        result = AMrelease().sendreqs([
+            ("mail01", "secret", "user@test.com"),
+            ("mail02", "bad", "user@test.com"),
+            ("mail03", "secret", "user+tag@test.com")
+        ])
+        self.assertEqual(result, [True, False, True])
+        self.assertTrue(AMrelease().sendreq("mail04", "secret", "u@test.com"))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            [r["mail_id"] for r in self.server.requests],
+            ["mail01", "mail02", "mail03", "mail04"]
+        )
+        self.assertEqual(self.server.requests[2]["recipient"],
+                         "user+tag@test.com")
+
+    def test_decode(self):
+        self.assertEqual(AMrelease().decode("250%202.0.0%20Ok%25"),
+                         "250 2.0.0 Ok%")
+
+    def test_reconnect(self):
+        self.server.close_after_answer = True
+        amr = AMrelease()
+        self.assertTrue(amr.sendreq("mail01", "secret", "user@test.com"))
+        # The server has closed the connection
+        self.assertTrue(amr.sendreq("mail02", "secret", "user@test.com"))
+        self.assertEqual(self.server.connections, 2)
+
+
+class QcleanupTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(QcleanupTestCase, self).setUp()
+        for i in range(5):
+            self.create_message("marked%d" % i, "sender@ext.com",
+                                ["deleted%d@test.com" % i], rs="D")
+        msg = self.create_message("partial", "sender@ext.com",
+                                  ["user@test.com", "user2@test.com"],
+                                  rs="D")
+        Msgrcpt.objects.filter(mail=msg, rid__email="user2@test.com") \
+            .update(rs="p")
+        self.create_message("released", "sender@ext.com",
+                            ["user@test.com"], rs="R")
+        self.create_message("old", "sender2@ext.com",
+                            ["old@test.com"], time_num=1000)
+
+    def test_cleanup(self):
+        call_command("qcleanup", batch_size=2)
+        self.assertEqual(
+            sorted(Msgs.objects.values_list("mail_id", flat=True)),
+            ["partial", "released"]
+        )
+        self.assertEqual(Msgrcpt.objects.count(), 3)
+        self.assertEqual(Quarantine.objects.count(), 2)
+        self.assertEqual(
+            sorted(Maddr.objects.values_list("email", flat=True)),
+            ["sender@ext.com", "user2@test.com", "user@test.com"]
+        )
+
+
+class QuarantinedMessageTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(QuarantinedMessageTestCase, self).setUp()
+        msg = self.create_message("mail01", "sender@ext.com",
+                                  ["user@test.com"])
+        Quarantine.objects.filter(mail=msg).delete()
+        content = "From: sender@ext.com\r\nSubject: Big\r\n\r\n" \
+            + "x" * 1000
+        # Chunks are stored out of order and the header/body
+        # separator is split between two of them
+        for ind, start, end in [(3, 40, 1042), (1, 0, 36), (2, 36, 40)]:
+            Quarantine.objects.create(
+                mail=msg, chunk_ind=ind, mail_text=content[start:end]
+            )
+
+    def test_read(self):
+        msg = get_quarantined_message("mail01")
+        self.assertEqual(msg["Subject"], "Big")
+        self.assertEqual(msg.get_payload(), "x" * 1000)
+        self.assertFalse(msg.truncated)
+
+    def test_headers_only(self):
+        msg = get_quarantined_message("mail01", headers_only=True)
+        self.assertEqual(msg.items(), [("From", "sender@ext.com"),
+                                       ("Subject", "Big")])
+        self.assertEqual(msg.get_payload(), "")
+
+    def test_max_size(self):
+        msg = get_quarantined_message("mail01", max_size=140)
+        self.assertTrue(msg.truncated)
+        self.assertEqual(msg.get_payload(), "x" * 102)
+
+
+# Extension URLs are only loaded when the extension is enabled
+urlpatterns = patterns(
+    '', (r'^quarantine/', include('modoboa.extensions.amavis.urls'))
+)
+
+
+class SearchIndexTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(SearchIndexTestCase, self).setUp()
+        Amavis().load()
+        self.create_message("mail01", "bob@ext.com", ["user@test.com"],
+                            time_num=1000)
+        self.create_message("mail02", "alice@spam.org",
+                            ["user2@test.com", "user@test2.com"],
+                            time_num=1001)
+        Msgs.objects.filter(mail_id="mail01").update(
+            subject="Cheap watches", spam_level=12.5, client_addr="1.2.3.4",
+            message_id="<abc@ext.com>"
+        )
+        Msgs.objects.filter(mail_id="mail02").update(spam_level=3.1)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.index = SearchIndex(self.path)
+        self.index.create()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_search(self):
+        self.assertEqual(self.index.update(), 2)
+        self.assertEqual(self.index.search(["from_addr"], "bob"), ["mail01"])
+        self.assertEqual(self.index.search(["subject"], "watch"), ["mail01"])
+        self.assertEqual(self.index.search(["to"], "user@test2.com"),
+                         ["mail02"])
+        self.assertEqual(
+            self.index.search(["from_addr", "subject", "to"], "test"),
+            ["mail02", "mail01"]
+        )
+        self.assertEqual(self.index.search(["message_id"], "abc@ext.com"),
+                         ["mail01"])
+        self.assertEqual(self.index.search(["client_addr"], "1.2.3.4"),
+                         ["mail01"])
+        self.assertEqual(self.index.search(["score"], "2-5"), ["mail02"])
+        self.assertEqual(self.index.search(["score"], ">10"), ["mail01"])
+        self.assertEqual(self.index.search(["score"], "foo"), [])
+
+    def test_non_ascii_message_id(self):
+        Msgs.objects.filter(mail_id="mail02").update(
+            message_id=u"<caf\xe9@spam.org>"
+        )
+        self.assertEqual(self.index.update(), 2)
+        self.assertEqual(
+            self.index.search(["message_id"], u"caf\xe9@spam.org"),
+            ["mail02"]
+        )
+        self.assertEqual(
+            self.index.search(["message_id"], "caf\xc3\xa9@spam.org"),
+            ["mail02"]
+        )
+
+    def test_incremental_update(self):
+        self.index.update()
+        self.create_message("mail03", "bob@ext.com", ["user@test.com"],
+                            time_num=1002)
+        self.assertEqual(self.index.update(), 1)
+        self.assertEqual(self.index.search(["from_addr"], "bob"),
+                         ["mail03", "mail01"])
+        self.assertEqual(self.index.prune(1001), 1)
+        self.assertEqual(self.index.search(["from_addr"], "bob"),
+                         ["mail03"])
+
+    def test_command(self):
+        self.assertIsNone(get_search_index())
+        parameters.save_admin("SEARCH_INDEX", self.path, app="amavis")
+        parameters.save_admin("MAX_MESSAGES_AGE", "100000", app="amavis")
+        call_command("amsearchindex")
+        self.assertEqual(get_search_index().search(["from_addr"], "alice"),
+                         ["mail02"])
+
+    def test_parse_score_range(self):
+        self.assertEqual(parse_score_range("1.5 - 3"), (1.5, 3))
+        self.assertEqual(parse_score_range("<2"), (None, 2))
+        self.assertEqual(parse_score_range("5"), (5, None))
+
+    def test_batches(self):
+        for i in range(3, 8):
+            self.create_message("mail%02d" % i, "bob@ext.com",
+                                ["user@test.com"], time_num=1000 + i)
+        Msgrcpt.objects.filter(mail="mail05").update(rs="D")
+        self.index.update()
+        search = IndexSearch(self.index, ["from_addr"], "bob", batch_size=2)
+        qset = Quarantine.objects.filter(chunk_ind=1, mail__msgrcpt__rs=" ")
+        self.assertEqual(search.count(qset), 5)
+        self.assertFalse(search.truncated)
+        rows, resume = search.rows(qset, 3)
+        self.assertEqual([row[1] for row in rows],
+                         ["mail07", "mail06", "mail04"])
+        self.assertIsNone(resume)
+        rows, resume = search.rows(qset, 10, (1004, "mail04"), True)
+        self.assertEqual([row[1] for row in rows], ["mail06", "mail07"])
+        self.assertIsNone(resume)
+
+    def test_limits(self):
+        for i in range(3, 8):
+            self.create_message("mail%02d" % i, "bob@ext.com",
+                                ["user@test.com"], time_num=1000 + i)
+        Msgrcpt.objects.filter(mail="mail05").update(rs="D")
+        self.index.update()
+        qset = Quarantine.objects.filter(chunk_ind=1, mail__msgrcpt__rs=" ")
+        search = IndexSearch(self.index, ["from_addr"], "bob", batch_size=2,
+                             max_batches=2, max_count=2)
+        self.assertEqual(search.count(qset), 2)
+        self.assertTrue(search.truncated)
+        # The scan stops after 2 batches (mail07 to mail04)
+        rows, resume = search.rows(qset, 10)
+        self.assertEqual([row[1] for row in rows],
+                         ["mail07", "mail06", "mail04"])
+        self.assertEqual(resume, (1004, "mail04"))
+        rows, resume = search.rows(qset, 10, resume)
+        self.assertEqual([row[1] for row in rows], ["mail03", "mail01"])
+        self.assertIsNone(resume)
+
+    def test_resumed_pages(self):
+        for i in range(3, 8):
+            self.create_message("mail%02d" % i, "bob@ext.com",
+                                ["user@test.com"], time_num=1000 + i)
+        Msgrcpt.objects.filter(mail__in=["mail04", "mail05"]).update(rs="D")
+        self.index.update()
+        search = IndexSearch(self.index, ["from_addr"], "bob", batch_size=2,
+                             max_batches=1)
+        connector = SQLconnector(None, Q(mail__msgrcpt__rs=" "), search)
+        connector.messages_count(order="-date")
+        pages = []
+        cursor = None
+        while True:
+            emails, prev_cursor, cursor = connector.seek(cursor, 3)
+            pages.append([email["mailid"] for email in emails])
+            if cursor is None:
+                break
+        # The second page is empty: mail05 and mail04 are deleted
+        self.assertEqual(pages, [["mail07", "mail06"], [],
+                                 ["mail03", "mail01"]])
+        # Going back
+        pages = []
+        while prev_cursor is not None:
+            emails, prev_cursor, cursor = connector.seek(prev_cursor, 3)
+            pages.append([email["mailid"] for email in emails])
+        self.assertEqual(pages, [[], ["mail07", "mail06"]])
+
+
+class ListingSearchTestCase(AmavisTestCase):
+    fixtures = ["initial_users.json"]
+    urls = "modoboa.extensions.amavis.tests"
+
+    def setUp(self):
+        super(ListingSearchTestCase, self).setUp()
+        Amavis().load()
+        Extension.objects.create(name="amavis", enabled=True)
+        self.clt = Client()
+        self.clt.login(username="admin", password="password")
+        for i in range(1, 13):
+            self.create_message("mail%02d" % i, "bob@ext.com",
+                                ["user@test.com"], time_num=1000 + i)
+        Msgs.objects.filter(mail_id="mail01").update(
+            spam_level=12.5, client_addr="1.2.3.4",
+            message_id="<abc@ext.com>"
+        )
+        Msgs.objects.filter(mail_id="mail02").update(
+            from_addr="alice@spam.org", spam_level=3.1
+        )
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def search(self, criteria, pattern, status="ok", **params):
+        params.update(criteria=criteria, pattern=pattern)
+        response = self.clt.get(
+            "/quarantine/listing/", params,
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        content = simplejson.loads(response.content)
+        self.assertEqual(content["status"], status)
+        return content
+
+    def get_ids(self, content):
+        return re.findall(r'<tr id="(\w+)"', content.get("listing", ""))
+
+    def check_searches(self):
+        ids = self.get_ids(self.search("message_id", "abc@ext.com"))
+        self.assertEqual(ids, ["mail01"])
+        ids = self.get_ids(self.search("message_id", u"caf\xe9@ext.com"))
+        self.assertEqual(ids, [])
+        ids = self.get_ids(self.search("client_addr", "1.2.3.4"))
+        self.assertEqual(ids, ["mail01"])
+        ids = self.get_ids(self.search("score", "2-5"))
+        self.assertEqual(ids, ["mail02"])
+        ids = self.get_ids(self.search("from_addr", "alice@spam.org"))
+        self.assertEqual(ids, ["mail02"])
+
+    def test_search_without_index(self):
+        self.check_searches()
+        self.search("score", "foo", "ko")
+        self.search("unknown", "foo", "ko")
+
+    def test_search_with_index(self):
+        parameters.save_admin("SEARCH_INDEX", self.path, app="amavis")
+        index = SearchIndex(self.path)
+        index.create()
+        index.update()
+        self.check_searches()
+        self.assertEqual(self.get_ids(self.search("score", "foo")), [])
+
+        # Pages are read from the index
+        parameters.save_user(User.objects.get(username="admin"),
+                             "MESSAGES_PER_PAGE", 10, app="amavis")
+        content = self.search("from_addr", "bob")
+        ids = self.get_ids(content)
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(ids[0], "mail12")
+        cursor = re.search(r"cursor=(\w+)", content["navbar"]).group(1)
+        content = self.search("from_addr", "bob", cursor=cursor)
+        self.assertEqual(self.get_ids(content), ["mail01"])
+
+
+class FakeSMTPChannel(smtpd.SMTPChannel):
+    """SMTP session which can be closed before its second message"""
+
+    drop = False
+    mails = 0
+
+    def smtp_MAIL(self, arg):
+        self.mails += 1
+        if self.drop and self.mails > 1:
+            self.close()
+            return
+        smtpd.SMTPChannel.smtp_MAIL(self, arg)
+
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """SMTP server storing received messages"""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.connections = 0
+        self.messages = []
+        self.drop_sessions = False
+
+    def handle_accept(self):
+        self.connections += 1
+        conn, addr = self.accept()
+        channel = FakeSMTPChannel(self, conn, addr)
+        channel.drop = self.drop_sessions
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+
+class AmnotifyTestCase(AmavisTestCase):
+    fixtures = ["initial_users.json"]
+    urls = "modoboa.extensions.amavis.tests"
+
+    def setUp(self):
+        super(AmnotifyTestCase, self).setUp()
+        factories.populate_database()
+        self.create_message("mail01", "sender@ext.com",
+                            ["user@test.com", "admin@test.com"], rs="p")
+        self.create_message("mail02", "sender@ext.com",
+                            ["user@test2.com"], rs="p")
+        self.create_message("mail03", "sender@ext.com", ["user@test.com"])
+        self.server = FakeSMTPServer()
+        self.thread = threading.Thread(
+            target=asyncore.loop, kwargs={"timeout": 0.1}
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.thread.join()
+
+    def call(self, **options):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command(
+                "amnotify", baseurl="http://localhost",
+                smtp_host="127.0.0.1",
+                smtp_port=self.server.socket.getsockname()[1],
+                **options
+            )
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_count_by_domain(self):
+        self.assertEqual(get_wrapper().count_pending_requests_by_domain(),
+                         {"test.com": 2, "test2.com": 1})
+
+    def test_notify(self):
+        # One grouped count + one sample query per domain
+        self.assertEqual(self.count_queries(self.call), 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            sorted([rcpts for rcpts, data in self.server.messages]),
+            [["admin@test.com"], ["admin@test2.com"]]
+        )
+        for rcpts, data in self.server.messages:
+            if rcpts == ["admin@test.com"]:
+                self.assertIn("2 release requests are pending", data)
+
+    def test_notify_superadmin(self):
+        factories.MailboxFactory(
+            address="sadmin", domain=Domain.objects.get(name="test.com"),
+            user=User.objects.get(username="admin")
+        )
+        # One global sample query is shared by super administrators
+        self.assertEqual(self.count_queries(self.call), 4)
+        self.assertEqual(len(self.server.messages), 3)
+        for rcpts, data in self.server.messages:
+            if rcpts == ["sadmin@test.com"]:
+                self.assertIn("3 release requests are pending", data)
+
+    def test_dropped_session(self):
+        self.server.drop_sessions = True
+        output = self.call()
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(output, "")
+
+    def test_concurrent_run(self):
+        lockfile = tempfile.NamedTemporaryFile()
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            with self.assertRaises(CommandError):
+                self.call(lock_file=lockfile.name)
+        finally:
+            lockfile.close()
+        self.assertEqual(self.server.messages, [])
+
+    def test_dry_run(self):
+        output = self.call(dry_run=True)
+        self.assertEqual(self.server.messages, [])
+        self.assertIn("Sending notification to admin@test.com (2 request(s))",
+                      output)
+        self.assertIn("2 notification(s), 3 pending request(s) in 2 domain(s)",
+                      output)
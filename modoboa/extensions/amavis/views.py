@@ -1,5 +1,4 @@
 # coding: utf-8
-import email
 from django.shortcuts import render
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.template import Template, Context
@@ -9,6 +8,8 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators \
     import login_required, user_passes_test
 from django.db.models import Q
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import etag
 from modoboa.lib import parameters
 from modoboa.lib.exceptions import ModoboaException
 from modoboa.lib.webutils import (
@@ -17,10 +18,19 @@ from modoboa.lib.webutils import (
 from modoboa.lib.email_listing import parse_search_parameters
 from modoboa.extensions.admin.models import Mailbox, Domain
 from templatetags.amavis_tags import quar_menu, viewm_menu
-from .lib import selfservice, AMrelease
-from .sql_listing import SQLlisting, SQLemail, get_wrapper
+from .lib import (
+    selfservice, AMrelease, get_pending_requests, invalidate_pending_requests,
+    get_quarantined_message
+)
+from .sql_listing import SQLlisting, SQLemail, IndexSearch, get_wrapper
+from .search import (
+    CRITERIA, get_search_index, normalize_message_id, parse_score_range
+)
 from .models import Msgrcpt
 
+# Quarantined messages can be huge, don't display more than 2MB
+MAX_DISPLAYED_SIZE = 2 * 1024 * 1024
+
 
 def __back_to_listing(request):
     """Return the current listing URL.
@@ -33,8 +43,9 @@ def __back_to_listing(request):
     """
     url = "listing"
     params = []
-    if "page" in request.session:
-        params += ["page=%s" % request.session["page"]]
+    for p in ["page", "cursor"]:
+        if p in request.session:
+            params += ["%s=%s" % (p, request.session[p])]
 
     params += ["%s=%s" % (p, request.session[p])
                for p in ["criteria", "pattern"] if p in request.session]
@@ -50,6 +61,33 @@ def empty_quarantine(request):
     return HttpResponse(simplejson.dumps(ctx), mimetype="application/json")
 
 
+def search_filter(criteria, pattern):
+    """Return the filter applied to the messages for a search criteria
+
+    Used when the search index is not available.
+
+    :rtype: ``Q`` object
+    """
+    if criteria == "from_addr":
+        return Q(mail__from_addr__contains=pattern)
+    if criteria == "subject":
+        return Q(mail__subject__contains=pattern)
+    if criteria == "message_id":
+        msgid = normalize_message_id(pattern)
+        return Q(mail__message_id__in=[msgid, "<%s>" % msgid])
+    if criteria == "client_addr":
+        return Q(mail__client_addr=pattern.strip())
+    scorerange = parse_score_range(pattern)
+    if scorerange is None:
+        raise ModoboaException(_("Invalid spam score range"))
+    flt = Q()
+    if scorerange[0] is not None:
+        flt &= Q(mail__spam_level__gte=scorerange[0])
+    if scorerange[1] is not None:
+        flt &= Q(mail__spam_level__lte=scorerange[1])
+    return flt
+
+
 @login_required
 def _listing(request):
     flt = None
@@ -66,20 +104,26 @@ def _listing(request):
     request.session["navparams"]["order"] = order
 
     parse_search_parameters(request)
+    search = None
     if "pattern" in request.session:
+        pattern = request.session["pattern"]
         criteria = request.session["criteria"]
         if criteria == "both":
             criteria = "from_addr,subject,to"
-        for c in criteria.split(","):
-            if c == "from_addr":
-                nfilter = Q(mail__from_addr__contains=request.session["pattern"])
-            elif c == "subject":
-                nfilter = Q(mail__subject__contains=request.session["pattern"])
-            elif c == "to":
-                rcptfilter = request.session["pattern"]
+        criteria = filter(None, criteria.split(","))
+        for c in criteria:
+            if not c in CRITERIA:
+                raise ModoboaException(_("Unsupported search criteria"))
+        index = get_search_index()
+        if index is not None and order[1:] == "date":
+            # Results are read from the index, page by page
+            search = IndexSearch(index, criteria, pattern)
+            criteria = []
+        for c in criteria:
+            if c == "to":
+                rcptfilter = pattern
                 continue
-            else:
-                raise Exception("unsupported search criteria %s" % c)
+            nfilter = search_filter(c, pattern)
             flt = nfilter if flt is None else flt | nfilter
 
     msgs = get_wrapper().get_mails(request, rcptfilter)
@@ -91,17 +135,22 @@ def _listing(request):
         if "page" in request.session:
             del request.session["page"]
         pageid = 1
+    cursor = request.GET.get("cursor", None)
+    if cursor:
+        request.session["cursor"] = cursor
+    elif "cursor" in request.session:
+        del request.session["cursor"]
 
     lst = SQLlisting(
-        request.user, msgs, flt,
+        request.user, msgs, flt, search,
         navparams=request.session["navparams"],
         elems_per_page=int(parameters.get_user(request.user, "MESSAGES_PER_PAGE"))
     )
-    page = lst.paginator.getpage(pageid)
+    page = lst.getpage(pageid, cursor)
     if not page:
         return empty_quarantine(request)
 
-    content = lst.fetch(request, page.id_start, page.id_stop)
+    content = lst.fetch_page(request, page)
     navbar = lst.render_navbar(page, "listing/?")
     ctx = getctx("ok", listing=content, navbar=navbar,
                  menu=quar_menu(request.user))
@@ -115,31 +164,29 @@ def index(request):
     ))
 
 
-def getmailcontent_selfservice(request, mail_id):
-    qmails = get_wrapper().get_mail_content(mail_id)
-    content = ""
-    for qm in qmails:
-        content += qm.mail_text
-    msg = email.message_from_string(content)
+def render_mailcontent(request, mail_id):
+    """Render the content of a quarantined message
+
+    Only the first MAX_DISPLAYED_SIZE bytes of the message are read.
+    """
+    msg = get_quarantined_message(mail_id, max_size=MAX_DISPLAYED_SIZE)
     mail = SQLemail(msg, mformat="plain", links="0")
+    body = mail.body
+    if msg.truncated:
+        body += "<p><em>%s</em></p>" % _("Message truncated")
     return render(request, "common/viewmail.html", {
         "headers": mail.render_headers(),
-        "mailbody": mail.body
+        "mailbody": body
     })
 
 
+def getmailcontent_selfservice(request, mail_id):
+    return render_mailcontent(request, mail_id)
+
+
 @selfservice(getmailcontent_selfservice)
 def getmailcontent(request, mail_id):
-    qmails = get_wrapper().get_mail_content(mail_id)
-    content = ""
-    for qm in qmails:
-        content += qm.mail_text
-    msg = email.message_from_string(content)
-    mail = SQLemail(msg, mformat="plain", links="0")
-    return render(request, "common/viewmail.html", {
-        "headers": mail.render_headers(),
-        "mailbody": mail.body
-    })
+    return render_mailcontent(request, mail_id)
 
 
 def viewmail_selfservice(request, mail_id,
@@ -168,6 +215,8 @@ def viewmail(request, mail_id):
         mb = Mailbox.objects.get(user=request.user)
         if not rcpt or rcpt == mb.full_address:
             msgrcpt = get_wrapper().get_recipient_message(mb.full_address, mail_id)
+            if msgrcpt.rs == 'p':
+                invalidate_pending_requests()
             msgrcpt.rs = 'V'
             msgrcpt.save()
 
@@ -181,10 +230,7 @@ def viewmail(request, mail_id):
 
 @login_required
 def viewheaders(request, mail_id):
-    content = ""
-    for qm in get_wrapper().get_mail_content(mail_id):
-        content += qm.mail_text
-    msg = email.message_from_string(content)
+    msg = get_quarantined_message(mail_id, headers_only=True)
     return render(request, 'amavis/viewheader.html', {
         "headers": msg.items()
     })
@@ -199,6 +245,20 @@ def check_mail_id(request, mail_id):
     return mail_id
 
 
+def get_selection(request, mail_id):
+    """Return the (recipient, mail_id) pairs selected by the user
+
+    Simple users can only act on their own messages.
+
+    :param mail_id: a list of identifiers (see ``check_mail_id``)
+    :return: a list of (address, mail_id) tuples
+    """
+    if request.user.group == 'SimpleUsers':
+        mb = Mailbox.objects.get(user=request.user)
+        return [(mb.full_address, mid.split()[-1]) for mid in mail_id]
+    return [tuple(mid.split()) for mid in mail_id]
+
+
 def delete_selfservice(request, mail_id):
     rcpt = request.GET.get("rcpt", None)
     if rcpt is None:
@@ -209,26 +269,15 @@ def delete_selfservice(request, mail_id):
         msgrcpt.save()
     except Msgrcpt.DoesNotExist:
         raise ModoboaException(_("Invalid request"))
+    invalidate_pending_requests()
     return ajax_simple_response(dict(status="ok", respmsg=_("Message deleted")))
 
 
 @selfservice(delete_selfservice)
 def delete(request, mail_id):
     mail_id = check_mail_id(request, mail_id)
-    if request.user.group == 'SimpleUsers':
-        mb = Mailbox.objects.get(user=request.user)
-        msgrcpts = get_wrapper().get_recipient_messages(mb.full_address, mail_id)
-        #msgrcpts.update(rs='D')
-        for msgrcpt in msgrcpts:
-            msgrcpt.rs = 'D'
-            msgrcpt.save()
-    else:
-        wrapper = get_wrapper()
-        for mid in mail_id:
-            r, i = mid.split()
-            msgrcpt = wrapper.get_recipient_message(r, i)
-            msgrcpt.rs = 'D'
-            msgrcpt.save()
+    get_wrapper().set_messages_status(get_selection(request, mail_id), 'D')
+    invalidate_pending_requests()
 
     message = ungettext("%(count)d message deleted successfully",
                         "%(count)d messages deleted successfully",
@@ -255,51 +304,44 @@ def release_selfservice(request, mail_id):
         amr = AMrelease()
         result = amr.sendreq(mail_id, secret_id, rcpt)
         if result:
-            rcpt.rs = 'R'
+            msgrcpt.rs = 'R'
             msg = _("Message released")
         else:
             raise ModoboaException(result)
     msgrcpt.save()
+    invalidate_pending_requests()
     return ajax_simple_response(dict(status="ok", respmsg=msg))
 
 
 @selfservice(release_selfservice)
 def release(request, mail_id):
     mail_id = check_mail_id(request, mail_id)
-    if request.user.group == 'SimpleUsers':
-        mb = Mailbox.objects.get(user=request.user)
-        msgrcpts = get_wrapper().get_recipient_messages(mb.full_address, mail_id)
-        if parameters.get_admin("USER_CAN_RELEASE") == "no":
-            # FIXME : can't use this syntax because extra SQL (using
-            # .extra() for postgres) is not propagated (the 'tables'
-            # parameter is lost somewhere...)
-            #
-            # msgrcpts.update(rs='p')
-            for msgrcpt in msgrcpts:
-                msgrcpt.rs = 'p'
-                msgrcpt.save()
-            message = ungettext("%(count)d request sent",
-                                "%(count)d requests sent",
-                                len(mail_id)) % {"count": len(mail_id)}
-            return ajax_response(request, "ok", respmsg=message,
-                                 url=__back_to_listing(request))
-    else:
-        msgrcpts = []
-        wrapper = get_wrapper()
-        for mid in mail_id:
-            r, i = mid.split()
-            msgrcpts += [wrapper.get_recipient_message(r, i)]
+    wrapper = get_wrapper()
+    selection = get_selection(request, mail_id)
+    if request.user.group == 'SimpleUsers' and \
+            parameters.get_admin("USER_CAN_RELEASE") == "no":
+        wrapper.set_messages_status(selection, 'p')
+        invalidate_pending_requests()
+        message = ungettext("%(count)d request sent",
+                            "%(count)d requests sent",
+                            len(mail_id)) % {"count": len(mail_id)}
+        return ajax_response(request, "ok", respmsg=message,
+                             url=__back_to_listing(request))
 
-    amr = AMrelease()
+    messages = wrapper.get_selected_messages(selection)
+    released = []
     error = None
-    for rcpt in msgrcpts:
-        result = amr.sendreq(rcpt.mail.mail_id, rcpt.mail.secret_id, rcpt.rid.email)
-        if result:
-            rcpt.rs = 'R'
-            rcpt.save()
-        else:
-            error = result
-            break
+    if messages:
+        results = AMrelease().sendreqs(
+            [(mid, secret_id, address) for address, mid, secret_id in messages]
+        )
+        for msg, result in zip(messages, results):
+            if result:
+                released.append(msg[:2])
+            elif error is None:
+                error = _("Failed to release message %s") % msg[1]
+    wrapper.set_messages_status(released, 'R')
+    invalidate_pending_requests()
 
     if not error:
         message = ungettext("%(count)d message released successfully",
@@ -325,8 +367,20 @@ def process(request):
         return delete(request, ids)
 
 
+def nbrequests_etag(request):
+    return "%s-%s" % get_pending_requests(request.user)
+
+
 @login_required
 @user_passes_test(lambda u: u.group != 'SimpleUsers')
+@etag(nbrequests_etag)
 def nbrequests(request):
-    result = get_wrapper().get_pending_requests(request.user)
-    return ajax_simple_response(dict(status="ok", requests=result))
+    """Return the number of pending requests (called by a poller)
+
+    Browsers must revalidate the answer each time: the ETag lets them
+    receive a 304 while the counter doesn't change.
+    """
+    result = get_pending_requests(request.user)[1]
+    response = ajax_simple_response(dict(status="ok", requests=result))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -27,9 +27,9 @@ def check_limit(user, lname):
         pass
 
 
-def inc_limit(user, lname):
+def inc_limit(user, lname, nb=1):
     try:
-        user.limitspool.inc_curvalue(lname)
+        user.limitspool.inc_curvalue(lname, nb)
     except LimitsPool.DoesNotExist:
         pass
 
@@ -100,8 +100,12 @@ def dec_nb_domaliases(domainaliases):
 
 
 @events.observe('CreateMailbox')
-def inc_nb_mailboxes(user, mailbox):
-    inc_limit(user, 'mailboxes_limit')
+def inc_nb_mailboxes(user, mailboxes):
+    from modoboa.extensions.admin.models import Mailbox
+
+    if isinstance(mailboxes, Mailbox):
+        mailboxes = [mailboxes]
+    inc_limit(user, 'mailboxes_limit', len(mailboxes))
 
 
 @events.observe('DeleteMailbox')
@@ -132,17 +136,26 @@ def can_create_new_object(user, objtype):
 
 
 @events.observe("AccountCreated")
-def create_pool(user):
-    owner = get_object_owner(user)
-    if not owner.is_superuser and \
-       not owner.belongs_to_group("Resellers"):
-        return
-
-    if user.belongs_to_group("DomainAdmins"):
-        check_limit(owner, 'domain_admins_limit')
-        inc_limit(owner, 'domain_admins_limit')
+def create_pool(users):
+    from modoboa.core.models import User
+
+    if isinstance(users, User):
+        users = [users]
+    # Only administrators need a pool
+    admins = User.objects.filter(
+        pk__in=[user.id for user in users],
+        groups__name__in=["DomainAdmins", "Resellers"]
+    )
+    for user in admins:
+        owner = get_object_owner(user)
+        if not owner.is_superuser and \
+           not owner.belongs_to_group("Resellers"):
+            continue
+
+        if user.belongs_to_group("DomainAdmins"):
+            check_limit(owner, 'domain_admins_limit')
+            inc_limit(owner, 'domain_admins_limit')
 
-    if user.group in ["DomainAdmins", "Resellers"]:
         p = LimitsPool(user=user)
         p.save()
         p.create_limits()
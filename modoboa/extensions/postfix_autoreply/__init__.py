@@ -107,12 +107,18 @@ def onDeleteDomain(domain):
 
 
 @events.observe("CreateMailbox")
-def onCreateMailbox(user, mailbox):
-    alias = Alias()
-    alias.full_address = mailbox.full_address
-    alias.autoreply_address = \
-        "%s@autoreply.%s" % (mailbox.full_address, mailbox.domain.name)
-    alias.save()
+def onCreateMailbox(user, mailboxes):
+    from modoboa.extensions.admin.models import Mailbox
+
+    if isinstance(mailboxes, Mailbox):
+        mailboxes = [mailboxes]
+    Alias.objects.bulk_create([
+        Alias(full_address=mailbox.full_address,
+              autoreply_address="%s@autoreply.%s" % (
+                  mailbox.full_address, mailbox.domain.name
+              ))
+        for mailbox in mailboxes
+    ])
 
 
 @events.observe("DeleteMailbox")
@@ -22,7 +22,7 @@ class Stats(ModoExtension):
 
     def load(self):
         from modoboa.extensions.stats.app_settings import ParametersForm
-        events.declare(["GetGraphSets"])
+        events.declare(["GetGraphSets", "GetLogHandlers"])
         parameters.register(
             ParametersForm, ugettext_lazy("Graphical statistics")
         )
@@ -2,7 +2,7 @@
 from django.utils.translation import ugettext_lazy
 from django import forms
 from modoboa.lib.parameters import AdminParametersForm
-from modoboa.lib.formutils import SeparatorField
+from modoboa.lib.formutils import SeparatorField, InlineRadioSelect
 
 
 class ParametersForm(AdminParametersForm):
@@ -10,6 +10,19 @@ class ParametersForm(AdminParametersForm):
 
     general_sep = SeparatorField(label=ugettext_lazy("General"))
 
+    storage_backend = forms.ChoiceField(
+        label=ugettext_lazy("Storage backend"),
+        choices=[("rrd", ugettext_lazy("RRD files")),
+                 ("sql", ugettext_lazy("Database"))],
+        initial="rrd",
+        help_text=ugettext_lazy(
+            "Where statistics are stored. Graphics can only be generated "
+            "with RRD files, the database can be shared between several "
+            "servers"
+        ),
+        widget=InlineRadioSelect
+    )
+
     logfile = forms.CharField(
         label=ugettext_lazy("Path to the log file"),
         initial="/var/log/mail.log",
@@ -27,3 +40,8 @@ class ParametersForm(AdminParametersForm):
         initial="/tmp/modoboa",
         help_text=ugettext_lazy("Path to directory where PNG files are stored")
     )
+
+    visibility_rules = {
+        "rrd_rootdir": "storage_backend=rrd",
+        "img_rootdir": "storage_backend=rrd"
+    }
@@ -0,0 +1,403 @@
+# coding: utf-8
+"""
+Time-series storage backends.
+
+Statistics collected by the log parser are stored using one of the
+following backends:
+
+* ``RRDBackend``: one RRD file per series, stored inside a local
+  directory (the historical behaviour),
+* ``SQLBackend``: per-minute counters stored inside the database, with
+  hourly and daily rollups. Useful when the parser and the web
+  interface don't share a filesystem.
+
+A series is identified by its *target* (a domain name or 'global').
+"""
+import os
+import glob
+import time
+from django.db import connection, transaction
+from django.db.models import Sum, Max
+from modoboa.lib import parameters
+from modoboa.lib.dbutils import bulk_create
+
+rrdstep = 60
+xpoints = 540
+points_per_sample = 3
+variables = ["sent", "recv", "bounced", "reject", "spam", "virus",
+             "size_sent", "size_recv"]
+
+
+class StatsBackend(object):
+    """Base class for storage backends."""
+
+    def __init__(self, verbose=False, debug=False):
+        self.verbose = verbose
+        self.debug = debug
+
+    def write(self, target, samples):
+        """Store new samples
+
+        Samples older than the last update of the series are ignored.
+
+        :param target: the series name
+        :param samples: a dictionary {timestamp: {variable: value}}
+        :return: the number of samples actually written
+        """
+        raise NotImplementedError
+
+    def read(self, targets, variables, start, end, cf="AVERAGE", step=None):
+        """Read values over a time range
+
+        When several targets are given, their series are summed
+        element-wise. Values are per-minute rates.
+
+        :param targets: list of series names
+        :param variables: list of variables to read
+        :param start: range start (timestamp)
+        :param end: range end (timestamp)
+        :param cf: consolidation function ('AVERAGE' or 'MAX')
+        :param step: wanted resolution in seconds (optional)
+        :return: a dictionary (start, end, step, data) or None
+        """
+        raise NotImplementedError
+
+    def last_update(self, target):
+        """Return the timestamp of the last sample of a series (or None)."""
+        raise NotImplementedError
+
+    def list_series(self):
+        """Return the list of known series."""
+        raise NotImplementedError
+
+    def maintenance(self):
+        """Periodic maintenance, run at the end of each parsing."""
+        pass
+
+
+class RRDBackend(StatsBackend):
+    """Store series inside RRD files (one per target)."""
+
+    def __init__(self, rootdir=None, **kwargs):
+        super(RRDBackend, self).__init__(**kwargs)
+        self.rootdir = rootdir if rootdir is not None \
+            else parameters.get_admin("RRD_ROOTDIR", app="stats")
+        self.lupdates = {}
+
+    def get_path(self, target):
+        return "%s/%s.rrd" % (self.rootdir, target)
+
+    def init_rrd(self, fname, m):
+        """init_rrd
+
+        Set-up Data Sources (DS)
+        Set-up Round Robin Archives (RRA):
+        - day,week,month and year archives
+        - 2 types : AVERAGE and MAX
+
+        parameter : start time
+        return    : last epoch recorded
+        """
+        import rrdtool
+
+        ds_type = 'ABSOLUTE'
+        rows = xpoints / points_per_sample
+        realrows = int(rows * 1.1)    # ensure that the full range is covered
+        day_steps = int(3600 * 24 / (rrdstep * rows))
+        week_steps = day_steps * 7
+        month_steps = week_steps * 5
+        year_steps = month_steps * 12
+
+        # Set up data sources for our RRD
+        params = []
+        for v in variables:
+            params += ['DS:%s:%s:%s:0:U' % (v, ds_type, rrdstep * 2)]
+
+        # Set up RRD to archive data
+        for cf in ['AVERAGE', 'MAX']:
+            for step in [day_steps, week_steps, month_steps, year_steps]:
+                params += ['RRA:%s:0.5:%s:%s' % (cf, step, realrows)]
+
+        # With those setup, we can now created the RRD
+        rrdtool.create(str(fname),
+                       '--start', str(m),
+                       '--step', str(rrdstep),
+                       *params)
+        return m
+
+    def update_rrd(self, target, t, counters):
+        """update_rrd
+
+        Update RRD with records at t time.
+
+        True  : if data are up-to-date for current minute
+        False : syslog may have probably been already recorded
+        or something wrong
+        """
+        import rrdtool
+
+        fname = self.get_path(target)
+        m = t - (t % rrdstep)
+        if not os.path.exists(fname):
+            # Start one step earlier so the first sample is recorded
+            self.lupdates[fname] = self.init_rrd(fname, m - rrdstep)
+            if self.debug:
+                print "[rrd] create new RRD file %s" % fname
+        else:
+            if not fname in self.lupdates:
+                self.lupdates[fname] = rrdtool.last(str(fname))
+
+        if m <= self.lupdates[fname]:
+            if self.verbose:
+                print "[rrd] VERBOSE events at %s already recorded in RRD" % m
+            return False
+
+        tpl = ":".join(variables)
+        # Missing some RRD steps
+        # Est ce vraiment nécessaire... ?
+        if m > self.lupdates[fname] + rrdstep:
+            values = ":".join(["0"] * len(variables))
+            for p in range(self.lupdates[fname] + rrdstep, m, rrdstep):
+                if self.verbose:
+                    print "[rrd] VERBOSE update -t %s %s:%s (SKIP)" \
+                        % (tpl, p, values)
+                rrdtool.update(str(fname), "-t", tpl, "%s:%s" % (p, values))
+
+        values = "%s" % m
+        for v in variables:
+            values += ":"
+            values += str(counters[v])
+        if self.verbose:
+            print "[rrd] VERBOSE update -t %s %s" % (tpl, values)
+
+        rrdtool.update(str(fname), "-t", tpl, values)
+        self.lupdates[fname] = m
+        return True
+
+    def write(self, target, samples):
+        nupdates = 0
+        for t in sorted(samples.keys()):
+            if self.update_rrd(target, t, samples[t]):
+                nupdates += 1
+        return nupdates
+
+    def read(self, targets, variables, start, end, cf="AVERAGE", step=None):
+        import rrdtool
+
+        result = None
+        for target in targets:
+            rrdfile = self.get_path(target)
+            if not os.path.exists(rrdfile):
+                continue
+            params = ["--start", str(start), "--end", str(end)]
+            if step is not None:
+                params += ["--step", str(step)]
+            for v in variables:
+                params += [str('DEF:%s=%s:%s:%s' % (v, rrdfile, v, cf)),
+                           str('CDEF:%spm=%s,60,*' % (v, v)),
+                           str('XPORT:%spm:%s' % (v, v))]
+            output = rrdtool.xport(*params)
+            columns = zip(*output["data"]) if output["data"] \
+                else [()] * len(variables)
+            if result is None:
+                result = dict(
+                    start=output["meta"]["start"], end=output["meta"]["end"],
+                    step=output["meta"]["step"],
+                    data=dict((v, list(col))
+                              for v, col in zip(variables, columns))
+                )
+                continue
+            for v, col in zip(variables, columns):
+                result["data"][v] = [
+                    a if b is None else b if a is None else a + b
+                    for a, b in zip(result["data"][v], col)
+                ]
+        return result
+
+    def last_update(self, target):
+        import rrdtool
+
+        rrdfile = self.get_path(target)
+        if not os.path.exists(rrdfile):
+            return None
+        return int(rrdtool.last(str(rrdfile)))
+
+    def list_series(self):
+        return sorted(
+            os.path.basename(path)[:-4]
+            for path in glob.glob("%s/*.rrd" % self.rootdir)
+        )
+
+
+class SQLBackend(StatsBackend):
+    """Store series inside the database (see ``models.Counter``)
+
+    Raw samples (one per minute) are periodically consolidated into
+    hourly and daily rollups. Each level is pruned once older than its
+    retention period.
+    """
+
+    rollups = [3600, 86400]
+    retention = {
+        rrdstep: 2 * 86400,
+        3600: 62 * 86400,
+        86400: 2 * 366 * 86400
+    }
+    batch_size = 1000
+
+    def write(self, target, samples):
+        from .models import Counter
+
+        last = self.last_update(target)
+        rows = []
+        for t in sorted(samples.keys()):
+            m = t - (t % rrdstep)
+            if last is not None and m <= last:
+                if self.verbose:
+                    print "[sql] VERBOSE events at %s already recorded" % m
+                continue
+            rows.append(Counter(
+                target=target, step=rrdstep, timestamp=m, **samples[t]
+            ))
+        bulk_create(Counter, rows, self.batch_size)
+        return len(rows)
+
+    def _select_step(self, start, step):
+        """Return the finest level covering the requested range."""
+        now = int(time.time())
+        levels = [rrdstep] + self.rollups
+        covering = [s for s in levels if now - self.retention[s] <= start]
+        if not covering:
+            return levels[-1]
+        if step is not None:
+            coarser = [s for s in covering if s <= int(step)]
+            if coarser:
+                return coarser[-1]
+        return covering[0]
+
+    def read(self, targets, variables, start, end, cf="AVERAGE", step=None):
+        from .models import Counter
+
+        if not Counter.objects.filter(target__in=targets).exists():
+            return None
+        start, end = int(start), int(end)
+        level = self._select_step(start, step)
+        qset = Counter.objects.filter(
+            target__in=targets, step=level,
+            timestamp__gte=start - start % level, timestamp__lte=end
+        )
+        if level != rrdstep:
+            qset = qset.filter(cf=cf)
+        rows = qset.values("timestamp").annotate(
+            *[Sum(v) for v in variables]
+        ).order_by("timestamp")
+        rows = dict((row["timestamp"], row) for row in rows)
+        # AVERAGE rollups contain sums: convert them to per-minute rates
+        ratio = float(rrdstep) / level \
+            if level != rrdstep and cf == "AVERAGE" else 1
+        result = dict(
+            start=start - start % level, end=end - end % level, step=level,
+            data=dict((v, []) for v in variables)
+        )
+        for t in range(result["start"], result["end"] + level, level):
+            for v in variables:
+                result["data"][v].append(
+                    rows[t]["%s__sum" % v] * ratio if t in rows else None
+                )
+        return result
+
+    def last_update(self, target):
+        from .models import Counter
+
+        return Counter.objects.filter(target=target, step=rrdstep) \
+            .aggregate(Max("timestamp"))["timestamp__max"]
+
+    def list_series(self):
+        from .models import Counter
+
+        return list(
+            Counter.objects.filter(step=rrdstep)
+            .values_list("target", flat=True).distinct().order_by("target")
+        )
+
+    def rollup(self, step, source):
+        """Consolidate the rows of a level into a coarser one
+
+        Only complete slots are consolidated: a slot is complete as
+        soon as the source level contains a more recent sample.
+
+        :param step: the step of the level to fill
+        :param source: the step of the source level
+        :return: the number of created rows
+        """
+        from .models import Counter
+
+        last = Counter.objects.filter(step=step) \
+            .aggregate(Max("timestamp"))["timestamp__max"]
+        newest = Counter.objects.filter(step=source) \
+            .aggregate(Max("timestamp"))["timestamp__max"]
+        if newest is None:
+            return 0
+        first = last + step if last is not None else 0
+        limit = newest - newest % step
+        if first >= limit:
+            return 0
+
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        rows = []
+        for cf, func, srccf in [("AVERAGE", "SUM", "AVERAGE"),
+                                ("MAX", "MAX", "MAX")]:
+            if source == rrdstep:
+                # Raw samples are both averages and maximums
+                srccf = "AVERAGE"
+            cursor.execute(
+                "SELECT %(target)s, %(ts)s - %(ts)s %%%% %(step)d AS slot, "
+                "%(values)s FROM %(table)s "
+                "WHERE %(step_col)s = %%s AND %(cf)s = %%s "
+                "AND %(ts)s >= %%s AND %(ts)s < %%s "
+                "GROUP BY %(target)s, slot" % {
+                    "target": qn("target"), "ts": qn("timestamp"),
+                    "step": step, "step_col": qn("step"), "cf": qn("cf"),
+                    "values": ", ".join(
+                        ["%s(%s)" % (func, qn(v)) for v in variables]
+                    ),
+                    "table": qn(Counter._meta.db_table)
+                }, [source, srccf, first, limit]
+            )
+            for row in cursor.fetchall():
+                values = dict(zip(variables, [int(v or 0) for v in row[2:]]))
+                rows.append(Counter(
+                    target=row[0], step=step, cf=cf, timestamp=int(row[1]),
+                    **values
+                ))
+        bulk_create(Counter, rows, self.batch_size)
+        return len(rows)
+
+    def prune(self):
+        """Remove rows older than the retention period of their level."""
+        from .models import Counter
+
+        now = int(time.time())
+        for step, retention in self.retention.iteritems():
+            Counter.objects.filter(
+                step=step, timestamp__lt=now - retention
+            ).delete()
+
+    @transaction.commit_on_success
+    def maintenance(self):
+        source = rrdstep
+        for step in self.rollups:
+            created = self.rollup(step, source)
+            if self.verbose:
+                print "[sql] VERBOSE %d rows created for step %d" \
+                    % (created, step)
+            source = step
+        self.prune()
+
+
+def get_backend(**kwargs):
+    """Return the storage backend selected in the parameters."""
+    if parameters.get_admin("STORAGE_BACKEND", app="stats") == "sql":
+        return SQLBackend(**kwargs)
+    return RRDBackend(**kwargs)
@@ -2,13 +2,19 @@
 import sys
 import os
 import time
-from django.utils.translation import ugettext as _, ugettext_lazy
+import glob
+import fcntl
+import zlib
+from django.utils.translation import ugettext as _, ugettext_lazy, get_language
 from modoboa.lib import parameters
 
-periods = [{"name": "day", "label": ugettext_lazy("Day")},
-           {"name": "week", "label": ugettext_lazy("Week")},
-           {"name": "month", "label": ugettext_lazy("Month")},
-           {"name": "year", "label": ugettext_lazy("Year")}]
+periods = [{"name": "day", "label": ugettext_lazy("Day"), "delta": 86400},
+           {"name": "week", "label": ugettext_lazy("Week"),
+            "delta": 7 * 86400},
+           {"name": "month", "label": ugettext_lazy("Month"),
+            "delta": 31 * 86400},
+           {"name": "year", "label": ugettext_lazy("Year"),
+            "delta": 365 * 86400}]
 
 
 def str2Time(y, M, d, h="00", m="00", s="00"):
@@ -33,19 +39,113 @@ def str2Time(y, M, d, h="00", m="00", s="00"):
 
 
 class Grapher(object):
+    #: number of lock files shared by all graphs
+    nlocks = 16
+    #: lifetime (in seconds) of graphs rendered for custom periods
+    custom_ttl = 3600
+
     def __init__(self):
         self.rrd_rootdir = parameters.get_admin("RRD_ROOTDIR")
         self.img_rootdir = parameters.get_admin("IMG_ROOTDIR")
 
-    def process(self, target, suffix, start, end, graph_tpl):
+    def last_update(self, target):
+        """Return the last update time of a RRD file
+
+        :param target: the RRD file's name (domain name or 'global')
+        :return: an integer or None if the file doesn't exist
+        """
+        from .backends import RRDBackend
+
+        return RRDBackend(self.rrd_rootdir).last_update(target)
+
+    def cache_key(self, target, suffix, graph_tpl, lastupdate):
+        """Return the key identifying a rendered graph
+
+        A graph only changes when its RRD file receives new samples
+        (or when the language used for legends changes).
+        """
+        return "%s_%s_%s_%s_%s_%d" % (
+            graph_tpl.display_name, target, graph_tpl.cf, suffix,
+            get_language(), lastupdate
+        )
+
+    def get_graph(self, target, suffix, start, end, graph_tpl,
+                  lastupdate=None, custom=False):
+        """Return the path to a graph, rendering it if needed
+
+        Rendered graphs are kept on disk (see ``cache_key``). Lock
+        files (a fixed number of them, shared between graphs) ensure
+        that simultaneous requests for the same graph only render it
+        once.
+
+        Graphs of custom periods are stored in a separate directory
+        and removed after ``custom_ttl`` seconds.
+
+        For predefined periods, *end* can be None: the graph will end
+        at the last RRD update.
+
+        :return: a path or None if the graph can't be generated
+        """
+        if lastupdate is None:
+            lastupdate = self.last_update(target)
+            if lastupdate is None:
+                return None
+        if end is None:
+            end = lastupdate
+        key = self.cache_key(target, suffix, graph_tpl, lastupdate)
+        imgdir = self.img_rootdir
+        if custom:
+            imgdir = os.path.join(imgdir, "custom")
+        path = "%s/%s.png" % (imgdir, key)
+        if os.path.exists(path):
+            return path
+        if not os.path.isdir(imgdir):
+            os.makedirs(imgdir)
+        prefix = key[:key.rindex("_")]
+        lockpath = "%s/.lock%d" % (
+            self.img_rootdir, (zlib.crc32(prefix) & 0xffffffff) % self.nlocks
+        )
+        with open(lockpath, "w") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(path):
+                    tmppath = "%s.%d.tmp" % (path, os.getpid())
+                    self.process(target, suffix, start, end, graph_tpl,
+                                 path=tmppath)
+                    if not os.path.exists(tmppath):
+                        return None
+                    os.rename(tmppath, path)
+                    for oldpath in glob.glob("%s/%s_*.png" % (imgdir, prefix)):
+                        if oldpath != path:
+                            os.unlink(oldpath)
+                    if custom:
+                        self.expire(imgdir, self.custom_ttl)
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+        return path
+
+    def expire(self, imgdir, ttl):
+        """Remove the graphs of a directory older than *ttl* seconds"""
+        limit = time.time() - ttl
+        for path in glob.glob("%s/*.png" % imgdir):
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+            except OSError:
+                # Already removed by another process
+                pass
+
+    def process(self, target, suffix, start, end, graph_tpl, path=None):
         import rrdtool
 
         rrdfile = "%s/%s.rrd" % (self.rrd_rootdir, target)
         if not os.path.exists(rrdfile):
             return
-        ext = "png"
-        path = "%s/%s_%s_%s_%s.%s" % (self.img_rootdir, graph_tpl.display_name,
-                                      target, graph_tpl.cf, suffix, ext)
+        if path is None:
+            path = "%s/%s_%s_%s_%s.png" % (
+                self.img_rootdir, graph_tpl.display_name, target,
+                graph_tpl.cf, suffix
+            )
         start = str(start)
         end = str(end)
         defs = []
@@ -84,10 +184,3 @@ class Grapher(object):
 
         if not os.path.exists(path):
             print "[graph] Impossible to create %s graph" % path
-
-    def make_defaults(self, target, graph_tpl):
-        end = "%d" % int(time.mktime(time.localtime()))
-        self.process(target, "day", "-1day", end, graph_tpl)
-        self.process(target, "week", "-1week", end, graph_tpl)
-        self.process(target, "month", "-1month", end, graph_tpl)
-        self.process(target, "year", "-1year", end, graph_tpl)
@@ -0,0 +1,169 @@
+# coding: utf-8
+"""
+Log line handlers.
+
+The log parser reads a syslog stream only once: each line is given to
+the handler declared for the program that produced it. A handler
+lists the program names it consumes (see ``LineHandler.programs``) and
+increments the parser's counters.
+
+Additional handlers can be provided by other extensions using the
+``GetLogHandlers`` event (callbacks must return a list of classes).
+"""
+import re
+from modoboa.extensions.stats.backends import variables
+
+
+class LineHandler(object):
+    """Base class for line handlers."""
+
+    #: names of the programs (syslog identifiers) handled
+    programs = []
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def handle(self, cur_t, prog, log):
+        """Handle a log line
+
+        :param cur_t: the timestamp of the line (truncated to the minute)
+        :param prog: the program which produced the line
+        :param log: the message
+        :return: False if the line format is unknown, True otherwise
+        """
+        raise NotImplementedError
+
+
+class PostfixHandler(LineHandler):
+    """Count sent, received, bounced and rejected messages."""
+
+    programs = ["postfix"]
+
+    def __init__(self, parser):
+        super(PostfixHandler, self).__init__(parser)
+        self.id_expr = re.compile("([0-9A-F]+): (.*)")
+
+    def handle(self, cur_t, prog, log):
+        p = self.parser
+        m = self.id_expr.match(log)
+        if m is None:
+            m = re.match("NOQUEUE: reject: .*from=<(.*)> to=<([^>]*)>", log)
+            if m is None:
+                return False
+            addrto = re.match("([^@]+)@(.+)", m.group(2))
+            if addrto and addrto.group(2) in p.domains:
+                p.inc_counter(addrto.group(2), cur_t, 'reject')
+            return True
+
+        (line_id, line_log) = m.groups()
+
+        m = re.search("message-id=<([^>]*)>", line_log)
+        if m:
+            p.workdict.set(line_id, cur_t, **{'from': m.group(1), 'size': 0})
+            return True
+
+        m = re.search("from=<([^>]*)>, size=(\d+)", line_log)
+        if m:
+            p.workdict.set(line_id, cur_t, **{
+                'from': m.group(1), 'size': int(m.group(2))
+            })
+            return True
+
+        m = re.search("to=<([^>]*)>.*status=(\S+)", line_log)
+        if m:
+            self.delivery(cur_t, line_id, m.group(1), m.group(2))
+            return True
+
+        if line_log == "removed":
+            p.workdict.remove(line_id)
+            return True
+        return False
+
+    def delivery(self, cur_t, line_id, rcpt, status):
+        """Count a delivery attempt."""
+        p = self.parser
+        entry = p.workdict.get(line_id, cur_t)
+        if entry is None:
+            if p.debug:
+                print "Inconsistent mail (%s: %s), skipping" % (line_id, rcpt)
+            return
+        if not status in variables:
+            if p.debug:
+                print "Unsupported status %s, skipping" % status
+            return
+        if rcpt in entry['delivered']:
+            if p.verbose:
+                print "Delivery to %s already counted (%s), skipping" \
+                    % (rcpt, line_id)
+            return
+        entry['delivered'].add(rcpt)
+
+        addrfrom = re.match("([^@]+)@(.+)", entry['from'])
+        if addrfrom is not None and addrfrom.group(2) in p.domains:
+            p.inc_counter(addrfrom.group(2), cur_t, 'sent')
+            p.inc_counter(addrfrom.group(2), cur_t, 'size_sent',
+                          entry['size'])
+            p.inc_hitter("sender", cur_t, addrfrom.group(0))
+        addrto = re.match("([^@]+)@(.+)", rcpt)
+        domname = addrto.group(2) if addrto is not None else None
+        if status == "sent":
+            p.inc_counter(domname, cur_t, 'recv')
+            p.inc_counter(domname, cur_t, 'size_recv', entry['size'])
+            if domname in p.domains:
+                p.inc_hitter("mailbox", cur_t, addrto.group(0))
+                if addrfrom is not None \
+                        and not addrfrom.group(2) in p.domains:
+                    p.inc_hitter("extdomain", cur_t, addrfrom.group(2))
+        else:
+            p.inc_counter(domname, cur_t, status)
+
+
+class AmavisHandler(LineHandler):
+    """Count spam and infected messages (per recipient)."""
+
+    programs = ["amavis", "amavisd"]
+
+    def __init__(self, parser):
+        super(AmavisHandler, self).__init__(parser)
+        self.expr = re.compile(
+            "(?:\([^)]*\) )?(Passed|Blocked) (SPAM|INFECTED)\\b"
+            ".*?<[^>]*> -> ((?:<[^>]*>,?)+)"
+        )
+        self.rcpt_expr = re.compile("<[^@>]+@([^>]+)>")
+
+    def handle(self, cur_t, prog, log):
+        m = self.expr.match(log)
+        if m is None:
+            return False
+        counter = "spam" if m.group(2) == "SPAM" else "virus"
+        for domain in self.rcpt_expr.findall(m.group(3)):
+            self.parser.inc_counter(domain.lower(), cur_t, counter)
+        return True
+
+
+class DovecotHandler(LineHandler):
+    """Count messages rejected by sieve scripts
+
+    Deliveries made through LMTP or the LDA are already counted using
+    postfix logs. Sieve rejects, however, are only visible here since
+    postfix sees a successful delivery.
+    """
+
+    programs = ["dovecot"]
+
+    def __init__(self, parser):
+        super(DovecotHandler, self).__init__(parser)
+        self.expr = re.compile("(?:lmtp|lda)\((?:\d+, )?([^)]*)\): (.*)")
+
+    def handle(self, cur_t, prog, log):
+        m = self.expr.match(log)
+        if m is None:
+            return False
+        if re.match("sieve: .*: rejected", m.group(2)):
+            addr = re.match("[^@]+@(.+)", m.group(1))
+            if addr and addr.group(1) in self.parser.domains:
+                self.parser.inc_counter(addr.group(1), cur_t, "reject")
+        return True
+
+
+handlers = [PostfixHandler, AmavisHandler, DovecotHandler]
@@ -0,0 +1,188 @@
+# coding: utf-8
+"""
+Tools used to compute statistics.
+"""
+import time
+import heapq
+import calendar
+from collections import OrderedDict
+
+MONTHS = dict(
+    (name, i + 1) for i, name in enumerate(
+        ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+         "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+    )
+)
+
+
+class SpaceSaving(object):
+    """Heavy hitters counter (Space-Saving algorithm)
+
+    Keeps track of the most frequent keys of a stream using a fixed
+    amount of memory: at most *capacity* keys are monitored. When a
+    new key arrives and the structure is full, the key with the lowest
+    count is replaced and the new key inherits its count (kept as the
+    maximum overestimation, see ``error``).
+
+    Counts are never underestimated and any key whose real count is
+    greater than total / capacity is guaranteed to be monitored.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counters = {}
+        # One entry per monitored key, counts may be outdated (lower)
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, key, value=1, error=0):
+        """Increment the counter of a key
+
+        :param key: the key
+        :param value: the increment
+        :param error: overestimation already included in *value*
+                      (used when merging counters)
+        """
+        if key in self.counters:
+            self.counters[key][0] += value
+            self.counters[key][1] += error
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [value, error]
+            heapq.heappush(self.heap, (value, key))
+            return
+        while True:
+            count, victim = self.heap[0]
+            current = self.counters[victim][0]
+            if count == current:
+                break
+            heapq.heapreplace(self.heap, (current, victim))
+        heapq.heappop(self.heap)
+        del self.counters[victim]
+        self.counters[key] = [count + value, count + error]
+        heapq.heappush(self.heap, (count + value, key))
+
+    def items(self):
+        """Return (key, count, error) tuples, most frequent keys first."""
+        return sorted(
+            [(key, c[0], c[1]) for key, c in self.counters.iteritems()],
+            key=lambda item: item[1], reverse=True
+        )
+
+    def top(self, n):
+        return self.items()[:n]
+
+
+class QueueIdSet(object):
+    """Bounded working set of postfix queue IDs
+
+    Entries are kept in LRU order (least recently seen first). An entry
+    is removed when the message leaves the queue, when it has not been
+    seen for *max_age* seconds (log time) or when the set exceeds
+    *max_size* entries.
+    """
+
+    def __init__(self, max_size=100000, max_age=5 * 86400):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.peak = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, qid):
+        return qid in self.entries
+
+    def get(self, qid, cur_t):
+        """Return the entry of a queue ID (or None) and mark it as seen."""
+        entry = self.entries.pop(qid, None)
+        if entry is not None:
+            entry["time"] = cur_t
+            self.entries[qid] = entry
+        return entry
+
+    def set(self, qid, cur_t, **values):
+        """Create or update the entry of a queue ID
+
+        Already counted recipients are kept when an entry is updated,
+        postfix logs the sender again before each delivery attempt.
+        """
+        entry = self.get(qid, cur_t)
+        if entry is None:
+            entry = dict(time=cur_t, delivered=set())
+            self.entries[qid] = entry
+        entry.update(values)
+        self.expire(cur_t)
+        return entry
+
+    def remove(self, qid):
+        self.entries.pop(qid, None)
+
+    def expire(self, cur_t):
+        """Remove expired entries and enforce the size limit."""
+        self.peak = max(self.peak, len(self.entries))
+        while self.entries:
+            qid, entry = next(self.entries.iteritems())
+            if len(self.entries) <= self.max_size \
+                    and entry["time"] >= cur_t - self.max_age:
+                break
+            del self.entries[qid]
+
+
+class TimestampDecoder(object):
+    """Convert log timestamps to seconds since the epoch
+
+    ``time.strptime`` is slow: the epoch of each day's midnight is
+    computed once and hour/minute/second offsets are added to it. Days
+    with a DST change don't last 86400 seconds, ``time.mktime`` is
+    called for each of their timestamps.
+    """
+
+    def __init__(self):
+        self.localdays = {}
+        self.utcdays = {}
+
+    def local(self, year, month, day, hour=0, minute=0, second=0):
+        """Decode a local time (traditional syslog timestamps)."""
+        key = (year, month, day)
+        base = self.localdays.get(key)
+        if base is None:
+            base = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+            nextday = int(
+                time.mktime((year, month, day + 1, 0, 0, 0, 0, 0, -1))
+            )
+            if nextday - base != 86400:
+                base = False
+            self.localdays[key] = base
+        if base is False:
+            return int(time.mktime(
+                (year, month, day, hour, minute, second, 0, 0, -1)
+            ))
+        return base + hour * 3600 + minute * 60 + second
+
+    def utc(self, year, month, day, hour=0, minute=0, second=0, offset=0):
+        """Decode a time with a known UTC offset (in seconds)."""
+        key = (year, month, day)
+        base = self.utcdays.get(key)
+        if base is None:
+            base = calendar.timegm((year, month, day, 0, 0, 0, 0, 0, 0))
+            self.utcdays[key] = base
+        return base + hour * 3600 + minute * 60 + second - offset
+
+    def iso8601(self, year, month, day, hour, minute, second, tz=None):
+        """Decode the fields of an ISO 8601 (RFC 5424) timestamp
+
+        Fields are strings, *tz* is either None (local time), 'Z' or
+        an offset like '+02:00'.
+        """
+        args = [int(year), int(month), int(day),
+                int(hour), int(minute), int(second)]
+        if tz is None:
+            return self.local(*args)
+        if tz == "Z":
+            return self.utc(*args)
+        offset = int(tz[1:3]) * 3600 + int(tz[-2:]) * 60
+        return self.utc(*args, offset=-offset if tz[0] == "-" else offset)
@@ -1,45 +1,57 @@
 #!/usr/bin/env python
 # coding: utf-8
 """
-Postfix log parser.
+Mail log parser.
 
 This scripts parses a log file produced by postfix (or using the same
 format). It looks for predefined events and build statistics about
-their occurence rate.
+their occurence rate. Lines produced by amavis and dovecot, found in
+the same stream, are handled during the same pass (see handlers.py).
 
-At the, somes default graphics are generated using the grapher module.
-(see grapher.py)
+Both traditional syslog timestamps (``Oct 11 22:14:15``) and ISO 8601
+ones (``2013-10-11T22:14:15.003+02:00``, rsyslog's high precision
+format) are supported.
+
+Graphics are not generated here: they are rendered on demand by the
+web interface using the grapher module (see grapher.py).
 
 Predefined events are:
  * Per domain sent/received messages,
- * Per domain received bad messages (bounced, reject for now),
+ * Per domain received bad messages (bounced, reject, spam, virus),
  * Per domain sent/received traffics size,
  * Global consolidation of all previous events.
 
 """
 import time
 import sys
-import os
 import re
-import rrdtool
-import string
+import multiprocessing
 from django.core.management.base import BaseCommand
+from django.db import connection
+from modoboa.lib.dbutils import bulk_create
 from optparse import make_option
-from modoboa.lib import parameters
+from modoboa.lib import events, parameters
 from modoboa.extensions.admin.models import Domain
 from modoboa.extensions.stats import Stats
-from modoboa.extensions.stats.grapher import str2Time, Grapher
-from modoboa.extensions.stats.graph_templates import MailTraffic
+from modoboa.extensions.stats.backends import get_backend, rrdstep, variables
+from modoboa.extensions.stats.handlers import handlers
+from modoboa.extensions.stats.lib import (
+    MONTHS, SpaceSaving, QueueIdSet, TimestampDecoder
+)
+from modoboa.extensions.stats.models import TopEntry
+
+# Parser instance shared with the worker processes (inherited through
+# fork, bound methods can't be pickled)
+_parser = None
+
 
-rrdstep = 60
-xpoints = 540
-points_per_sample = 3
-variables = ["sent", "recv", "bounced", "reject", "spam", "virus",
-             "size_sent", "size_recv"]
+def _process_domain(dom):
+    """Worker entry point: see ``LogParser.process_domain``."""
+    return _parser.process_domain(dom)
 
 
 class LogParser(object):
-    def __init__(self, options, workdir, year=None):
+    def __init__(self, options, backend, year=None):
         self.logfile = options["logfile"]
         try:
             self.f = open(self.logfile)
@@ -47,10 +59,12 @@ class LogParser(object):
             if options["debug"]:
                 print "%s" % errno
             sys.exit(1)
-        self.workdir = workdir
+        self.backend = backend
         self.__year = year
         self.debug = options["debug"]
         self.verbose = options["verbose"]
+        self.workers = options.get("workers") or 1
+        self.topn_capacity = options.get("topn_capacity") or 1000
         self.cfs = ['AVERAGE', 'MAX']
 
         curtime = time.localtime()
@@ -66,103 +80,24 @@ class LogParser(object):
             self.data[str(dom.name)] = {}
         self.data["global"] = {}
 
-        self.workdict = {}
-        self.lupdates = {}
-        self.line_expr = re.compile("(\w+)\s+(\d+)\s+(\d+):(\d+):(\d+)\s+([-\w]+)\s+(\w+)/?\w*[[](\d+)[]]:\s+(.*)")
-
-    def init_rrd(self, fname, m):
-        """init_rrd
-
-        Set-up Data Sources (DS)
-        Set-up Round Robin Archives (RRA):
-        - day,week,month and year archives
-        - 2 types : AVERAGE and MAX
-
-        parameter : start time
-        return    : last epoch recorded
-        """
-        ds_type = 'ABSOLUTE'
-        rows = xpoints / points_per_sample
-        realrows = int(rows * 1.1)    # ensure that the full range is covered
-        day_steps = int(3600 * 24 / (rrdstep * rows))
-        week_steps = day_steps * 7
-        month_steps = week_steps * 5
-        year_steps = month_steps * 12
-
-        # Set up data sources for our RRD
-        params = []
-        for v in variables:
-            params += ['DS:%s:%s:%s:0:U' % (v, ds_type, rrdstep * 2)]
-
-        # Set up RRD to archive data
-        for cf in ['AVERAGE', 'MAX']:
-            for step in [day_steps, week_steps, month_steps, year_steps]:
-                params += ['RRA:%s:0.5:%s:%s' % (cf, step, realrows)]
-
-        # With those setup, we can now created the RRD
-        rrdtool.create(str(fname),
-                       '--start', str(m),
-                       '--step', str(rrdstep),
-                       *params)
-        return m
-
-    def update_rrd(self, dom, t):
-        """update_rrd
-
-        Update RRD with records at t time.
-
-        True  : if data are up-to-date for current minute
-        False : syslog may have probably been already recorded
-        or something wrong
-        """
-        fname = "%s/%s.rrd" % (self.workdir, dom)
-        m = t - (t % rrdstep)
-        if not os.path.exists(fname):
-            self.lupdates[fname] = self.init_rrd(fname, m)
-            if self.debug:
-                print "[rrd] create new RRD file %s" % fname
-        else:
-            if not fname in self.lupdates:
-                self.lupdates[fname] = rrdtool.last(str(fname))
-
-        if m <= self.lupdates[fname]:
-            if self.verbose:
-                print "[rrd] VERBOSE events at %s already recorded in RRD" % m
-            return False
-
-        tpl = ""
-        for v in variables:
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        # Missing some RRD steps
-        # Est ce vraiment nécessaire... ?
-        if m > self.lupdates[fname] + rrdstep:
-            values = ""
-            for v in variables:
-                if values != "":
-                    values += ":"
-                values += "0"
-            for p in range(self.lupdates[fname] + rrdstep, m, rrdstep):
-                if self.verbose:
-                    print "[rrd] VERBOSE update -t %s %s:%s (SKIP)" \
-                        % (tpl, p, values)
-                rrdtool.update(str(fname), "-t", tpl, "%s:%s" % (p, values))
-
-        values = "%s" % m
-        tpl = ""
-        for v in variables:
-            values += ":"
-            values += str(self.data[dom][m][v])
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        if self.verbose:
-            print "[rrd] VERBOSE update -t %s %s" % (tpl, values)
-
-        rrdtool.update(str(fname), "-t", tpl, values)
-        self.lupdates[fname] = m
-        return True
+        self.workdict = QueueIdSet(options.get("max_queue_ids") or 100000)
+        self.timings = {}
+        # Heavy hitters are only counted for events not already
+        # recorded by a previous run
+        self.lastupdate = backend.last_update("global") or 0
+        self.hitters = {}
+        self.decoder = TimestampDecoder()
+        self.handlers = {}
+        for cls in handlers + events.raiseQueryEvent("GetLogHandlers"):
+            handler = cls(self)
+            for prog in handler.programs:
+                self.handlers[prog] = handler
+        self.line_expr = re.compile(
+            "(?:(\w{3})\s+(\d+)\s+(\d+):(\d+):(\d+)"
+            "|(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?"
+            "(Z|[+-]\d\d:?\d\d)?)"
+            "\s+([-\w.]+)\s+(\w+)/?\w*(?:[[](\d+)[]])?:\s+(.*)"
+        )
 
     def initcounters(self, dom, cur_t):
         init = {}
@@ -180,6 +115,41 @@ class LogParser(object):
             self.initcounters("global", cur_t)
         self.data["global"][cur_t][counter] += val
 
+    def inc_hitter(self, dimension, cur_t, name):
+        """Increment the counter of a frequent entry
+
+        One bounded structure is used per dimension and per day.
+        """
+        if cur_t <= self.lastupdate:
+            return
+        key = (dimension, cur_t - cur_t % 86400)
+        if not key in self.hitters:
+            self.hitters[key] = SpaceSaving(self.topn_capacity)
+        self.hitters[key].add(name.lower())
+
+    def save_hitters(self):
+        """Merge heavy hitters with the ones already stored
+
+        Stored entries are merged with the new ones into a structure
+        of the same capacity, so the number of rows stays bounded.
+        """
+        for (dimension, day), hitters in self.hitters.iteritems():
+            entries = TopEntry.objects.filter(dimension=dimension, day=day)
+            for entry in entries:
+                hitters.add(entry.name, entry.count, entry.error)
+            entries.delete()
+            rows = []
+            for name, count, error in hitters.items():
+                domain = name.split("@", 1)[1] if "@" in name else ""
+                rows.append(TopEntry(
+                    dimension=dimension, day=day, name=name, domain=domain,
+                    count=count, error=error
+                ))
+            bulk_create(TopEntry, rows)
+        TopEntry.objects.filter(
+            day__lt=int(time.time()) - 366 * 86400
+        ).delete()
+
     def year(self, month):
         """Return the appropriate year
 
@@ -197,93 +167,107 @@ class LogParser(object):
         :param month: the month of the current record beeing parsed
         :return: an integer
         """
-        month = time.strptime(month, "%b").tm_mon if not month.isdigit() \
-            else int(month)
+        month = MONTHS[month] if not month.isdigit() else int(month)
         if self.curmonth == 1 and month != self.curmonth:
             return self.__year - 1
         return self.__year
 
-    def process(self):
-        id_expr = re.compile("([0-9A-F]+): (.*)")
-        prev_se = -1
-        prev_mi = -1
-        prev_ho = -1
+    def parse(self):
+        """Parse the log file and fill the counters."""
+        prev_key = None
         for line in self.f.readlines():
             m = self.line_expr.match(line)
             if not m:
                 continue
-            (mo, da, ho, mi, se, host, prog, pid, log) = m.groups()
-            se = int(int(se) / rrdstep)  # rrd step is one-minute => se = 0
-
-            if prev_se != se or prev_mi != mi or prev_ho != ho:
-                cur_t = str2Time(self.year(mo), mo, da, ho, mi, se)
-                cur_t = cur_t - cur_t % rrdstep
-                prev_mi = mi
-                prev_ho = ho
-                prev_se = se
-            m = id_expr.match(log)
-            if m:
-                (line_id, line_log) = m.groups()
-
-                m = re.search("message-id=<([^>]*)>", line_log)
-                if m:
-                    self.workdict[line_id] = {'from': m.group(1), 'size': 0}
-                    continue
-
-                m = re.search("from=<([^>]*)>, size=(\d+)", line_log)
-                if m:
-                    self.workdict[line_id] = {'from': m.group(1),
-                                              'size': string.atoi(m.group(2))}
-                    continue
-
-                m = re.search("to=<([^>]*)>.*status=(\S+)", line_log)
-                if m:
-                    if not line_id in self.workdict:
-                        if self.debug:
-                            print "Inconsistent mail (%s: %s), skipping" % (line_id, m.group(1))
-                        continue
-                    if not m.group(2) in variables:
+            fields = m.groups()
+            (host, prog, pid, log) = fields[12:]
+
+            # Counters are per-minute: seconds are ignored
+            key = fields[:4] if fields[0] is not None \
+                else fields[5:10] + fields[11:12]
+            if key != prev_key:
+                if fields[0] is not None:
+                    (mo, da, ho, mi) = key
+                    if not mo in MONTHS:
                         if self.debug:
-                            print "Unsupported status %s, skipping" % m.group(2)
+                            print "Unknown month %s, skipping" % mo
                         continue
+                    cur_t = self.decoder.local(
+                        self.year(mo), MONTHS[mo], int(da), int(ho), int(mi)
+                    )
+                else:
+                    cur_t = self.decoder.iso8601(*(fields[5:10] + ("0",)
+                                                   + fields[11:12]))
+                cur_t = cur_t - cur_t % rrdstep
+                prev_key = key
 
-                    addrfrom = re.match("([^@]+)@(.+)", self.workdict[line_id]['from'])
-                    if addrfrom is not None and addrfrom.group(2) in self.domains:
-                        self.inc_counter(addrfrom.group(2), cur_t, 'sent')
-                        self.inc_counter(addrfrom.group(2), cur_t, 'size_sent',
-                                         self.workdict[line_id]['size'])
-                    addrto = re.match("([^@]+)@(.+)", m.group(1))
-                    domname = addrto.group(2) if addrto is not None else None
-                    if m.group(2) == "sent":
-                        self.inc_counter(addrto.group(2), cur_t, 'recv')
-                        self.inc_counter(addrto.group(2), cur_t, 'size_recv',
-                                         self.workdict[line_id]['size'])
-                    else:
-                        self.inc_counter(domname, cur_t, m.group(2))
-                    continue
-
-                if self.debug:
-                    print "Unknown line format: %s" % line_log
-            else:
-                m = re.match("NOQUEUE: reject: .*from=<(.*)> to=<([^>]*)>", log)
-                if m:
-                    addrto = re.match("([^@]+)@(.+)", m.group(2))
-                    if addrto and addrto.group(2) in self.domains:
-                        self.inc_counter(addrto.group(2), cur_t, 'reject')
-                    continue
+            handler = self.handlers.get(prog)
+            if handler is None:
                 if self.debug:
-                    print "Unknown line format: %s" % log
+                    print "Unsupported program %s, skipping" % prog
+                continue
+            if not handler.handle(cur_t, prog, log) and self.debug:
+                print "Unknown line format: %s" % log
+
+    def process_domain(self, dom):
+        """Flush the counters of a domain into the storage backend
 
-        # Sort everything by time
-        G = Grapher()
-        for dom, data in self.data.iteritems():
-            if self.debug:
-                print "[rrd] dealing with domain %s" % dom
-            for t in sorted(data.keys()):
-                self.update_rrd(dom, t)
+        Graphs are not generated here: they are rendered on demand
+        (see ``Grapher.get_graph``).
 
-            for graph_tpl in MailTraffic().get_graphs():
-                G.make_defaults(dom, graph_tpl)
+        :param dom: a domain name (or 'global')
+        :return: a tuple (domain, number of updates, elapsed time)
+        """
+        if self.debug:
+            print "[stats] dealing with domain %s" % dom
+        start = time.time()
+        nupdates = self.backend.write(dom, self.data[dom])
+        return dom, nupdates, time.time() - start
+
+    def report_timings(self):
+        print "[stats] parsing: %.2fs" % self.timings["parsing"]
+        print "[stats] updates: %.2fs (cumulated over workers)" \
+            % self.timings["updates"]
+        print "[stats] %d/%d domain(s) updated in %.2fs using %d worker(s)" \
+            % (self.timings["updated"], len(self.data),
+               self.timings["flush"], self.workers)
+        print "[stats] heavy hitters: %.2fs" % self.timings["hitters"]
+        print "[stats] queue IDs working set: peak %d, %d left" \
+            % (self.workdict.peak, len(self.workdict))
+        print "[stats] maintenance: %.2fs" % self.timings["maintenance"]
+
+    def process(self):
+        global _parser
+
+        start = time.time()
+        self.parse()
+        self.timings["parsing"] = time.time() - start
+
+        start = time.time()
+        if self.workers > 1:
+            _parser = self
+            # Workers must not share the database connection
+            connection.close()
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                results = pool.map(_process_domain, self.data.keys(), 1)
+            finally:
+                pool.close()
+                pool.join()
+                _parser = None
+        else:
+            results = [self.process_domain(dom) for dom in self.data.keys()]
+        self.timings["flush"] = time.time() - start
+        self.timings["updated"] = len([r for r in results if r[1]])
+        self.timings["updates"] = sum(r[2] for r in results)
+        start = time.time()
+        self.save_hitters()
+        self.timings["hitters"] = time.time() - start
+        start = time.time()
+        self.backend.maintenance()
+        self.timings["maintenance"] = time.time() - start
+        if self.verbose or self.debug:
+            self.report_timings()
 
 
 class Command(BaseCommand):
@@ -295,12 +279,23 @@ class Command(BaseCommand):
         make_option("--verbose", default=False, action="store_true",
                     dest="verbose", help="Set verbose mode"),
         make_option("--debug", default=False, action="store_true",
-                    help="Set debug mode")
+                    help="Set debug mode"),
+        make_option("--workers", type="int",
+                    default=multiprocessing.cpu_count(),
+                    help="Number of processes used to store statistics"),
+        make_option("--topn-capacity", type="int", default=1000,
+                    dest="topn_capacity",
+                    help="Maximum number of entries tracked per day to "
+                    "compute top senders/recipients"),
+        make_option("--max-queue-ids", type="int", default=100000,
+                    dest="max_queue_ids",
+                    help="Maximum number of queue IDs kept in memory")
     )
 
     def handle(self, *args, **options):
         Stats().load()
         if options["logfile"] is None:
             options["logfile"] = parameters.get_admin("LOGFILE", app="stats")
-        p = LogParser(options, parameters.get_admin("RRD_ROOTDIR", app="stats"))
+        p = LogParser(options, get_backend(verbose=options["verbose"],
+                                           debug=options["debug"]))
         p.process()
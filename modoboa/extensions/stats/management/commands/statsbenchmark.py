@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+Storage backends benchmark.
+
+Writes then reads fake series using the selected backend and reports
+elapsed times. For the RRD backend, files are created inside a
+temporary directory. For the SQL backend, generated rows are removed
+at the end.
+"""
+import time
+import shutil
+import tempfile
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from modoboa.extensions.stats.backends import (
+    RRDBackend, SQLBackend, rrdstep, variables
+)
+
+
+class Command(BaseCommand):
+    help = 'Statistics storage backends benchmark'
+
+    option_list = BaseCommand.option_list + (
+        make_option("--backend", default="sql",
+                    help="The backend to test (rrd or sql)"),
+        make_option("--series", type="int", default=100,
+                    help="Number of series to write"),
+        make_option("--samples", type="int", default=1440,
+                    help="Number of samples (minutes) per series")
+    )
+
+    def handle(self, *args, **options):
+        workdir = None
+        if options["backend"] == "rrd":
+            workdir = tempfile.mkdtemp()
+            backend = RRDBackend(workdir)
+        elif options["backend"] == "sql":
+            backend = SQLBackend()
+        else:
+            raise CommandError("Unknown backend %s" % options["backend"])
+
+        now = int(time.time())
+        end = now - now % rrdstep
+        start = end - options["samples"] * rrdstep
+        samples = dict(
+            (t, dict((v, 1) for v in variables))
+            for t in range(start, end, rrdstep)
+        )
+        targets = ["bench%d.com" % i for i in range(options["series"])]
+        try:
+            begin = time.time()
+            for target in targets:
+                backend.write(target, samples)
+            elapsed = time.time() - begin
+            print "write: %.2fs (%d samples/s)" % (
+                elapsed, len(targets) * len(samples) / max(elapsed, 0.001)
+            )
+
+            begin = time.time()
+            backend.maintenance()
+            print "maintenance: %.2fs" % (time.time() - begin)
+
+            begin = time.time()
+            for target in targets:
+                backend.read([target], variables, start, end)
+            print "read (one series per request): %.2fs" % (time.time() - begin)
+
+            begin = time.time()
+            backend.read(targets, variables, start, end)
+            print "read (all series summed): %.2fs" % (time.time() - begin)
+        finally:
+            if workdir is not None:
+                shutil.rmtree(workdir)
+            else:
+                from modoboa.extensions.stats.models import Counter
+                Counter.objects.filter(target__in=targets).delete()
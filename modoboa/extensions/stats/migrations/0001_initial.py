@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Counter'
+        db.create_table(u'stats_counter', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('target', self.gf('django.db.models.fields.CharField')(max_length=100, db_index=True)),
+            ('step', self.gf('django.db.models.fields.IntegerField')()),
+            ('cf', self.gf('django.db.models.fields.CharField')(default='AVERAGE', max_length=7)),
+            ('timestamp', self.gf('django.db.models.fields.IntegerField')(db_index=True)),
+            ('sent', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('recv', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('bounced', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('reject', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('spam', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('virus', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('size_sent', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('size_recv', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+        ))
+        db.send_create_signal(u'stats', ['Counter'])
+
+        # Adding unique constraint on 'Counter', fields ['target', 'step', 'cf', 'timestamp']
+        db.create_unique(u'stats_counter', ['target', 'step', 'cf', 'timestamp'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'Counter', fields ['target', 'step', 'cf', 'timestamp']
+        db.delete_unique(u'stats_counter', ['target', 'step', 'cf', 'timestamp'])
+
+        # Deleting model 'Counter'
+        db.delete_table(u'stats_counter')
+
+
+    models = {
+        u'stats.counter': {
+            'Meta': {'unique_together': "(('target', 'step', 'cf', 'timestamp'),)", 'object_name': 'Counter'},
+            'bounced': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'cf': ('django.db.models.fields.CharField', [], {'default': "'AVERAGE'", 'max_length': '7'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'recv': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'reject': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'sent': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'size_recv': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'size_sent': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'spam': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'step': ('django.db.models.fields.IntegerField', [], {}),
+            'target': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'virus': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['stats']
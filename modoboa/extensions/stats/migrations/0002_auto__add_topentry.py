@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'TopEntry'
+        db.create_table(u'stats_topentry', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('dimension', self.gf('django.db.models.fields.CharField')(max_length=20)),
+            ('day', self.gf('django.db.models.fields.IntegerField')()),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=254)),
+            ('domain', self.gf('django.db.models.fields.CharField')(max_length=100, blank=True)),
+            ('count', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('error', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+        ))
+        db.send_create_signal(u'stats', ['TopEntry'])
+
+        # Adding index on 'TopEntry', fields ['dimension', 'day']
+        db.create_index(u'stats_topentry', ['dimension', 'day'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'TopEntry', fields ['dimension', 'day']
+        db.delete_index(u'stats_topentry', ['dimension', 'day'])
+
+        # Deleting model 'TopEntry'
+        db.delete_table(u'stats_topentry')
+
+
+    models = {
+        u'stats.counter': {
+            'Meta': {'unique_together': "(('target', 'step', 'cf', 'timestamp'),)", 'object_name': 'Counter'},
+            'bounced': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'cf': ('django.db.models.fields.CharField', [], {'default': "'AVERAGE'", 'max_length': '7'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'recv': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'reject': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'sent': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'size_recv': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'size_sent': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'spam': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'step': ('django.db.models.fields.IntegerField', [], {}),
+            'target': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'timestamp': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'virus': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        },
+        u'stats.topentry': {
+            'Meta': {'object_name': 'TopEntry', 'index_together': "[['dimension', 'day']]"},
+            'count': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'day': ('django.db.models.fields.IntegerField', [], {}),
+            'dimension': ('django.db.models.fields.CharField', [], {'max_length': '20'}),
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'error': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '254'})
+        }
+    }
+
+    complete_apps = ['stats']
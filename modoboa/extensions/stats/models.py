@@ -0,0 +1,77 @@
+# coding: utf-8
+from django.db import models
+
+
+class Counter(models.Model):
+    """Traffic counters of a series over a time slot
+
+    Used by the SQL storage backend (see ``backends.SQLBackend``).
+
+    *step* is the duration of the slot in seconds: 60 for raw samples,
+    3600 or 86400 for rollups. For rollups, *cf* tells if values are
+    sums ('AVERAGE') or per-minute maximums ('MAX') of the raw
+    samples.
+    """
+    target = models.CharField(max_length=100, db_index=True)
+    step = models.IntegerField()
+    cf = models.CharField(max_length=7, default="AVERAGE")
+    timestamp = models.IntegerField(db_index=True)
+    sent = models.BigIntegerField(default=0)
+    recv = models.BigIntegerField(default=0)
+    bounced = models.BigIntegerField(default=0)
+    reject = models.BigIntegerField(default=0)
+    spam = models.BigIntegerField(default=0)
+    virus = models.BigIntegerField(default=0)
+    size_sent = models.BigIntegerField(default=0)
+    size_recv = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("target", "step", "cf", "timestamp"),)
+
+
+class TopEntryManager(models.Manager):
+
+    def get_top(self, dimension, start, end, domain=None, limit=10):
+        """Return the most frequent entries over a time range
+
+        :param dimension: the dimension to query
+        :param start: range start (timestamp)
+        :param end: range end (timestamp)
+        :param domain: restrict entries to this domain (optional)
+        :param limit: maximum number of returned entries
+        :return: a list of dictionaries (name, total)
+        """
+        qset = self.get_query_set().filter(
+            dimension=dimension, day__gte=start - start % 86400, day__lte=end
+        )
+        if domain is not None:
+            qset = qset.filter(domain=domain)
+        return qset.values("name").annotate(total=models.Sum("count")) \
+            .order_by("-total")[:limit]
+
+
+class TopEntry(models.Model):
+    """Daily counter of a frequent entry
+
+    Entries are computed by the log parser using a bounded heavy
+    hitters structure (see ``lib.SpaceSaving``) so only the most
+    frequent ones are kept for each day. *error* is the maximum
+    overestimation of *count*.
+
+    Dimensions are:
+
+    * sender: local senders (sent messages)
+    * mailbox: local recipients (received messages)
+    * extdomain: external domains sending messages to local recipients
+    """
+    dimension = models.CharField(max_length=20)
+    day = models.IntegerField()
+    name = models.CharField(max_length=254)
+    domain = models.CharField(max_length=100, blank=True)
+    count = models.BigIntegerField(default=0)
+    error = models.BigIntegerField(default=0)
+
+    objects = TopEntryManager()
+
+    class Meta:
+        index_together = [["dimension", "day"]]
@@ -0,0 +1,365 @@
+# coding: utf-8
+import glob
+import os
+import time
+import shutil
+import tempfile
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils.unittest import skipIf
+from modoboa.core.models import Extension
+from modoboa.extensions.admin.models import Domain
+from modoboa.lib import parameters
+from modoboa.lib.tests import ModoTestCase
+from modoboa.extensions.stats import Stats
+from modoboa.extensions.stats.graph_templates import AvgTraffic
+from modoboa.extensions.stats.grapher import Grapher
+from modoboa.extensions.stats.backends import (
+    RRDBackend, SQLBackend, variables
+)
+from modoboa.extensions.stats.lib import (
+    SpaceSaving, QueueIdSet, TimestampDecoder
+)
+from modoboa.extensions.stats.models import Counter, TopEntry
+from modoboa.extensions.stats.management.commands.logparser import LogParser
+
+try:
+    import rrdtool
+except ImportError:
+    rrdtool = None
+
+
+class BackendTestMixin(object):
+    """Tests shared by every storage backend."""
+
+    def get_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.backend = self.get_backend()
+        now = int(time.time())
+        self.start = now - now % 3600 - 4 * 3600
+        self.end = self.start + 3 * 3600
+
+    def make_samples(self, value=1):
+        return dict(
+            (t, dict((v, value) for v in variables))
+            for t in range(self.start, self.end, 60)
+        )
+
+    def check_values(self, result, expected):
+        values = [v for v in result["data"]["sent"] if v is not None]
+        self.assertNotEqual(values, [])
+        for v in values:
+            self.assertAlmostEqual(v, expected)
+
+    def test_write(self):
+        samples = self.make_samples()
+        self.assertEqual(self.backend.write("test.com", samples), len(samples))
+        self.assertEqual(self.backend.write("test.com", samples), 0)
+        self.assertEqual(self.backend.last_update("test.com"), self.end - 60)
+        self.assertIsNone(self.backend.last_update("unknown.com"))
+
+    def test_read(self):
+        self.backend.write("test.com", self.make_samples())
+        result = self.backend.read(
+            ["test.com"], variables, self.start, self.end
+        )
+        self.assertEqual(sorted(result["data"].keys()), sorted(variables))
+        self.check_values(result, 1)
+
+    def test_read_many(self):
+        self.backend.write("test.com", self.make_samples(1))
+        self.backend.write("test2.com", self.make_samples(2))
+        result = self.backend.read(
+            ["test.com", "test2.com"], ["sent"], self.start, self.end
+        )
+        self.check_values(result, 3)
+        self.assertIsNone(
+            self.backend.read(["unknown.com"], ["sent"], self.start, self.end)
+        )
+
+    def test_list_series(self):
+        self.backend.write("test.com", self.make_samples())
+        self.backend.write("global", self.make_samples())
+        self.assertEqual(self.backend.list_series(), ["global", "test.com"])
+
+
+@skipIf(rrdtool is None, "rrdtool is not installed")
+class RRDBackendTestCase(BackendTestMixin, TestCase):
+
+    def get_backend(self):
+        self.workdir = tempfile.mkdtemp()
+        return RRDBackend(self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+
+class SQLBackendTestCase(BackendTestMixin, TestCase):
+
+    def get_backend(self):
+        return SQLBackend()
+
+    def test_rollup(self):
+        self.backend.write("test.com", self.make_samples(1))
+        self.backend.maintenance()
+        # The last hour is not complete yet
+        rows = Counter.objects.filter(target="test.com", step=3600)
+        self.assertEqual(rows.filter(cf="AVERAGE").count(), 2)
+        self.assertEqual(rows.filter(cf="MAX").count(), 2)
+        self.assertEqual(rows.filter(cf="AVERAGE")[0].sent, 60)
+        self.assertEqual(rows.filter(cf="MAX")[0].sent, 1)
+        self.backend.maintenance()
+        self.assertEqual(rows.count(), 4)
+
+        result = self.backend.read(
+            ["test.com"], ["sent"], self.start, self.end, step=3600
+        )
+        self.assertEqual(result["step"], 3600)
+        self.check_values(result, 1)
+        result = self.backend.read(
+            ["test.com"], ["sent"], self.start, self.end, "MAX", step=3600
+        )
+        self.check_values(result, 1)
+
+    def test_prune(self):
+        self.backend.write("test.com", {
+            self.start - 3 * 86400: dict((v, 1) for v in variables)
+        })
+        self.backend.prune()
+        self.assertIsNone(self.backend.last_update("test.com"))
+
+
+class SpaceSavingTestCase(TestCase):
+
+    def test_capacity(self):
+        hitters = SpaceSaving(3)
+        for key in ["a"] * 10 + ["b"] * 5 + ["c", "d", "e", "f"]:
+            hitters.add(key)
+        self.assertEqual(len(hitters), 3)
+        self.assertEqual(hitters.top(2), [("a", 10, 0), ("b", 5, 0)])
+
+    def test_overestimation(self):
+        hitters = SpaceSaving(2)
+        for key in ["a", "a", "a", "b", "c"]:
+            hitters.add(key)
+        # 'c' replaced 'b' and inherited its count
+        self.assertEqual(hitters.items(), [("a", 3, 0), ("c", 2, 1)])
+
+
+class QueueIdSetTestCase(TestCase):
+
+    def test_update_keeps_deliveries(self):
+        qids = QueueIdSet()
+        qids.set("ABC", 100, size=0)
+        qids.get("ABC", 110)["delivered"].add("user@test.com")
+        qids.set("ABC", 120, size=42)
+        entry = qids.get("ABC", 130)
+        self.assertEqual(entry["size"], 42)
+        self.assertEqual(entry["delivered"], set(["user@test.com"]))
+        qids.remove("ABC")
+        self.assertFalse("ABC" in qids)
+
+    def test_limits(self):
+        qids = QueueIdSet(max_size=2, max_age=100)
+        qids.set("A", 0)
+        qids.set("B", 10)
+        qids.get("A", 20)
+        qids.set("C", 30)
+        # 'B' is the least recently seen entry
+        self.assertEqual(sorted(qids.entries.keys()), ["A", "C"])
+        qids.set("D", 125)
+        self.assertEqual(sorted(qids.entries.keys()), ["C", "D"])
+        self.assertEqual(qids.peak, 3)
+
+
+class TimestampDecoderTestCase(TestCase):
+
+    def test_local(self):
+        decoder = TimestampDecoder()
+        # Covers DST changes, whatever the local timezone is
+        for day in range(0, 365, 3):
+            for hour in [0, 1, 2, 3, 12, 23]:
+                t = time.localtime(1356998400 + day * 86400)
+                args = (t.tm_year, t.tm_mon, t.tm_mday, hour, 30, 15)
+                self.assertEqual(
+                    decoder.local(*args),
+                    int(time.mktime(args + (0, 0, -1)))
+                )
+
+    def test_iso8601(self):
+        decoder = TimestampDecoder()
+        self.assertEqual(
+            decoder.iso8601("2013", "10", "11", "22", "14", "15", "Z"),
+            1381529655
+        )
+        self.assertEqual(
+            decoder.iso8601("2013", "10", "11", "22", "14", "15", "+02:00"),
+            1381529655 - 7200
+        )
+        self.assertEqual(
+            decoder.iso8601("2013", "10", "11", "22", "14", "15", "-0130"),
+            1381529655 + 5400
+        )
+
+
+class TopEntryTestCase(TestCase):
+
+    def test_get_top(self):
+        day = 86400 * 100
+        for offset, name, count in [(0, "a@test.com", 5),
+                                    (0, "b@test.com", 8),
+                                    (86400, "a@test.com", 4),
+                                    (86400, "c@test2.com", 20)]:
+            TopEntry.objects.create(
+                dimension="sender", day=day + offset, name=name,
+                domain=name.split("@")[1], count=count
+            )
+        top = TopEntry.objects.get_top("sender", day, day + 2 * 86400,
+                                       domain="test.com")
+        self.assertEqual(
+            [(e["name"], e["total"]) for e in top],
+            [("a@test.com", 9), ("b@test.com", 8)]
+        )
+        top = TopEntry.objects.get_top("sender", day, day + 1, limit=1)
+        self.assertEqual(top[0]["name"], "b@test.com")
+
+
+class LogParserTestCase(TestCase):
+
+    def parse(self, content):
+        logfile = tempfile.NamedTemporaryFile()
+        logfile.write(content)
+        logfile.flush()
+        parser = LogParser(
+            dict(logfile=logfile.name, debug=False, verbose=False),
+            SQLBackend()
+        )
+        parser.parse()
+        logfile.close()
+        return parser.data
+
+    def test_multiple_sources(self):
+        Domain.objects.create(name="test.com", quota=0, enabled=True)
+        data = self.parse("""\
+Oct 11 22:14:15 mx postfix/qmgr[12]: ABC12: from=<a@ext.com>, size=100, nrcpt=1 (queue active)
+Oct 11 22:14:15 mx postfix/local[13]: ABC12: to=<u@test.com>, relay=local, status=deferred (busy)
+Oct 11 22:14:15 mx postfix/local[13]: ABC12: to=<u@test.com>, relay=local, status=sent (delivered)
+Oct 11 22:14:16 mx postfix/local[13]: ABC12: to=<u@test.com>, relay=local, status=sent (delivered)
+Oct 11 22:14:16 mx postfix/qmgr[12]: ABC12: removed
+Oct 11 22:14:16 mx postfix/qmgr[12]: ABC56: from=<u@test.com>, size=50, nrcpt=2 (queue active)
+Oct 11 22:14:16 mx postfix/smtp[16]: ABC56: to=<x@ext.com>, relay=ext.com[5.6.7.8]:25, status=sent (250 OK)
+Oct 11 22:14:16 mx postfix/smtp[16]: ABC56: to=<y@ext.com>, relay=ext.com[5.6.7.8]:25, status=bounced (550 unknown user)
+Oct 11 22:14:16 mx postfix/qmgr[12]: ABC56: removed
+Oct 11 22:14:16 mx postfix/smtpd[15]: NOQUEUE: reject: RCPT from x[1.2.3.4]: 554 5.7.1 <w@test.com>: Relay access denied; from=<s@ext.com> to=<w@test.com> proto=ESMTP
+Oct 11 22:14:17 mx amavis[14]: (01234-05) Blocked SPAM {DiscardedInbound}, [1.2.3.4]:25 [1.2.3.4] <s@ext.com> -> <u@test.com>,<v@test.com>, Queue-ID: DEF34, mail_id: x, Hits: 9.1, size: 200
+Oct 11 22:14:18 mx amavis[14]: (01234-06) Blocked INFECTED (Eicar-Test-Signature) {DiscardedInbound}, [1.2.3.4]:25 [1.2.3.4] <s@ext.com> -> <u@test.com>, Queue-ID: DEF35
+Oct 11 22:14:19 mx dovecot: lmtp(u@test.com): sieve: msgid=<1@ext.com>: rejected: go away
+""")
+        self.assertEqual(len(data["global"]), 1)
+        self.assertEqual(data["global"].values()[0], {
+            "recv": 2, "size_recv": 150, "sent": 2, "size_sent": 100,
+            "bounced": 1, "reject": 2, "spam": 2, "virus": 1
+        })
+        self.assertEqual(len(data["test.com"]), 1)
+        self.assertEqual(data["test.com"].values()[0], {
+            "recv": 1, "size_recv": 100, "sent": 2, "size_sent": 100,
+            "bounced": 0, "reject": 2, "spam": 2, "virus": 1
+        })
+
+    def test_iso8601(self):
+        data = self.parse(
+            "2013-10-11T22:14:15.003+02:00 mx amavis[14]: (01234-05) "
+            "Passed SPAM {RelayedTaggedInbound}, [1.2.3.4]:25 [1.2.3.4] "
+            "<s@ext.com> -> <u@test.com>, Queue-ID: DEF34\n"
+        )
+        self.assertEqual(data["global"].keys(), [1381522440])
+
+
+class GraphDataTestCase(ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(GraphDataTestCase, self).setUp()
+        Extension.objects.create(name="stats", enabled=True)
+        Stats().load()
+        parameters.save_admin("STORAGE_BACKEND", "sql", app="stats")
+
+    def get_data(self, status="ok", view="graph_data", **params):
+        params.update(gset="mailtraffic", period="custom")
+        self.check_ajax_get(
+            reverse("modoboa.extensions.stats.views.%s" % view), params,
+            status=status
+        )
+
+    def test_custom_period(self):
+        self.get_data(start="2013-10-01", end="2013-10-02")
+        self.get_data(start="1380578400", end="2013-10-02")
+
+    def test_invalid_custom_period(self):
+        self.get_data("ko", start="foo", end="2013-10-02")
+        self.get_data("ko", start="2013-10", end="2013-10-02")
+        self.get_data("ko", start="2013-10-02", end="2013-10-02")
+        self.get_data("ko", start="2013-10-03", end="2013-10-02")
+
+    def test_graph_invalid_custom_period(self):
+        for start in ["*-*-*", "2013-10", "../2013-10-01", "2013-10-02"]:
+            self.get_data("ko", view="graph", graph="avgtraffic",
+                          domain="global", start=start, end="2013-10-02")
+
+
+class FakeGrapher(Grapher):
+    """Grapher writing empty files instead of graphs"""
+
+    def __init__(self, img_rootdir):
+        self.rrd_rootdir = img_rootdir
+        self.img_rootdir = img_rootdir
+        self.rendered = 0
+
+    def process(self, target, suffix, start, end, graph_tpl, path=None):
+        self.rendered += 1
+        open(path, "w").close()
+
+
+class GrapherTestCase(TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.grapher = FakeGrapher(self.workdir)
+        self.tpl = AvgTraffic()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_cache(self):
+        path = self.grapher.get_graph("global", "day", None, None, self.tpl,
+                                      1000)
+        self.assertEqual(
+            self.grapher.get_graph("global", "day", None, None, self.tpl,
+                                   1000),
+            path
+        )
+        self.assertEqual(self.grapher.rendered, 1)
+        # Outdated versions are removed
+        self.grapher.get_graph("global", "day", None, None, self.tpl, 2000)
+        self.assertFalse(os.path.exists(path))
+
+    def test_lock_files(self):
+        for suffix in range(Grapher.nlocks * 2):
+            self.grapher.get_graph("global", str(suffix), 0, 1, self.tpl,
+                                   1000)
+        self.assertLessEqual(
+            len(glob.glob("%s/.lock*" % self.workdir)), Grapher.nlocks
+        )
+
+    def test_custom_expiry(self):
+        old = self.grapher.get_graph("global", "1_2", 1, 2, self.tpl, 1000,
+                                     custom=True)
+        self.assertTrue(old.startswith("%s/custom/" % self.workdir))
+        mtime = time.time() - Grapher.custom_ttl - 1
+        os.utime(old, (mtime, mtime))
+        new = self.grapher.get_graph("global", "3_4", 3, 4, self.tpl, 1000,
+                                     custom=True)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
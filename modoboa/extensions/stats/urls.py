@@ -5,4 +5,6 @@ urlpatterns = patterns(
     'modoboa.extensions.stats.views',
     url(r'^$', 'index', name='fullindex'),
     url(r'^graphs/$', "graphs"),
+    url(r'^graph/$', "graph"),
+    url(r'^data/$', "graph_data"),
 )
@@ -1,5 +1,8 @@
 # coding: utf-8
+import time
 from django.shortcuts import render
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import (
     login_required, user_passes_test, permission_required
@@ -12,7 +15,38 @@ from modoboa.lib.webutils import (
 from modoboa.extensions.admin.models import (
     Domain
 )
-from modoboa.extensions.stats.grapher import periods, str2Time, Grapher
+from modoboa.extensions.stats.grapher import periods, Grapher
+from modoboa.extensions.stats.backends import get_backend
+from modoboa.extensions.stats.models import TopEntry
+
+
+def parse_date(value):
+    """Convert a timestamp or a YYYY-MM-DD date to seconds
+
+    :rtype: int
+    """
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(time.mktime(time.strptime(value, "%Y-%m-%d")))
+    except ValueError:
+        raise ModoboaException(_("Invalid date: %s") % value)
+
+
+def parse_custom_period(request):
+    """Return the (start, end) timestamps of a custom period
+
+    *start* and *end* are read from the request's parameters.
+    """
+    if not "start" in request.GET or not "end" in request.GET:
+        raise ModoboaException(_("Bad custom period"))
+    start, end = [
+        parse_date(value)
+        for value in [request.GET["start"], request.GET["end"]]
+    ]
+    if start >= end:
+        raise ModoboaException(_("Bad custom period"))
+    return start, end
 
 
 @login_required
@@ -65,25 +99,170 @@ def graphs(request):
         tplvars.update(domain=domain[0].name)
 
     if period == "custom":
-        if not "start" in request.GET or not "end" in request.GET:
-            raise ModoboaException(_("Bad custom period"))
-        start = request.GET["start"]
-        end = request.GET["end"]
-        G = Grapher()
-        period_name = "%s_%s" % (start.replace('-', ''), end.replace('-', ''))
-        for tpl in gsets[gset].get_graphs():
-            tplvars['graphs'].append(tpl.display_name)
-            G.process(
-                tplvars["domain"], period_name, str2Time(*start.split('-')),
-                str2Time(*end.split('-')), tpl
-            )
-        tplvars["period_name"] = period_name
-        tplvars["start"] = start
-        tplvars["end"] = end
+        start, end = parse_custom_period(request)
+        tplvars["start"] = request.GET["start"]
+        tplvars["end"] = request.GET["end"]
     else:
-        tplvars['graphs'] = gsets[gset].get_graph_names()
+        deltas = dict((p["name"], p["delta"]) for p in periods)
+        end = int(time.time())
+        start = end - deltas.get(period, 86400)
+    tplvars.update(gset=gset, graphs=gsets[gset].get_graph_names())
+
+    domain = None if tplvars["domain"] == "global" else tplvars["domain"]
+    tops = [
+        (_("Top senders"), "sender"),
+        (_("Top recipients"), "mailbox"),
+    ]
+    if domain is None:
+        tops.append((_("Top external domains"), "extdomain"))
+    tplvars["tops"] = [
+        dict(title=title, entries=TopEntry.objects.get_top(
+            dimension, start, end, domain
+        )) for title, dimension in tops
+    ]
 
     return ajax_simple_response(dict(
         status="ok",
         content=_render_to_string(request, "stats/graphs.html", tplvars)
     ))
+
+
+@login_required
+@user_passes_test(lambda u: u.group != "SimpleUsers")
+def graph(request):
+    """Serve a single graph
+
+    Graphs are rendered on first request and then cached (see
+    ``Grapher.get_graph``). Clients are given an ETag and a
+    Last-Modified date so they don't download unchanged graphs again.
+    """
+    gsets = events.raiseDictEvent("GetGraphSets")
+    gset = request.GET.get("gset", None)
+    if not gset in gsets:
+        raise Http404
+    name = request.GET.get("graph", None)
+    tpls = [tpl for tpl in gsets[gset].get_graphs()
+            if tpl.display_name == name]
+    if not tpls:
+        raise Http404
+    domain = request.GET.get("domain", "global")
+    if domain == "global":
+        if not request.user.is_superuser:
+            raise PermDeniedException
+    else:
+        try:
+            dom = Domain.objects.get(name=domain)
+        except Domain.DoesNotExist:
+            raise Http404
+        if not request.user.can_access(dom):
+            raise PermDeniedException
+
+    period = request.GET.get("period", "day")
+    if period == "custom":
+        start, end = parse_custom_period(request)
+        suffix = "%d_%d" % (start, end)
+    elif period in [p["name"] for p in periods]:
+        suffix = period
+        start = "end-1%s" % period
+        end = None
+    else:
+        raise Http404
+
+    G = Grapher()
+    lastupdate = G.last_update(domain)
+    if lastupdate is None:
+        raise Http404
+    etag = '"%s"' % G.cache_key(domain, suffix, tpls[0], lastupdate)
+    if "HTTP_IF_NONE_MATCH" in request.META:
+        if request.META["HTTP_IF_NONE_MATCH"] == etag:
+            return HttpResponseNotModified()
+    else:
+        since = parse_http_date_safe(
+            request.META.get("HTTP_IF_MODIFIED_SINCE", "")
+        )
+        if since is not None and since >= lastupdate:
+            return HttpResponseNotModified()
+    path = G.get_graph(domain, suffix, start, end, tpls[0], lastupdate,
+                       custom=period == "custom")
+    if path is None:
+        raise Http404
+    with open(path, "rb") as fp:
+        response = HttpResponse(fp.read(), content_type="image/png")
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(lastupdate)
+    return response
+
+
+@login_required
+@user_passes_test(lambda u: u.group != "SimpleUsers")
+def graph_data(request):
+    """Return the values behind a graphic set as JSON
+
+    Used for client-side charting. Supported parameters:
+
+    * gset: the graphic set
+    * domains: comma separated list of domains (their values are
+      summed). Defaults to 'global' for super administrators and to
+      every accessible domain otherwise
+    * cf: consolidation function (AVERAGE or MAX)
+    * resolution: wanted step in seconds
+    * period: a predefined period or 'custom' (then *start* and *end*
+      must be provided, as timestamps or YYYY-MM-DD dates)
+    """
+    gsets = events.raiseDictEvent("GetGraphSets")
+    gset = request.GET.get("gset", None)
+    if not gset in gsets:
+        raise ModoboaException(_("Unknown graphic set"))
+    cf = request.GET.get("cf", "AVERAGE")
+    if not cf in ["AVERAGE", "MAX"]:
+        raise ModoboaException(_("Unknown consolidation function"))
+    step = request.GET.get("resolution", None)
+    if step is not None and not step.isdigit():
+        raise ModoboaException(_("Invalid resolution"))
+
+    domains = request.GET.get("domains", None)
+    if domains is None:
+        if request.user.is_superuser:
+            targets = ["global"]
+        else:
+            targets = [
+                str(name) for name in Domain.objects.get_for_admin(
+                    request.user
+                ).values_list("name", flat=True)
+            ]
+    else:
+        targets = [str(name) for name in domains.split(",") if name]
+        names = [name for name in targets if name != "global"]
+        if len(names) != len(targets) and not request.user.is_superuser:
+            raise PermDeniedException
+        if names and Domain.objects.get_for_admin(request.user) \
+                .filter(name__in=names).count() != len(set(names)):
+            raise PermDeniedException
+
+    period = request.GET.get("period", "day")
+    if period == "custom":
+        start, end = parse_custom_period(request)
+    else:
+        deltas = dict((p["name"], p["delta"]) for p in periods)
+        if not period in deltas:
+            raise ModoboaException(_("Unknown period"))
+        end = int(time.time())
+        start = end - deltas[period]
+
+    graphs = gsets[gset].get_graphs()
+    variables = []
+    for tpl in graphs:
+        variables += tpl.vars.keys()
+    result = get_backend().read(targets, variables, start, end, cf, step)
+    if result is None:
+        return ajax_simple_response(dict(status="ok", graphs=[]))
+    return ajax_simple_response(dict(
+        status="ok", start=result["start"], end=result["end"],
+        step=result["step"], graphs=[dict(
+            name=tpl.display_name, title=unicode(tpl.title),
+            vertlabel=unicode(tpl.vertlabel), curves=[dict(
+                name=v, legend=unicode(d["legend"]), color=d["color"],
+                type=d.get("type", "LINE"), data=result["data"][v]
+            ) for v, d in tpl.vars.iteritems()]
+        ) for tpl in graphs]
+    ))
@@ -1,5 +1,6 @@
 # coding: utf-8
 from django.db import connection
+from django.db.models import Q
 from django.conf import settings
             
 def db_table_exists(table, cursor=None):
@@ -31,3 +32,54 @@ def db_type(connection="default"):
         if settings.DATABASES[connection]['ENGINE'].find(t) != -1:
             return t
     return None
+
+
+def bulk_create(model, objs, batch_size=1000):
+    """Insert objects in batches using ``QuerySet.bulk_create``
+
+    Each batch is passed without *batch_size* so that the database
+    backend can split it further if it has lower limits (sqlite).
+
+    :param model: the model class
+    :param objs: a list of unsaved instances
+    :param batch_size: the maximum number of objects per batch
+    :return: the number of inserted objects
+    """
+    for pos in range(0, len(objs), batch_size):
+        model.objects.bulk_create(objs[pos:pos + batch_size])
+    return len(objs)
+
+
+def queryset_chunks(queryset, keys, chunk_size=500):
+    """Iterate over a queryset by chunks
+
+    Chunks are read using keyset pagination (no OFFSET, so each query
+    costs the same) and the queryset is evaluated for each chunk:
+    ``prefetch_related`` lookups apply, unlike with ``iterator()``.
+
+    :param queryset: a ``QuerySet`` object
+    :param keys: a list of fields giving a unique ordering (relations
+                 are allowed, ie. ``domain__name``)
+    :param chunk_size: the number of objects per chunk
+    :return: a generator of lists of objects
+    """
+    queryset = queryset.order_by(*keys)
+    last = None
+    while True:
+        qset = queryset
+        if last is not None:
+            cond = None
+            for pos, key in enumerate(keys):
+                q = Q(**dict(
+                    [(k, v) for k, v in zip(keys[:pos], last[:pos])]
+                    + [("%s__gt" % key, last[pos])]
+                ))
+                cond = q if cond is None else cond | q
+            qset = qset.filter(cond)
+        objs = list(qset[:chunk_size])
+        if not objs:
+            break
+        yield objs
+        if len(objs) < chunk_size:
+            break
+        last = [reduce(getattr, key.split("__"), objs[-1]) for key in keys]
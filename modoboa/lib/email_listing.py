@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import re
+import base64
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.template import Template, Context
@@ -18,6 +18,8 @@ class MBconnector(object):
 
 
 class Page(object):
+    navbar_template = "common/pagination_bar.html"
+
     def __init__(self, pageid, id_start, id_stop, items, 
                  items_per_page, has_previous, has_next,
                  baseurl=None):
@@ -49,6 +51,68 @@ class Page(object):
         return lid
 
 
+class CursorPage(Page):
+    """A page of a keyset (or *seek*) pagination
+
+    Pages are not identified by their offset but by cursors (see
+    ``encode_cursor``) pointing to the first or last item of the
+    adjacent pages. The total number of items (used to display the
+    number of pages) can be an approximation.
+
+    :param emails: the items of this page
+    :param truncated: the total number of items is a lower bound
+    """
+    navbar_template = "common/cursor_pagination_bar.html"
+
+    def __init__(self, pageid, emails, items, items_per_page,
+                 previous_cursor=None, next_cursor=None, last_cursor=None,
+                 baseurl=None, truncated=False):
+        super(CursorPage, self).__init__(
+            pageid, None, None, items, items_per_page,
+            previous_cursor is not None, next_cursor is not None,
+            baseurl
+        )
+        self.emails = emails
+        self.truncated = truncated
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+        self.last_cursor = last_cursor
+
+    def previous_page_number(self):
+        if not self.has_previous:
+            return False
+        return max(self.number - 1, 1)
+
+    def last_page(self):
+        return max(super(CursorPage, self).last_page(), self.number)
+
+
+def encode_cursor(*values):
+    """Build an opaque cursor (safe to use inside URLs)
+
+    Padding characters are removed since they can't be used inside
+    the location hash.
+    """
+    return base64.urlsafe_b64encode(
+        "|".join([str(v) for v in values])
+    ).rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the values of a cursor built by ``encode_cursor``
+
+    :return: a list of strings or None if the cursor is invalid
+    """
+    if not cursor:
+        return None
+    try:
+        cursor = str(cursor)
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    except (TypeError, UnicodeEncodeError):
+        return None
+    return value.split("|")
+
+
 class Paginator(object):
     def __init__(self, total, elems_per_page):
         self.total = total
@@ -113,15 +177,24 @@ class EmailListing(object):
         context = {
             "page": page, "STATIC_URL": settings.STATIC_URL, "baseurl": baseurl
         }
-        return render_to_string("common/pagination_bar.html", context)
+        return render_to_string(page.navbar_template, context)
 
     def fetch(self, request, id_start, id_stop):
-        table = self.tbltype(
+        return self.render_emails(
             request,
             self.mbc.fetch(start=id_start, stop=id_stop,
                            mbox=self.folder,
                            nbelems=self.elems_per_page)
         )
+
+    def fetch_page(self, request, page):
+        """Return the content of a page (numbered or cursor based)."""
+        if isinstance(page, CursorPage):
+            return self.render_emails(request, page.emails)
+        return self.fetch(request, page.id_start, page.id_stop)
+
+    def render_emails(self, request, emails):
+        table = self.tbltype(request, emails)
         tpl = Template("""
 <form method="POST" id="listingform">
   {{ table }}
@@ -137,17 +210,17 @@ class EmailListing(object):
         if not page:
             listing = "<div class='alert alert-info'>%s</div>" % _("Empty mailbox")
         else:
-            listing = self.fetch(request, page.id_start, page.id_stop)
+            listing = self.fetch_page(request, page)
         return dict(listing=listing, navbar=self.render_navbar(page, self.baseurl))
 
 
 def parse_search_parameters(request):
     if 'pattern' in request.GET:
-        request.session["pattern"] = re.escape(request.GET["pattern"])
+        request.session["pattern"] = request.GET["pattern"]
         if 'criteria' in request.GET:
             request.session["criteria"] = request.GET["criteria"]
         else:
-            request.session["criteria"] = ["from_addr"]
+            request.session["criteria"] = "from_addr"
     else:
         for p in ["pattern", "criteria"]:
             if p in request.session.keys():
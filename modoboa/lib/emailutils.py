@@ -250,7 +250,8 @@ def set_email_headers(msg, subject, sender, rcpt):
     msg["Date"] = formatdate(time.time(), True)
 
 
-def __sendmail(sender, rcpt, msgstring, server='localhost', port=25):
+def __sendmail(sender, rcpt, msgstring, server='localhost', port=25,
+               connection=None):
     """Message sending
 
     Return a tuple (True, None) on success, (False, error message)
@@ -261,12 +262,17 @@ def __sendmail(sender, rcpt, msgstring, server='localhost', port=25):
     :param msgstring: the message structure (must be a string)
     :param server: the sending server's address
     :param port: the listening port
+    :param connection: an opened ``smtplib.SMTP`` instance to use
+                       (it is not closed)
     :return: tuple
     """
     try:
-        s = smtplib.SMTP(server, port)
-        s.sendmail(sender, [rcpt], msgstring)
-        s.quit()
+        if connection is not None:
+            connection.sendmail(sender, [rcpt], msgstring)
+        else:
+            s = smtplib.SMTP(server, port)
+            s.sendmail(sender, [rcpt], msgstring)
+            s.quit()
     except smtplib.SMTPException, e:
         return False, "SMTP error: %s" % str(e)
     return True, None
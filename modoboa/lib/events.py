@@ -83,12 +83,14 @@ class observe(object):
             if extname:
                 from modoboa.core.models import Extension
                 from modoboa.core.extensions import exts_pool
+                extdef = exts_pool.get_extension(extname)
+                if extdef is not None and extdef.always_active:
+                    # No need to query the database
+                    return f(*args, **kwargs)
                 try:
                     ext = Extension.objects.get(name=extname)
                 except Extension.DoesNotExist:
-                    extdef = exts_pool.get_extension(extname)
-                    if not extdef.always_active:
-                        return []
+                    return []
                 else:
                     if not ext.enabled:
                         return []
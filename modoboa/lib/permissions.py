@@ -1,8 +1,9 @@
 # coding: utf-8
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
-from django.db import IntegrityError
-from modoboa.core.models import ObjectAccess
+from django.db import IntegrityError, transaction
+from django.db.models.query import QuerySet
+from modoboa.core.models import ObjectAccess, invalidate_access_cache
 import events
 from exceptions import ModoboaException
 
@@ -24,6 +25,53 @@ def get_account_roles(user):
     return sorted(std_roles, key=lambda role: role[1])
 
 
+def bulk_grant(accesses, batch_size=1000):
+    """Create ``ObjectAccess`` entries by batches
+
+    Entries must not exist yet. If another process has created some of
+    them in the meantime, the batch is inserted row by row and
+    duplicates are ignored.
+
+    :param accesses: an iterable of ``ObjectAccess`` objects
+    :param batch_size: number of entries inserted per query
+    :return: the number of created entries
+    """
+    def flush(batch):
+        # Savepoints keep the transaction usable after an error
+        # (required by PostgreSQL)
+        sid = transaction.savepoint()
+        try:
+            ObjectAccess.objects.bulk_create(batch)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+            return len(batch)
+        created = 0
+        for entry in batch:
+            sid = transaction.savepoint()
+            try:
+                entry.save()
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+                created += 1
+        return created
+
+    total = 0
+    batch = []
+    invalidate_access_cache()
+    for entry in accesses:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            total += flush(batch)
+            batch = []
+    if batch:
+        total += flush(batch)
+    return total
+
+
 def grant_access_to_object(user, obj, is_owner=False):
     """Grant access to an object for a given user
 
@@ -41,6 +89,7 @@ def grant_access_to_object(user, obj, is_owner=False):
     :param is_owner: the user is the unique object's owner
     """
     ct = ContentType.objects.get_for_model(obj)
+    invalidate_access_cache()
     try:
         entry = user.objectaccess_set.get(content_type=ct, object_id=obj.id)
         entry.is_owner = is_owner
@@ -51,37 +100,52 @@ def grant_access_to_object(user, obj, is_owner=False):
         return
 
     try:
-        ObjectAccess.objects.create(user=user, content_type=ct, 
+        ObjectAccess.objects.create(user=user, content_type=ct,
                                     object_id=obj.id, is_owner=is_owner)
-        if is_owner:
-            from modoboa.core.models import User
-            for su in User.objects.filter(is_superuser=True):
-                if su == user:
-                    continue
-                try:
-                    ObjectAccess.objects.create(user=su, content_type=ct, object_id=obj.id)
-                except IntegrityError:
-                    pass
-
     except IntegrityError, e:
         raise ModoboaException(_("Failed to grant access (%s)" % str(e)))
+    if is_owner:
+        from modoboa.core.models import User
+
+        superusers = User.objects.filter(is_superuser=True) \
+            .exclude(pk=user.pk) \
+            .exclude(pk__in=ObjectAccess.objects.filter(
+                content_type=ct, object_id=obj.id).values("user")) \
+            .values_list("pk", flat=True)
+        bulk_grant(
+            ObjectAccess(user_id=pk, content_type=ct, object_id=obj.id)
+            for pk in superusers
+        )
 
 
-def grant_access_to_objects(user, objects, ct):
+def grant_access_to_objects(user, objects, ct, batch_size=1000):
     """Grant access to a collection of objects
 
     All objects in the collection must share the same type (ie. ``ct``
-    applies to all objects).
+    applies to all objects). Objects the user can already access are
+    ignored (existing entries are not modified).
 
     :param user: a ``User`` object
-    :param objects: a list of objects
+    :param objects: a ``QuerySet`` or a list of objects
     :param ct: the content type
+    :param batch_size: number of entries inserted per query
+    :return: the number of created entries
     """
-    for obj in objects:
-        try:
-            ObjectAccess.objects.create(user=user, content_type=ct, object_id=obj.id)
-        except IntegrityError:
-            pass
+    existing = ObjectAccess.objects.filter(user=user, content_type=ct) \
+        .values_list("object_id", flat=True)
+    if isinstance(objects, QuerySet):
+        # Anti-join done by the database
+        ids = list(objects.exclude(pk__in=existing)
+                   .values_list("pk", flat=True))
+    else:
+        existing = set(existing.filter(
+            object_id__in=[obj.id for obj in objects]
+        ))
+        ids = [obj.id for obj in objects if not obj.id in existing]
+    return bulk_grant(
+        (ObjectAccess(user=user, content_type=ct, object_id=pk)
+         for pk in ids), batch_size
+    )
 
 
 def ungrant_access_to_object(obj, user=None):
@@ -94,6 +158,7 @@ def ungrant_access_to_object(obj, user=None):
     :param user: a ``User`` object
     """
     ct = ContentType.objects.get_for_model(obj)
+    invalidate_access_cache()
     if user:
         try:
             ObjectAccess.objects.get(user=user, content_type=ct, object_id=obj.id).delete()
@@ -108,6 +173,7 @@ def ungrant_access_to_objects(objects):
 
     :param objects: a list of objects inheriting from ``model.Model``
     """
+    invalidate_access_cache()
     for obj in objects:
         ct = ContentType.objects.get_for_model(obj)
         ObjectAccess.objects.filter(content_type=ct, object_id=obj.id).delete()
@@ -17,6 +17,11 @@ from templatetags.lib_tags import render_link
 
 class Column(object):
     """Simple column representation
+
+    When rows are built from model instances, a column can declare
+    the relations it displays (``related`` attribute, a list of
+    lookups). They are loaded in advance by the table (see
+    ``Table.prefetch``).
     """
     def __init__(self, name, **kwargs):
         self.name = name
@@ -115,11 +120,21 @@ class DivColumn(Column):
 
 
 class ActionColumn(Column):
+    """Specific column: actions
+
+    ``defvalue`` is a function called with the current user and the
+    row identifier (or the model instance if the ``use_object``
+    attribute is set).
+    """
     def render(self, fct, user, rowid):
         return fct(user, rowid)
 
     def transform(self, row, col, table):
-        col["value"] = self.render(self.defvalue, table.request.user, row[table.idkey])
+        if getattr(self, "use_object", False) and "object" in row:
+            rowid = row["object"]
+        else:
+            rowid = row[table.idkey]
+        col["value"] = self.render(self.defvalue, table.request.user, rowid)
         col["safe"] = True
 
 
@@ -192,10 +207,24 @@ class Table(object):
             self.rows += [nrow]
             trcpt += 1
 
+    def prefetch(self, objects):
+        """Load the relations needed by the columns
+
+        :param objects: a ``QuerySet`` (other iterables are returned
+                        unchanged)
+        """
+        related = []
+        for c in self.columns:
+            related += [r for r in getattr(c, "related", [])
+                        if not r in related]
+        if not related or not hasattr(objects, "prefetch_related"):
+            return objects
+        return objects.prefetch_related(*related)
+
     def _rows_from_model(self, objects, include_type_in_id=False):
         rows = []
-        for obj in objects:
-            nrow = {}
+        for obj in self.prefetch(objects):
+            nrow = {"object": obj}
             try:
                 idkey = getattr(self, "idkey")
                 nrow[idkey] = getattr(obj, idkey)
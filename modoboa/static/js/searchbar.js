@@ -43,6 +43,7 @@
                 this.options.navobj.delparam("criteria");
                 this.options.navobj.delparam("page");
             }
+            this.options.navobj.delparam("cursor");
             this.options.navobj.update();
         }
     };